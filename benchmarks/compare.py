@@ -0,0 +1,57 @@
+"""
+Сравнение двух файлов результатов run.py: время каждой операции в новой версии
+относительно базовой. Код возврата 1, если какая-то операция замедлилась
+больше допустимого порога.
+
+    python benchmarks/compare.py baseline.json results.json [--threshold 1.2]
+"""
+import argparse
+import json
+import sys
+
+
+def load_results(path):
+    with open(path, encoding="utf-8") as f:
+        report = json.load(f)
+    return {(result["size"], result["operation"]): result
+            for result in report["results"] if "skipped" not in result}, report.get("environment", {})
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Сравнение результатов замеров")
+    parser.add_argument("baseline")
+    parser.add_argument("current")
+    parser.add_argument("--threshold", type=float, default=1.2,
+                        help="допустимое отношение нового времени к базовому (по умолчанию 1.2 = +20%%)")
+    parser.add_argument("--metric", default="best_s", choices=("best_s", "median_s"))
+    args = parser.parse_args(argv)
+
+    baseline, baseline_env = load_results(args.baseline)
+    current, current_env = load_results(args.current)
+    print(f"База: {baseline_env.get('commit')} ({baseline_env.get('created')}), "
+          f"сравнение: {current_env.get('commit')} ({current_env.get('created')})")
+    print(f"{'размер':>8} {'операция':<24} {'было, мс':>10} {'стало, мс':>10} {'отношение':>9}  память, КБ")
+    regressions = 0
+    for key in sorted(set(baseline) & set(current)):
+        old, new = baseline[key], current[key]
+        ratio = new[args.metric] / old[args.metric] if old[args.metric] else float("inf")
+        mark = ""
+        if ratio > args.threshold:
+            mark = "  МЕДЛЕННЕЕ"
+            regressions += 1
+        elif ratio < 1 / args.threshold:
+            mark = "  быстрее"
+        memory = f"{old.get('peak_python_kb')} -> {new.get('peak_python_kb')}"
+        print(f"{key[0]:>8} {key[1]:<24} {old[args.metric] * 1000:10.1f} {new[args.metric] * 1000:10.1f} "
+              f"{ratio:9.2f}  {memory}{mark}")
+    unmatched = len(set(baseline) ^ set(current))
+    if unmatched:
+        print(f"Замеров без пары (есть только в одном из файлов): {unmatched}")
+    if regressions:
+        print(f"Замедлились операций: {regressions} (порог {args.threshold})")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,157 @@
+"""
+Детерминированный генератор реестра для замеров: при одинаковых size и seed
+получается одна и та же база. Названия и контрагенты на кириллице, размеры
+папок неравномерны (несколько крупных подпапок и длинный хвост мелких),
+у части документов есть вложения, в том числе общие для нескольких документов.
+Даты окончания около 10% документов отсчитываются от текущего дня, чтобы
+проверке сроков всегда было что найти.
+
+    python benchmarks/generate.py 100000 registry.db [--seed 1]
+"""
+import argparse
+import os
+import random
+import sqlite3
+import sys
+from datetime import date, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from registrar.storage import DocumentStorage, initialize_database
+
+GENERATE_CHUNK_ROWS = 10000
+
+TOP_FOLDERS = ["Договоры", "Соглашения", "Акты", "Счета", "Доверенности", "Приказы",
+               "Письма", "Протоколы", "Спецификации", "Лицензии", "Претензии", "Архив"]
+DOCUMENT_KINDS = ["Договор поставки", "Договор аренды", "Договор подряда", "Дополнительное соглашение",
+                  "Акт выполненных работ", "Счет-фактура", "Доверенность", "Соглашение о конфиденциальности",
+                  "Договор оказания услуг", "Лицензионный договор", "Спецификация", "Претензия"]
+SUBJECTS = ["оборудования", "нежилого помещения", "программного обеспечения", "строительных материалов",
+            "офисной мебели", "транспортных услуг", "канцелярских товаров", "ремонтных работ",
+            "электроэнергии", "консультационных услуг", "серверного оборудования", "продуктов питания"]
+COMPANY_FORMS = ["ООО", "АО", "ПАО", "ИП", "ЗАО", "ГУП"]
+COMPANY_WORDS = ["Ромашка", "Василек", "Северсталь", "Техноком", "Альфа", "Вектор", "Гранит", "Заря",
+                 "Импульс", "Континент", "Меридиан", "Надежда", "Омега", "Прогресс", "Радуга", "Сибирь",
+                 "Стройинвест", "Транзит", "Урал", "Феникс", "Холдинг", "Энергия", "Юпитер", "Янтарь"]
+DESCRIPTION_WORDS = ["поставка", "оплата", "срок", "исполнение", "гарантия", "приложение", "объем",
+                     "стоимость", "порядок", "сторона", "обязательство", "ответственность", "расчет",
+                     "качество", "приемка", "доставка", "условие", "изменение"]
+ATTACHMENT_EXTENSIONS = [".pdf", ".pdf", ".pdf", ".docx", ".xlsx", ".jpg"]
+
+# Доля документов с вложениями и доля вложений, повторяющих уже существующий файл
+ATTACHMENT_SHARE = 0.4
+SHARED_ATTACHMENT_SHARE = 0.15
+
+
+def folder_layout(rng, size):
+    """
+    Подпапки с размерами по закону Ципфа: первая подпапка в несколько раз
+    больше десятой, сотая - совсем маленькая. Возвращает [(top, sub, число документов)].
+    """
+    sub_folder_count = max(1, min(2000, size // 200))
+    folders = []
+    for index in range(sub_folder_count):
+        top_folder = TOP_FOLDERS[index % len(TOP_FOLDERS)]
+        year = 2015 + (index // len(TOP_FOLDERS)) % 11
+        suffix = index // (len(TOP_FOLDERS) * 11)
+        folders.append((top_folder, f"{year}" + (f"-{suffix}" if suffix else "")))
+    weights = [1 / (rank + 1) for rank in range(sub_folder_count)]
+    rng.shuffle(weights)
+    total = sum(weights)
+    counts = [int(size * weight / total) for weight in weights]
+    counts[0] += size - sum(counts)
+    return [(top, sub, count) for (top, sub), count in zip(folders, counts) if count]
+
+
+def counterparty(rng):
+    form = rng.choice(COMPANY_FORMS)
+    if form == "ИП":
+        return f"ИП {rng.choice(['Иванов', 'Петров', 'Сидоров', 'Кузнецов', 'Смирнов', 'Попов'])} {rng.choice('АБВГДЕИКЛМНОПРС')}.{rng.choice('АБВГДЕИКЛМНОПРС')}."
+    return f"{form} «{rng.choice(COMPANY_WORDS)}{rng.choice(['', '-М', ' Плюс', ' Групп', ' Трейд'])}»"
+
+
+def generate_registry(db_path, size, seed=1):
+    """Создает базу db_path с size документами. Возвращает число созданных вложений."""
+    if os.path.exists(db_path):
+        os.remove(db_path)
+    initialize_database(db_path)
+    storage = DocumentStorage(db_path)
+    rng = random.Random(seed)
+    counterparties = [counterparty(rng) for _ in range(max(10, size // 50))]
+    base_date = date(2015, 1, 1)
+    today = date.today()
+
+    rows = []
+    for top_folder, sub_folder, count in folder_layout(rng, size):
+        for _ in range(count):
+            start_date = base_date + timedelta(days=rng.randrange(4000))
+            if rng.random() < 0.15:
+                end_date = None # Бессрочный
+            elif rng.random() < 0.1:
+                end_date = today + timedelta(days=rng.randrange(120)) # Истекают в ближайшие месяцы
+            else:
+                end_date = start_date + timedelta(days=rng.randrange(30, 1500))
+            number = f"{rng.choice('АБВГДКМНПРСТ')}-{rng.randrange(1, 100000):05d}/{start_date.year % 100:02d}"
+            rows.append((
+                top_folder, sub_folder, number,
+                f"{rng.choice(DOCUMENT_KINDS)} {rng.choice(SUBJECTS)}",
+                rng.choice(counterparties),
+                start_date.isoformat(),
+                end_date.isoformat() if end_date else None,
+                " ".join(rng.choice(DESCRIPTION_WORDS) for _ in range(rng.randrange(0, 25))),
+            ))
+            if len(rows) >= GENERATE_CHUNK_ROWS:
+                storage.insert_document_rows(rows)
+                rows = []
+    if rows:
+        storage.insert_document_rows(rows)
+    return _generate_attachments(db_path, size, rng)
+
+
+def _generate_attachments(db_path, size, rng):
+    """Записи вложений и содержимого (blobs) без файлов на диске - для замеров нужна только база."""
+    conn = sqlite3.connect(db_path)
+    try:
+        blobs = []
+        attachments = []
+        created = 0
+        with conn:
+            for document_id in range(1, size + 1):
+                if rng.random() >= ATTACHMENT_SHARE:
+                    continue
+                for _ in range(rng.choice((1, 1, 1, 2, 3))):
+                    if blobs and rng.random() < SHARED_ATTACHMENT_SHARE:
+                        content_hash, file_path = rng.choice(blobs)
+                    else:
+                        content_hash = f"{rng.getrandbits(256):064x}"
+                        file_path = content_hash + rng.choice(ATTACHMENT_EXTENSIONS)
+                        conn.execute('INSERT INTO blobs (content_hash, file_path, size) VALUES (?, ?, ?)',
+                                     (content_hash, file_path, rng.randrange(10_000, 5_000_000)))
+                        if len(blobs) < 10000:
+                            blobs.append((content_hash, file_path))
+                    attachments.append((document_id, file_path, f"Скан {document_id}{os.path.splitext(file_path)[1]}",
+                                        content_hash))
+                    created += 1
+                if len(attachments) >= GENERATE_CHUNK_ROWS:
+                    conn.executemany('INSERT INTO attachments (document_id, file_path, name, content_hash) VALUES (?, ?, ?, ?)',
+                                     attachments)
+                    attachments = []
+            conn.executemany('INSERT INTO attachments (document_id, file_path, name, content_hash) VALUES (?, ?, ?, ?)',
+                             attachments)
+    finally:
+        conn.close()
+    return created
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Генерация тестового реестра документов")
+    parser.add_argument("size", type=int, help="число документов")
+    parser.add_argument("db", help="файл создаваемой базы (перезаписывается)")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args(argv)
+    attachments = generate_registry(args.db, args.size, args.seed)
+    print(f"Создано документов: {args.size}, вложений: {attachments} в {args.db}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
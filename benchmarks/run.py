@@ -0,0 +1,283 @@
+"""
+Замеры горячих путей реестра на синтетических базах (см. generate.py).
+Для каждого размера базы операции выполняются несколько раз; в результат идут
+лучшее и медианное время и пиковый объем памяти Python (tracemalloc, отдельным
+прогоном, чтобы трассировка не искажала время). Операции с таблицей документов
+выполняются с платформой Qt offscreen; без PySide6 они пропускаются.
+
+    python benchmarks/run.py --sizes 1000,10000,100000 --output results.json
+    python benchmarks/compare.py old.json results.json
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import date, datetime
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from generate import generate_registry
+from registrar.export import FOLDER_EXPORT_COLUMNS, database_sheets, subfolder_sheets, write_csv, write_workbook
+from registrar.importer import import_documents
+from registrar.models import Document
+from registrar.storage import DocumentStorage, initialize_database
+
+DEFAULT_SIZES = "1000,10000,100000"
+RESULTS_FORMAT_VERSION = 1
+
+# Сколько документов изменяют и добавляют замеры сохранения
+SAVE_EDIT_COUNT = 100
+SAVE_NEW_COUNT = 1000
+# Сколько мелких запросов (как при открытии папок и добавлении вложений) выполняет point_queries
+POINT_QUERY_COUNT = 1000
+
+
+class Context:
+    """Состояние замеров одного размера базы: рабочая копия базы, самая крупная подпапка, объекты Qt."""
+    def __init__(self, db_path, work_dir, qt):
+        self.db_path = db_path
+        self.work_dir = work_dir
+        # Кэш запросов отключен: повторные прогоны должны выполнять запрос, а не брать его из кэша.
+        # Выигрыш от кэша замеряют отдельные операции *_cached на cached_storage.
+        self.storage = DocumentStorage(db_path, query_cache_size=0)
+        self.cached_storage = DocumentStorage(db_path)
+        self.qt = qt
+        folders = self.storage.load_folder_tree()
+        self.largest_folder = max(((top, sub) for top, subs in folders.items() for sub in subs),
+                                  key=lambda folder: self.storage.count_documents(*folder))
+        self.largest_documents = self.storage.load_documents(*self.largest_folder)
+        self.search_results = self.storage.search_documents("договор поставки")
+        self.import_source = None
+
+
+def setup_qt():
+    """Приложение Qt с платформой offscreen и модель таблицы из main.py; None, если PySide6 недоступен."""
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    try:
+        from PySide6.QtWidgets import QApplication, QTableView
+        import main
+    except ImportError as e:
+        print(f"Замеры таблицы пропущены: {e}", file=sys.stderr)
+        return None
+    app = QApplication.instance() or QApplication([])
+    view = QTableView()
+    view.resize(1000, 700)
+    model = main.DocumentTableModel(view)
+    view.setModel(model)
+    view.show()
+    return {"app": app, "view": view, "model": model, "main": main}
+
+
+def show_rows(context, columns, rows, folder=None):
+    """Как update_document_table: новая выборка в модели и отрисовка первой страницы."""
+    qt = context.qt
+    qt["model"].set_rows(columns, rows, folder)
+    qt["view"].viewport().repaint()
+    qt["app"].processEvents()
+
+
+def op_table_sort(context, title):
+    """Сортировка самой крупной подпапки в таблице по столбцу title (щелчок по заголовку)."""
+    qt = context.qt
+    columns = qt["main"].FOLDER_COLUMNS
+    show_rows(context, columns, context.largest_documents, context.largest_folder)
+    qt["model"].sort([column.title for column in columns].index(title))
+    qt["view"].viewport().repaint()
+    qt["app"].processEvents()
+
+
+def cleanup_table_sort(context):
+    context.qt["model"].sort(-1)
+
+
+def op_save_edits(context):
+    for doc in context.largest_documents[:SAVE_EDIT_COUNT]:
+        doc.description = (doc.description or "") + " изм."
+        context.storage.update(doc)
+    context.storage.flush()
+
+
+def op_save_new(context):
+    top_folder, sub_folder = context.largest_folder
+    for index in range(SAVE_NEW_COUNT):
+        context.storage.add(Document(f"BENCH-{index}", "Договор поставки оборудования", "ООО «Замер»",
+                                     date(2024, 1, 1), date(2026, 1, 1), "добавлен замером"),
+                            top_folder, sub_folder)
+    context.storage.flush()
+
+
+def cleanup_save_new(context):
+    conn = sqlite3.connect(context.db_path)
+    with conn:
+        conn.execute("DELETE FROM documents WHERE number LIKE 'BENCH-%'")
+    conn.close()
+
+
+def op_rename_folder(context):
+    """Переименование самой крупной подпапки туда и обратно."""
+    top_folder, sub_folder = context.largest_folder
+    context.storage.rename_folder(top_folder, sub_folder, sub_folder + " (замер)")
+    context.storage.rename_folder(top_folder, sub_folder + " (замер)", sub_folder)
+
+
+def op_point_queries(context):
+    """Много коротких запросов подряд: здесь основное время - открытие соединения и разбор SQL."""
+    for _ in range(POINT_QUERY_COUNT):
+        context.storage.find_blob("0" * 64)
+        context.storage.get_setting("benchmark")
+
+
+def op_export_all_csv(context):
+    with open(os.path.join(context.work_dir, "export.csv"), "w", newline="", encoding="utf-8") as f:
+        write_csv(f, FOLDER_EXPORT_COLUMNS, context.storage.iter_all_export_rows())
+
+
+def op_import_csv(context):
+    if context.import_source is None:
+        context.import_source = os.path.join(context.work_dir, "import.csv")
+        with open(context.import_source, "w", newline="", encoding="utf-8") as f:
+            write_csv(f, FOLDER_EXPORT_COLUMNS, context.storage.iter_all_export_rows())
+    target = os.path.join(context.work_dir, "import.db")
+    if os.path.exists(target):
+        os.remove(target)
+    initialize_database(target)
+    import_documents(DocumentStorage(target), context.import_source)
+
+
+# (имя, функция(context), нужен ли Qt, функция очистки после прогона или None)
+OPERATIONS = [
+    ("load_folder_tree", lambda c: c.storage.load_folder_tree(), False, None),
+    ("load_largest_subfolder", lambda c: c.storage.load_documents(*c.largest_folder), False, None),
+    ("save_edits", op_save_edits, False, None),
+    ("save_new", op_save_new, False, cleanup_save_new),
+    ("search_fts", lambda c: c.storage.search_documents("договор поставки"), False, None),
+    ("search_field", lambda c: c.storage.search_documents("ромашка", "counterparty"), False, None),
+    ("search_date_range", lambda c: c.storage.find_by_date_range("start_date", date(2020, 1, 1), date(2020, 3, 31)),
+     False, None),
+    ("expiring", lambda c: c.storage.find_expiring(30), False, None),
+    ("search_fts_cached", lambda c: c.cached_storage.search_documents("договор поставки"), False, None),
+    ("expiring_cached", lambda c: c.cached_storage.find_expiring(30), False, None),
+    ("rename_folder", op_rename_folder, False, None),
+    ("point_queries", op_point_queries, False, None),
+    ("table_subfolder", lambda c: show_rows(c, c.qt["main"].FOLDER_COLUMNS, c.largest_documents, c.largest_folder),
+     True, None),
+    ("table_search", lambda c: show_rows(c, c.qt["main"].SEARCH_COLUMNS, c.search_results), True, None),
+    ("table_sort_end_date", lambda c: op_table_sort(c, "Дата окончания"), True, cleanup_table_sort),
+    ("table_sort_number", lambda c: op_table_sort(c, "Номер"), True, cleanup_table_sort),
+    ("export_subfolder_xlsx", lambda c: write_workbook(os.path.join(c.work_dir, "subfolder.xlsx"),
+                                                       subfolder_sheets(c.storage, *c.largest_folder)), False, None),
+    ("export_all_xlsx", lambda c: write_workbook(os.path.join(c.work_dir, "all.xlsx"), database_sheets(c.storage)),
+     False, None),
+    ("export_all_csv", op_export_all_csv, False, None),
+    ("import_csv", op_import_csv, False, None),
+]
+
+
+def measure(context, function, cleanup, repeat, memory):
+    """Время каждого прогона и пиковая память Python отдельного прогона под tracemalloc."""
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function(context)
+        times.append(time.perf_counter() - started)
+        if cleanup:
+            cleanup(context)
+    peak_kb = None
+    if memory:
+        tracemalloc.start()
+        try:
+            function(context)
+            peak_kb = tracemalloc.get_traced_memory()[1] // 1024
+        finally:
+            tracemalloc.stop()
+        if cleanup:
+            cleanup(context)
+    return times, peak_kb
+
+
+def run_size(size, args, qt):
+    work_dir = tempfile.mkdtemp(prefix=f"registrar-bench-{size}-")
+    try:
+        db_path = os.path.join(work_dir, "documents.db")
+        started = time.perf_counter()
+        generate_registry(db_path, size, args.seed)
+        print(f"[{size}] база создана за {time.perf_counter() - started:.1f} с", file=sys.stderr)
+        context = Context(db_path, work_dir, qt)
+        results = []
+        for name, function, needs_qt, cleanup in OPERATIONS:
+            if args.only and name not in args.only or name in args.skip:
+                continue
+            if needs_qt and qt is None:
+                results.append({"size": size, "operation": name, "skipped": "PySide6 недоступен"})
+                continue
+            times, peak_kb = measure(context, function, cleanup, args.repeat, not args.no_memory)
+            result = {"size": size, "operation": name, "best_s": round(min(times), 6),
+                      "median_s": round(statistics.median(times), 6), "runs_s": [round(t, 6) for t in times],
+                      "peak_python_kb": peak_kb}
+            results.append(result)
+            memory = f", пик {peak_kb} КБ" if peak_kb is not None else ""
+            print(f"[{size}] {name:<24} {result['best_s'] * 1000:10.1f} мс{memory}", file=sys.stderr)
+        return results
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def environment():
+    commit = None
+    try:
+        import subprocess
+        commit = subprocess.run(["git", "-C", REPO_DIR, "rev-parse", "--short", "HEAD"],
+                                capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        pass
+    return {
+        "format": RESULTS_FORMAT_VERSION,
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "commit": commit,
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Замеры горячих путей реестра документов")
+    parser.add_argument("--sizes", default=DEFAULT_SIZES, help=f"размеры баз через запятую (по умолчанию {DEFAULT_SIZES})")
+    parser.add_argument("--repeat", type=int, default=3, help="прогонов каждой операции")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--only", action="append", default=[], help="выполнить только эти операции")
+    parser.add_argument("--skip", action="append", default=[], help="пропустить операции")
+    parser.add_argument("--no-memory", action="store_true", help="не замерять память (быстрее)")
+    parser.add_argument("--no-qt", action="store_true", help="пропустить замеры таблицы")
+    parser.add_argument("--output", "-o", help="файл JSON с результатами (по умолчанию stdout)")
+    parser.add_argument("--list", action="store_true", help="показать список операций")
+    args = parser.parse_args(argv)
+    if args.list:
+        print("\n".join(name for name, *_ in OPERATIONS))
+        return 0
+
+    qt = None if args.no_qt else setup_qt()
+    report = {"environment": environment(), "results": []}
+    for size in (int(size) for size in args.sizes.split(",")):
+        report["results"].extend(run_size(size, args, qt))
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,62 +1,625 @@
+import time
+STARTUP_STARTED = time.perf_counter() # Отсчет времени запуска - до остальных импортов
+
 import sys
 import os
-import shutil
 import sqlite3
-import shortuuid
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
 
 from PySide6.QtWidgets import (QApplication, QWidget, QMainWindow, QSplitter, QTreeView,
                                QTableView, QStatusBar, QFileDialog, QDialog,
                                QVBoxLayout, QHBoxLayout, QInputDialog,
                                QPushButton, QMessageBox, QAbstractItemView,
-                               QLabel, QTextEdit, QListWidget, QLineEdit,
-                               QDateEdit, QComboBox, QMenu)
+                               QLabel, QTextEdit, QListWidget, QListWidgetItem, QLineEdit,
+                               QDateEdit, QComboBox, QMenu, QProgressDialog)
 from PySide6.QtGui import QStandardItemModel, QStandardItem, QAction, QColor
-from PySide6.QtCore import QDate, Qt, QModelIndex
-import pandas as pd
-
-
-class Document:
-    def __init__(self, number="", name="", counterparty="",
-                 start_date=None, end_date=None,
-                 description="", attachments=None, db_id=None):
-        self.id = db_id # Идентификатор в БД
-        self.number = number
-        self.name = name
-        self.counterparty = counterparty
-        # Убедимся, что даты - это QDate
-        if isinstance(start_date, str):
-            self.start_date = QDate.fromString(start_date, "dd.MM.yyyy")
-        elif isinstance(start_date, QDate) or start_date is None:
-            self.start_date = start_date or QDate.currentDate()
+from PySide6.QtCore import QDate, Qt, QModelIndex, QAbstractTableModel, QThread, Signal, QTimer, QObject
+
+from registrar.instrumentation import configure_logging, profiler_from_args, span
+from registrar.models import Document, date_sort_key, format_date, natural_sort_key, parse_date_range
+from registrar.storage import (ATTACHMENT_TEXT_FIELD, SQLITE_POLL_BUSY_TIMEOUT, DocumentStorage, QueryCancelled,
+                               SubfolderCache, WriteConflict, initialize_database)
+from registrar.attachments import (AttachmentStore, AttachmentScan, IngestCancelled, attachment_path,
+                                   process_pending_deletes, shard_attachments,
+                                   ATTACHMENT_LAYOUT_KEY, ATTACHMENT_LAYOUT_SHARDED)
+from registrar.importer import import_documents
+from registrar.export import (ExportCancelled, FOLDER_EXPORT_COLUMNS, database_sheets, excel_sheet_title,
+                              subfolder_sheets, write_workbook)
+
+
+# Бюджет времени от старта процесса до показа окна, мс (переопределяется REGISTRAR_STARTUP_BUDGET_MS)
+STARTUP_BUDGET_MS = 1500
+
+# Сколько файлов вложений копируется параллельно
+ATTACHMENT_COPY_WORKERS = 4
+
+# Поиск при наборе: пауза после последнего нажатия, мс; минимальная длина запроса;
+# сколько найденных строк передается в таблицу за раз
+SEARCH_DEBOUNCE_MS = 300
+SEARCH_MIN_CHARS = 2
+SEARCH_STREAM_BATCH = 500
+
+# Как часто проверяются изменения базы, сделанные другими экземплярами программы, мс
+EXTERNAL_CHANGES_POLL_MS = 2000
+# Через сколько повторить сохранение, если база была занята другим экземпляром, мс
+SAVE_RETRY_MS = 5000
+
+
+class AttachmentIngestor(QObject):
+    """
+    Параллельно помещает файлы в AttachmentStore в пуле потоков.
+    Сигналы испускаются из рабочих потоков и доставляются в поток GUI через очередь событий.
+    """
+    progress = Signal(int, int)     # ключ файла, процент
+    done = Signal(int, object)      # ключ файла, Attachment
+    failed = Signal(int, str)       # ключ файла, текст ошибки
+    cancelled = Signal(int)         # ключ файла
+
+    def __init__(self, attachment_store, parent=None):
+        super().__init__(parent)
+        self.attachment_store = attachment_store
+        self._executor = None
+        self._cancel_event = None
+        self._pending = set()
+        self._next_key = 0
+        # Все помещенные в хранилище вложения; пополняется в рабочем потоке до испускания done,
+        # поэтому после cancel() полон, даже если сигналы еще стоят в очереди событий
+        self._stored = []
+        self._stored_lock = threading.Lock()
+        self.done.connect(self._finish)
+        self.failed.connect(self._finish)
+        self.cancelled.connect(self._finish)
+
+    def submit(self, source_path):
+        """Ставит файл в очередь, возвращает ключ, с которым придут сигналы."""
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=ATTACHMENT_COPY_WORKERS,
+                                                thread_name_prefix="attachment-copy")
+            self._cancel_event = threading.Event()
+        key = self._next_key
+        self._next_key += 1
+        self._pending.add(key)
+        self._executor.submit(self._ingest, key, source_path, self._cancel_event)
+        return key
+
+    def _ingest(self, key, source_path, cancel_event):
+        try:
+            attachment = self.attachment_store.ingest(
+                source_path, lambda percent: self.progress.emit(key, percent), cancel_event)
+        except IngestCancelled:
+            self.cancelled.emit(key)
+        except Exception as e:
+            self.failed.emit(key, str(e))
         else:
-            self.start_date = QDate.currentDate()
+            with self._stored_lock:
+                self._stored.append(attachment)
+            self.done.emit(key, attachment)
+
+    def _finish(self, key, *args):
+        self._pending.discard(key)
+
+    def has_pending(self):
+        return bool(self._pending)
+
+    def stored_attachments(self):
+        """Вложения, которые успели попасть в хранилище (в т.ч. те, чей сигнал done еще не доставлен)."""
+        with self._stored_lock:
+            return list(self._stored)
+
+    def cancel(self):
+        """
+        Отменяет все незавершенные копирования и ждет остановки потоков.
+        Задачи из очереди тоже запускаются и сразу сообщают об отмене; новые файлы можно добавлять снова.
+        """
+        if self._executor is None:
+            return
+        self._cancel_event.set()
+        self._executor.shutdown(wait=True)
+        self._executor = None
+
+
+class AttachmentCleanupWorker(QThread):
+    """Фоновая обработка очереди pending_deletes (см. process_pending_deletes)."""
+    removed = Signal(int) # сколько файлов удалено
+
+    def __init__(self, storage, attachments_dir, parent=None):
+        super().__init__(parent)
+        self.storage = storage
+        self.attachments_dir = attachments_dir
+        self._stopped = False
+
+    def stop(self):
+        self._stopped = True
+
+    def run(self):
+        try:
+            removed = process_pending_deletes(self.storage, self.attachments_dir, lambda: self._stopped)
+        except sqlite3.OperationalError:
+            removed = 0 # База долго занята другим экземпляром - очередь останется до следующего запуска очистки
+        self.removed.emit(removed)
+
+
+class AttachmentScanWorker(QThread):
+    """Полная проверка хранилища вложений в фоне (см. AttachmentScan)."""
+    progress = Signal(int, int) # проверено файлов, удалено файлов
+    finished_scan = Signal(int, int, bool) # проверено, удалено, дошли ли до конца хранилища
+
+    def __init__(self, storage, attachments_dir, parent=None):
+        super().__init__(parent)
+        self.scan = AttachmentScan(storage, attachments_dir, self.progress.emit)
+        self._stopped = False
+
+    def stop(self):
+        self._stopped = True
+
+    def run(self):
+        try:
+            completed = self.scan.run(lambda: self._stopped)
+        except sqlite3.OperationalError:
+            completed = False # База долго занята другим экземпляром - проверка продолжится с сохраненного места
+        self.finished_scan.emit(self.scan.checked, self.scan.removed, completed)
+
+
+class TextIndexWorker(QThread):
+    """Извлечение текста новых вложений для поиска по содержимому в фоне (см. index_attachment_texts)."""
+    progress = Signal(int) # проиндексировано файлов
+    indexed = Signal(int)
+
+    def __init__(self, storage, attachments_dir, parent=None):
+        super().__init__(parent)
+        self.storage = storage
+        self.attachments_dir = attachments_dir
+        self._stopped = False
+
+    def stop(self):
+        self._stopped = True
+
+    def run(self):
+        from registrar.textindex import index_attachment_texts # Разбор файлов нужен не при каждом запуске
+        try:
+            indexed = index_attachment_texts(self.storage, self.attachments_dir, lambda: self._stopped,
+                                             self.progress.emit)
+        except sqlite3.OperationalError:
+            indexed = 0 # База долго занята другим экземпляром - очередь разберем после следующего сохранения
+        self.indexed.emit(indexed)
 
-        if isinstance(end_date, str):
-            self.end_date = QDate.fromString(end_date, "dd.MM.yyyy") if end_date else None
-        elif isinstance(end_date, QDate) or end_date is None:
-            self.end_date = end_date
+
+class AttachmentShardMigrationWorker(QThread):
+    """Однократный перенос файлов вложений в подкаталоги в фоне (см. shard_attachments)."""
+    finished_migration = Signal(int, bool) # перенесено файлов, завершена ли миграция
+
+    def __init__(self, storage, attachments_dir, parent=None):
+        super().__init__(parent)
+        self.storage = storage
+        self.attachments_dir = attachments_dir
+        self._stopped = False
+
+    def stop(self):
+        self._stopped = True
+
+    def run(self):
+        try:
+            moved, completed = shard_attachments(self.storage, self.attachments_dir, lambda: self._stopped)
+        except sqlite3.OperationalError:
+            moved, completed = 0, False # База долго занята другим экземпляром - миграция продолжится при запуске
+        self.finished_migration.emit(moved, completed)
+
+
+def to_qdate(value):
+    """datetime.date -> QDate для виджетов; модель документов работает с datetime.date."""
+    return QDate(value.year, value.month, value.day)
+
+
+def from_qdate(value):
+    """QDate из виджета -> datetime.date."""
+    return date(value.year(), value.month(), value.day())
+
+
+# Столбец таблицы документов: заголовок, функция(top_folder, sub_folder, doc) -> текст и, чтобы сортировать
+# и фильтровать по значению, а не по тексту, - функция -> дата (date) или -> ключ сортировки (key).
+# Номера сравниваются "естественно" (№ 9 < № 10); такой ключ дороже, поэтому не у всех текстовых столбцов.
+TableColumn = namedtuple("TableColumn", ["title", "text", "date", "key"], defaults=[None, None])
+
+# Наборы столбцов таблицы документов. Столбцы документа общие для всех таблиц,
+# чтобы одно и то же значение (например, бессрочная дата окончания) везде выглядело и сортировалось одинаково.
+END_DATE_COLUMN = TableColumn("Дата окончания", lambda top, sub, doc: format_date(doc.end_date, "Бессрочный"),
+                              date=lambda top, sub, doc: doc.end_date)
+
+FOLDER_COLUMNS = [
+    TableColumn("Номер", lambda top, sub, doc: doc.number, key=lambda top, sub, doc: natural_sort_key(doc.number)),
+    TableColumn("Наименование", lambda top, sub, doc: doc.name),
+    TableColumn("Контрагент", lambda top, sub, doc: doc.counterparty),
+    TableColumn("Дата начала", lambda top, sub, doc: format_date(doc.start_date),
+                date=lambda top, sub, doc: doc.start_date),
+    END_DATE_COLUMN,
+]
+
+LOCATION_COLUMNS = [
+    TableColumn("Верхняя папка", lambda top, sub, doc: top),
+    TableColumn("Подпапка", lambda top, sub, doc: sub),
+]
+
+SEARCH_COLUMNS = LOCATION_COLUMNS + FOLDER_COLUMNS
+
+
+def column_sort_key(column):
+    """Функция (top_folder, sub_folder, doc) -> ключ сортировки: даты сравниваются как даты, текст - без учета регистра."""
+    if column.key is not None:
+        return column.key
+    if column.date is not None:
+        date_value = column.date
+        return lambda top, sub, doc: date_sort_key(date_value(top, sub, doc))
+    text = column.text
+    return lambda top, sub, doc: (text(top, sub, doc) or "").casefold()
+
+
+def column_filter(column, text):
+    """
+    Функция (top_folder, sub_folder, doc) -> bool для фильтра столбца: строка ищется в тексте ячейки
+    без учета регистра, а у столбца с датами можно задать диапазон "дд.мм.гггг-дд.мм.гггг".
+    """
+    date_range = parse_date_range(text) if column.date is not None else None
+    if date_range is not None:
+        date_from, date_to = date_range
+        def matches(top, sub, doc):
+            value = column.date(top, sub, doc)
+            if value is None:
+                return date_to is None # Бессрочный - позже любой даты
+            return (date_from is None or value >= date_from) and (date_to is None or value <= date_to)
+        return matches
+    needle = text.casefold()
+    return lambda top, sub, doc: needle in (column.text(top, sub, doc) or "").casefold()
+
+
+def expiring_color(days_left):
+    """Цвет строки в зависимости от оставшегося срока"""
+    if days_left <= 7:
+        return QColor(255, 0, 0)  # Красный для срочных (0-7 дней)
+    if days_left <= 14:
+        return QColor(255, 165, 0)  # Оранжевый (8-14 дней)
+    return QColor(0, 0, 0)  # По умолчанию черный
+
+
+class FolderTreeModel(QStandardItemModel):
+    """
+    Дерево папок с индексом имя -> элемент: добавление и удаление папки
+    вставляют или убирают одну строку, не перестраивая дерево, поэтому
+    выделение и прокрутка сохраняются, а поиск элемента не обходит дерево.
+    """
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self._top_items = {}    # имя -> QStandardItem
+        self._sub_items = {}    # (верхняя папка, подпапка) -> QStandardItem
+
+    def reset(self, folders):
+        """Полностью заполняет дерево из { "Верхняя папка": ["Подпапка", ...], ... }"""
+        self.clear()
+        self._top_items.clear()
+        self._sub_items.clear()
+        top_items = []
+        for top_folder_name, sub_folders in folders.items():
+            top_item = self._make_item(top_folder_name)
+            self._top_items[top_folder_name] = top_item
+            sub_items = [self._make_item(sub_folder_name) for sub_folder_name in sub_folders]
+            for sub_folder_name, sub_item in zip(sub_folders, sub_items):
+                self._sub_items[(top_folder_name, sub_folder_name)] = sub_item
+            if sub_items:
+                top_item.appendRows(sub_items)
+            top_items.append(top_item)
+        # Одна вставка вместо сигналов на каждую строку
+        if top_items:
+            self.invisibleRootItem().appendRows(top_items)
+
+    @staticmethod
+    def _make_item(name):
+        item = QStandardItem(name)
+        item.setEditable(False) # Имя меняется только через операции с папками, иначе индекс устареет
+        return item
+
+    def top_item(self, top_folder_name):
+        return self._top_items.get(top_folder_name)
+
+    def sub_item(self, top_folder_name, sub_folder_name):
+        return self._sub_items.get((top_folder_name, sub_folder_name))
+
+    def add_top_folder(self, top_folder_name):
+        item = self._make_item(top_folder_name)
+        self.appendRow(item)
+        self._top_items[top_folder_name] = item
+        return item
+
+    def add_sub_folder(self, top_folder_name, sub_folder_name):
+        item = self._make_item(sub_folder_name)
+        self._top_items[top_folder_name].appendRow(item)
+        self._sub_items[(top_folder_name, sub_folder_name)] = item
+        return item
+
+    def remove_top_folder(self, top_folder_name):
+        item = self._top_items.pop(top_folder_name)
+        for row in range(item.rowCount()):
+            del self._sub_items[(top_folder_name, item.child(row).text())]
+        self.removeRow(item.row())
+
+    def remove_sub_folder(self, top_folder_name, sub_folder_name):
+        item = self._sub_items.pop((top_folder_name, sub_folder_name))
+        self._top_items[top_folder_name].removeRow(item.row())
+
+    def rename_top_folder(self, top_folder_name, new_name):
+        item = self._top_items.pop(top_folder_name)
+        item.setText(new_name)
+        self._top_items[new_name] = item
+        for row in range(item.rowCount()):
+            sub_folder_name = item.child(row).text()
+            self._sub_items[(new_name, sub_folder_name)] = self._sub_items.pop((top_folder_name, sub_folder_name))
+
+    def rename_sub_folder(self, top_folder_name, sub_folder_name, new_name):
+        item = self._sub_items.pop((top_folder_name, sub_folder_name))
+        item.setText(new_name)
+        self._sub_items[(top_folder_name, new_name)] = item
+
+    def move_sub_folder(self, top_folder_name, sub_folder_name, new_top_folder_name):
+        """Переносит строку подпапки под другую верхнюю папку (создает ее при необходимости)."""
+        item = self._sub_items.pop((top_folder_name, sub_folder_name))
+        self._top_items[top_folder_name].takeRow(item.row())
+        new_parent = self._top_items.get(new_top_folder_name) or self.add_top_folder(new_top_folder_name)
+        new_parent.appendRow(item)
+        self._sub_items[(new_top_folder_name, sub_folder_name)] = item
+        return item
+
+
+class DocumentTableModel(QAbstractTableModel):
+    """
+    Виртуальная модель таблицы документов. Текст ячеек формируется в data()
+    только для видимых строк, а строки подгружаются порциями через
+    canFetchMore/fetchMore - из списка или из итератора (курсора).
+
+    Сортировка и фильтры по столбцам выполняются над объектами Document по
+    значениям (даты - как даты), а не над текстом ячеек. Они привязаны к заголовку
+    столбца и сохраняются при смене набора строк (другая подпапка, поиск).
+    """
+    FETCH_BATCH_SIZE = 500
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self._columns = []
+        self._all = []           # Весь набор строк (список подпапки не копируется) или уже прочитанная часть итератора
+        self._rows = []          # Показываемые строки: тот же _all или его отфильтрованная и упорядоченная копия
+        self._pending = []       # Потоковые строки, которые еще не вставлены в упорядоченный _rows
+        self._source = None      # Итератор с еще не загруженными строками
+        self._loaded = 0         # Сколько строк уже отдано представлению
+        self._locate = None      # строка -> (top_folder, sub_folder, Document)
+        self._color = None       # (top_folder, sub_folder, Document) -> QColor или None
+        self.folder = None       # (top_folder, sub_folder), если показано содержимое подпапки
+        self.sort_order = None   # (заголовок столбца, Qt.SortOrder) или None - исходный порядок
+        self.filters = {}        # заголовок столбца -> текст фильтра
+
+    def set_rows(self, columns, rows, folder=None, color=None):
+        """
+        Показывает новый набор строк. rows - список Document (для подпапки folder)
+        либо список/итератор кортежей (top_folder, sub_folder, Document).
+        """
+        with span("table_rebuild") as timing:
+            self.beginResetModel()
+            self._columns = columns
+            self._color = color
+            self.folder = folder
+            if folder is not None:
+                self._locate = lambda doc: (folder[0], folder[1], doc)
+            else:
+                self._locate = lambda row: row
+            if isinstance(rows, list):
+                self._all = rows
+                self._source = None
+            else:
+                self._all = []
+                self._source = iter(rows)
+            self._apply_view()
+            self.endResetModel()
+            timing.set(rows=len(self._rows))
+
+    def clear(self):
+        self.set_rows([], [])
+
+    def _sort_column(self):
+        """Индекс столбца, по которому упорядочены строки, или -1."""
+        if self.sort_order is not None:
+            for section, column in enumerate(self._columns):
+                if column.title == self.sort_order[0]:
+                    return section
+        return -1
+
+    def _row_filters(self):
+        return [column_filter(column, self.filters[column.title])
+                for column in self._columns if column.title in self.filters]
+
+    def _sorted(self, rows):
+        key = column_sort_key(self._columns[self._sort_column()])
+        reverse = self.sort_order[1] == Qt.SortOrder.DescendingOrder
+        if self.folder is not None:
+            # Строки подпапки - сами документы: ключ без лишнего вызова _locate на каждую строку
+            top_folder, sub_folder = self.folder
+            return sorted(rows, key=lambda doc: key(top_folder, sub_folder, doc), reverse=reverse)
+        return sorted(rows, key=lambda row: key(*row), reverse=reverse)
+
+    def _apply_view(self):
+        """Заново строит показываемые строки из _all с учетом фильтров и сортировки."""
+        row_filters = self._row_filters()
+        self._pending = []
+        if not row_filters and self._sort_column() < 0:
+            # Без сортировки и фильтров строки показываются без копирования, итератор читается порциями
+            self._rows = self._all
+            if self._source is not None and len(self._all) < self.FETCH_BATCH_SIZE:
+                self._pull(self.FETCH_BATCH_SIZE - len(self._all))
+            self._loaded = min(len(self._rows), self.FETCH_BATCH_SIZE)
+            return
+        if self._source is not None:
+            # Упорядочить можно только весь набор
+            self._all.extend(self._source)
+            self._source = None
+        rows = self._all
+        if row_filters:
+            locate = self._locate
+            rows = [row for row in rows if all(matches(*locate(row)) for matches in row_filters)]
+        if self._sort_column() >= 0:
+            rows = self._sorted(rows)
+        self._rows = rows
+        self._loaded = min(len(rows), self.FETCH_BATCH_SIZE)
+
+    def sort(self, column, order=Qt.SortOrder.AscendingOrder):
+        """Упорядочивает строки по столбцу column; column < 0 - исходный порядок набора."""
+        with span("table_sort", column=column) as timing:
+            self.beginResetModel()
+            self.sort_order = (self._columns[column].title, order) if 0 <= column < len(self._columns) else None
+            self._apply_view()
+            self.endResetModel()
+            timing.set(rows=len(self._rows))
+
+    def sort_section(self):
+        """(индекс столбца или -1, порядок) для индикатора сортировки в заголовке."""
+        order = self.sort_order[1] if self.sort_order is not None else Qt.SortOrder.AscendingOrder
+        return self._sort_column(), order
+
+    def set_filter(self, column, text):
+        """Задает (пустой text - снимает) фильтр столбца column."""
+        title = self._columns[column].title
+        text = text.strip()
+        if text:
+            self.filters[title] = text
         else:
-             self.end_date = None
+            self.filters.pop(title, None)
+        self._refilter()
+
+    def clear_filters(self):
+        self.filters.clear()
+        self._refilter()
+
+    def _refilter(self):
+        with span("table_filter", filters=len(self.filters)) as timing:
+            self.beginResetModel()
+            self._apply_view()
+            self.endResetModel()
+            timing.set(rows=len(self._rows))
+        self.headerDataChanged.emit(Qt.Orientation.Horizontal, 0, max(len(self._columns) - 1, 0))
+
+    def is_filtered(self):
+        return any(column.title in self.filters for column in self._columns)
+
+    def visible_count(self):
+        """Число строк набора, прошедших фильтры (загруженные порциями строки тоже считаются)."""
+        return len(self._rows) + len(self._pending)
+
+    def append_rows(self, rows):
+        """
+        Дописывает строки в конец списка (потоковые результаты поиска). Пока первая
+        порция не заполнена, строки сразу показываются, остальные подгружает fetchMore.
+        """
+        if self._rows is self._all:
+            self._rows.extend(rows)
+        else:
+            self._all.extend(rows)
+            row_filters = self._row_filters()
+            if row_filters:
+                rows = [row for row in rows if all(matches(*self._locate(row)) for matches in row_filters)]
+            if self._sort_column() < 0:
+                self._rows.extend(rows)
+            else:
+                # Пересортировка на каждую порцию обошлась бы квадратично: упорядоченный список
+                # перестраивается, только когда накопилось не меньше строк, чем в нем уже есть
+                self._pending.extend(rows)
+                if len(self._pending) >= max(len(self._rows), self.FETCH_BATCH_SIZE):
+                    self.finish_rows()
+                return
+        count = min(len(self._rows), self.FETCH_BATCH_SIZE) - self._loaded
+        if count > 0:
+            self.beginInsertRows(QModelIndex(), self._loaded, self._loaded + count - 1)
+            self._loaded += count
+            self.endInsertRows()
+
+    def finish_rows(self):
+        """Конец потока строк: вставляет в упорядоченную таблицу отложенные append_rows строки."""
+        if not self._pending:
+            return
+        self.beginResetModel()
+        self._rows = self._sorted(self._rows + self._pending)
+        self._pending = []
+        self._loaded = min(len(self._rows), self.FETCH_BATCH_SIZE)
+        self.endResetModel()
+
+    def _pull(self, count):
+        """Забирает из итератора до count строк, возвращает число прочитанных."""
+        pulled = 0
+        for row in self._source:
+            self._all.append(row)
+            pulled += 1
+            if pulled >= count:
+                break
+        else:
+            self._source = None # Итератор исчерпан
+        return pulled
+
+    def location_at(self, row):
+        """Возвращает (top_folder, sub_folder, Document) для строки таблицы."""
+        if 0 <= row < self._loaded:
+            return self._locate(self._rows[row])
+        return None, None, None
+
+    def column_title(self, section):
+        return self._columns[section].title if 0 <= section < len(self._columns) else None
+
+    def is_date_column(self, section):
+        return 0 <= section < len(self._columns) and self._columns[section].date is not None
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else self._loaded
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self._columns)
+
+    def data(self, index, role=Qt.ItemDataRole.DisplayRole):
+        if not index.isValid() or index.row() >= self._loaded:
+            return None
+        if role == Qt.ItemDataRole.DisplayRole:
+            return self._columns[index.column()].text(*self._locate(self._rows[index.row()]))
+        if role == Qt.ItemDataRole.ForegroundRole and self._color:
+            return self._color(*self._locate(self._rows[index.row()]))
+        return None
 
-        self.description = description
-        self.attachments = attachments or [] # Список путей к файлам в папке attachments
+    def headerData(self, section, orientation, role=Qt.ItemDataRole.DisplayRole):
+        if orientation != Qt.Orientation.Horizontal or section >= len(self._columns):
+            return None
+        title = self._columns[section].title
+        if role == Qt.ItemDataRole.DisplayRole:
+            return f"{title} [{self.filters[title]}]" if title in self.filters else title
+        if role == Qt.ItemDataRole.ToolTipRole:
+            return "Щелчок - сортировка, правая кнопка - фильтр"
+        return None
 
-    def is_document_expiring(self, days_threshold=30):
-        if not self.end_date:
+    def canFetchMore(self, parent=QModelIndex()):
+        if parent.isValid():
             return False
-        days_left = QDate.currentDate().daysTo(self.end_date)
-        return 0 <= days_left <= days_threshold # Истекающий = осталось от 0 до threshold дней
+        return self._loaded < len(self._rows) or self._source is not None
 
-    def to_dict(self):
-        return {
-            "number": self.number,
-            "name": self.name,
-            "counterparty": self.counterparty,
-            "start_date": self.start_date.toString("dd.MM.yyyy"),
-            "end_date": self.end_date.toString("dd.MM.yyyy") if self.end_date else "",
-            "description": self.description,
-            "attachments": ", ".join(self.attachments) # Сохраняем пути как строку
-        }
+    def fetchMore(self, parent=QModelIndex()):
+        if parent.isValid():
+            return
+        if self._source is None:
+            count = min(len(self._rows) - self._loaded, self.FETCH_BATCH_SIZE)
+            if count <= 0:
+                return
+            self.beginInsertRows(QModelIndex(), self._loaded, self._loaded + count - 1)
+            self._loaded += count
+            self.endInsertRows()
+            return
+        # Для итератора заранее число строк неизвестно: читаем порцию, затем сообщаем о вставке
+        start = len(self._rows)
+        pulled = self._pull(self.FETCH_BATCH_SIZE)
+        if pulled:
+            self.beginInsertRows(QModelIndex(), start, start + pulled - 1)
+            self._loaded = len(self._rows)
+            self.endInsertRows()
 
 
 class SearchDialog(QDialog):
@@ -75,6 +638,7 @@ class SearchDialog(QDialog):
         self.field_combo.addItem("Дата начала", "start_date")
         self.field_combo.addItem("Дата окончания", "end_date")
         self.field_combo.addItem("Описание", "description")
+        self.field_combo.addItem("Содержимое вложений", ATTACHMENT_TEXT_FIELD)
         layout.addWidget(self.field_combo)
 
         # Текст для поиска
@@ -121,8 +685,8 @@ class SearchDialog(QDialog):
     def get_search_params(self):
         field = self.field_combo.currentData()
         text = self.search_edit.text()
-        from_date = self.from_date_edit.date() if field in ["start_date", "end_date"] else None
-        to_date = self.to_date_edit.date() if field in ["start_date", "end_date"] else None
+        from_date = from_qdate(self.from_date_edit.date()) if field in ["start_date", "end_date"] else None
+        to_date = from_qdate(self.to_date_edit.date()) if field in ["start_date", "end_date"] else None
         return {
             "field": field,
             "text": text,
@@ -143,8 +707,8 @@ class DocumentViewDialog(QDialog):
         self.number_label = QLabel(f"Номер: {document.number}")
         self.name_label = QLabel(f"Наименование: {document.name}")
         self.counterparty_label = QLabel(f"Контрагент: {document.counterparty}")
-        self.start_date_label = QLabel(f"Дата начала: {document.start_date.toString('dd.MM.yyyy')}")
-        self.end_date_label = QLabel(f"Дата окончания: {document.end_date.toString('dd.MM.yyyy') if document.end_date else 'Не указана'}")
+        self.start_date_label = QLabel(f"Дата начала: {format_date(document.start_date)}")
+        self.end_date_label = QLabel(f"Дата окончания: {format_date(document.end_date, 'Не указана')}")
         layout.addWidget(self.number_label)
         layout.addWidget(self.name_label)
         layout.addWidget(self.counterparty_label)
@@ -161,7 +725,10 @@ class DocumentViewDialog(QDialog):
         # Вложения
         layout.addWidget(QLabel("Приложенные документы:"))
         self.attachments_list = QListWidget()
-        self.attachments_list.addItems(document.attachments)
+        for attachment in document.attachments:
+            item = QListWidgetItem(attachment.name)
+            item.setData(Qt.ItemDataRole.UserRole, attachment)
+            self.attachments_list.addItem(item)
         self.attachments_list.itemDoubleClicked.connect(self.open_attachment)
         layout.addWidget(self.attachments_list)
 
@@ -174,10 +741,10 @@ class DocumentViewDialog(QDialog):
 
     def open_attachment(self, item):
         # Получаем путь к файлу относительно папки attachments
-        file_name = item.text()
+        attachment = item.data(Qt.ItemDataRole.UserRole)
         # Предполагаем, что файл хранится в папке attachments рядом с exe
         attachments_dir = os.path.join(os.path.dirname(os.path.abspath(sys.argv[0])), "attachments")
-        file_path = os.path.join(attachments_dir, file_name)
+        file_path = attachment_path(attachments_dir, attachment.file_path)
 
         if os.path.exists(file_path):
             try:
@@ -192,14 +759,19 @@ class DocumentViewDialog(QDialog):
 
 
 class DocumentEditDialog(QDialog):
-    def __init__(self, document=None, parent=None):
+    def __init__(self, document=None, parent=None, attachment_store=None):
         super().__init__(parent)
         self.setWindowTitle("Редактирование документа" if document else "Добавление документа")
         self.resize(500, 400)
         self.document = document or Document()
-        # Определяем путь к папке attachments
-        self.attachments_dir = os.path.join(os.path.dirname(os.path.abspath(sys.argv[0])), "attachments")
-        os.makedirs(self.attachments_dir, exist_ok=True) # Создаем папку, если её нет
+        self.attachment_store = attachment_store # Хранилище, куда помещаются новые вложения
+        # Файлы копируются в фоне; пока копирование идет, элемент списка показывает процент
+        self.ingestor = AttachmentIngestor(attachment_store, self)
+        self.ingestor.progress.connect(self.on_ingest_progress)
+        self.ingestor.done.connect(self.on_ingest_done)
+        self.ingestor.failed.connect(self.on_ingest_failed)
+        self.ingestor.cancelled.connect(self.on_ingest_cancelled)
+        self._ingest_items = {} # ключ копирования -> QListWidgetItem
 
         layout = QVBoxLayout()
 
@@ -211,7 +783,7 @@ class DocumentEditDialog(QDialog):
         self.add_field(fields_layout, "Наименование:", self.name_edit)
         self.counterparty_edit = QLineEdit(self.document.counterparty)
         self.add_field(fields_layout, "Контрагент:", self.counterparty_edit)
-        self.start_date_edit = QDateEdit(self.document.start_date)
+        self.start_date_edit = QDateEdit(to_qdate(self.document.start_date))
         self.start_date_edit.setDisplayFormat("dd.MM.yyyy")
         self.start_date_edit.setCalendarPopup(True)
         self.add_field(fields_layout, "Дата начала:", self.start_date_edit)
@@ -220,7 +792,7 @@ class DocumentEditDialog(QDialog):
         self.end_date_edit.setDisplayFormat("dd.MM.yyyy")
         self.end_date_edit.setCalendarPopup(True)
         if self.document.end_date:
-            self.end_date_edit.setDate(self.document.end_date)
+            self.end_date_edit.setDate(to_qdate(self.document.end_date))
         else:
             self.end_date_edit.setSpecialValueText("Не указана")
             self.end_date_edit.setDate(self.end_date_edit.minimumDate()) # Используем минимальную дату как "пустую"
@@ -235,8 +807,9 @@ class DocumentEditDialog(QDialog):
         # Вложения
         layout.addWidget(QLabel("Приложенные документы:"))
         self.attachments_list = QListWidget()
-        # Отображаем только имена файлов, не полные пути
-        self.attachments_list.addItems([os.path.basename(f) for f in self.document.attachments])
+        # Отображаем только имена файлов, само вложение храним в данных элемента
+        for attachment in self.document.attachments:
+            self.add_attachment_item(attachment)
         layout.addWidget(self.attachments_list)
 
         # Кнопки для добавления/удаления вложений
@@ -247,6 +820,10 @@ class DocumentEditDialog(QDialog):
         self.remove_attachment_button = QPushButton("Удалить")
         self.remove_attachment_button.clicked.connect(self.remove_attachment)
         buttons_layout.addWidget(self.remove_attachment_button)
+        self.cancel_copy_button = QPushButton("Отменить копирование")
+        self.cancel_copy_button.clicked.connect(self.ingestor.cancel)
+        self.cancel_copy_button.hide()
+        buttons_layout.addWidget(self.cancel_copy_button)
         layout.addLayout(buttons_layout)
 
         # Кнопки OK/Отмена
@@ -267,24 +844,58 @@ class DocumentEditDialog(QDialog):
         field_layout.addWidget(widget)
         layout.addLayout(field_layout)
 
+    def add_attachment_item(self, attachment):
+        item = QListWidgetItem(attachment.name)
+        item.setData(Qt.ItemDataRole.UserRole, attachment)
+        self.attachments_list.addItem(item)
+
     def add_attachment(self):
         file_paths, _ = QFileDialog.getOpenFileNames(self, "Выберите файл(ы)")
         if file_paths:
             for file_path in file_paths:
                 if os.path.exists(file_path):
-                    # Генерируем уникальное имя файла
-                    original_name = os.path.basename(file_path)
-                    name, ext = os.path.splitext(original_name)
-                    unique_name = f"{name}_{shortuuid.uuid()}{ext}"
-
-                    # Копируем файл в папку attachments
-                    destination_path = os.path.join(self.attachments_dir, unique_name)
-                    try:
-                        shutil.copy2(file_path, destination_path)
-                        # Добавляем только имя файла в список (пути хранятся относительно attachments)
-                        self.attachments_list.addItem(unique_name)
-                    except Exception as e:
-                        QMessageBox.warning(self, "Ошибка", f"Не удалось скопировать файл {original_name}: {e}")
+                    # Помещаем файл в хранилище в фоне; одинаковое содержимое не копируется повторно
+                    item = QListWidgetItem(f"{os.path.basename(file_path)} - 0%")
+                    item.setData(Qt.ItemDataRole.UserRole + 1, os.path.basename(file_path))
+                    self.attachments_list.addItem(item)
+                    self._ingest_items[self.ingestor.submit(file_path)] = item
+            self.update_ingest_state()
+
+    def on_ingest_progress(self, key, percent):
+        item = self._ingest_items.get(key)
+        if item:
+            item.setText(f"{item.data(Qt.ItemDataRole.UserRole + 1)} - {percent}%")
+
+    def on_ingest_done(self, key, attachment):
+        item = self._ingest_items.pop(key, None)
+        if item:
+            item.setText(attachment.name)
+            item.setData(Qt.ItemDataRole.UserRole, attachment)
+        self.update_ingest_state()
+
+    def on_ingest_failed(self, key, error):
+        item = self._ingest_items.pop(key, None)
+        if item:
+            self.attachments_list.takeItem(self.attachments_list.row(item))
+            QMessageBox.warning(self, "Ошибка", f"Не удалось скопировать файл {item.data(Qt.ItemDataRole.UserRole + 1)}: {error}")
+        self.update_ingest_state()
+
+    def on_ingest_cancelled(self, key):
+        item = self._ingest_items.pop(key, None)
+        if item:
+            self.attachments_list.takeItem(self.attachments_list.row(item))
+        self.update_ingest_state()
+
+    def update_ingest_state(self):
+        """Пока файлы копируются, сохранить документ нельзя, зато можно отменить копирование"""
+        pending = self.ingestor.has_pending()
+        self.ok_button.setEnabled(not pending)
+        self.cancel_copy_button.setVisible(pending)
+
+    def done(self, result):
+        # При закрытии диалога прерываем копирование: недописанные файлы удаляются
+        self.ingestor.cancel()
+        super().done(result)
 
     def remove_attachment(self):
         current_item = self.attachments_list.currentItem()
@@ -296,23 +907,184 @@ class DocumentEditDialog(QDialog):
         self.document.number = self.number_edit.text()
         self.document.name = self.name_edit.text()
         self.document.counterparty = self.counterparty_edit.text()
-        self.document.start_date = self.start_date_edit.date()
+        self.document.start_date = from_qdate(self.start_date_edit.date())
         # Проверяем, была ли установлена дата окончания или она "пустая"
         if self.end_date_edit.date() == self.end_date_edit.minimumDate():
              self.document.end_date = None
         else:
-             self.document.end_date = self.end_date_edit.date()
+             self.document.end_date = from_qdate(self.end_date_edit.date())
 
         self.document.description = self.description_edit.toPlainText()
-        # Получаем список имен файлов из QListWidget
-        self.document.attachments = [self.attachments_list.item(i).text()
-                                    for i in range(self.attachments_list.count())]
+        # Получаем список вложений из QListWidget (файлы, копирование которых не завершено, пропускаем)
+        attachments = [self.attachments_list.item(i).data(Qt.ItemDataRole.UserRole)
+                       for i in range(self.attachments_list.count())]
+        self.document.attachments = tuple(attachment for attachment in attachments if attachment is not None)
         return self.document
 
+    def discarded_attachments(self):
+        """Помещенные в хранилище вложения, которые не попали в документ (диалог отменен или вложение удалено из списка)."""
+        kept = set(self.document.attachments) if self.result() == QDialog.DialogCode.Accepted else set()
+        # Берем список у ingestor, а не из сигналов done: копирование, завершившееся перед самой отменой,
+        # сообщает о себе уже после закрытия диалога (done() дожидается потоков в ingestor.cancel())
+        return [attachment for attachment in self.ingestor.stored_attachments() if attachment not in kept]
+
+
+class ExportWorker(QThread):
+    """
+    Экспорт в Excel в фоновом потоке. Строки идут из курсора SQLite прямо
+    в write-only книгу openpyxl, поэтому расход памяти не зависит от их числа.
+    """
+    progress = Signal(int, int)   # записано строк, всего строк
+    succeeded = Signal(str, int)  # путь к файлу, число строк
+    failed = Signal(str)
+    cancelled = Signal()
+
+    def __init__(self, file_path, sheets, total, parent=None):
+        super().__init__(parent)
+        self.file_path = file_path
+        self.sheets = sheets # [(имя листа, заголовки, итератор строк), ...]
+        self.total = total
+        self._cancelled = False
+
+    def cancel(self):
+        self._cancelled = True
+
+    def run(self):
+        try:
+            written = write_workbook(self.file_path, self.sheets,
+                                     lambda written: self.progress.emit(written, self.total),
+                                     lambda: self._cancelled)
+        except ExportCancelled:
+            self.cancelled.emit()
+        except Exception as e:
+            self.failed.emit(str(e))
+        else:
+            self.succeeded.emit(self.file_path, written)
+
+
+class SearchWorker(QThread):
+    """
+    Текстовый поиск в фоновом потоке: результаты передаются порциями по мере
+    чтения из курсора. cancel() прерывает запрос прямо в SQLite - так при
+    наборе текста устаревший запрос не мешает новому.
+    """
+    batch = Signal(int, object)             # номер запроса, [(top_folder, sub_folder, Document), ...]
+    finished_search = Signal(int, int, bool) # номер запроса, найдено строк, был ли прерван
+
+    def __init__(self, storage, generation, text, field, parent=None):
+        super().__init__(parent)
+        self.storage = storage
+        self.generation = generation
+        self.text = text
+        self.field = field
+        self._cancelled = False
+
+    def cancel(self):
+        self._cancelled = True
+
+    def run(self):
+        found = 0
+        rows = []
+        try:
+            with span("search_live", field=self.field) as timing:
+                for row in self.storage.iter_search_results(self.text, self.field, lambda: self._cancelled):
+                    rows.append(row)
+                    if len(rows) >= SEARCH_STREAM_BATCH:
+                        self.batch.emit(self.generation, rows)
+                        found += len(rows)
+                        rows = []
+                timing.set(rows=found + len(rows))
+        except QueryCancelled:
+            self.finished_search.emit(self.generation, found, True)
+            return
+        if rows:
+            self.batch.emit(self.generation, rows)
+            found += len(rows)
+        self.finished_search.emit(self.generation, found, False)
+
+
+class ImportWorker(QThread):
+    """
+    Массовый импорт CSV/XLSX в фоновом потоке (см. import_documents).
+    Отклоненные строки пишутся в отчет rejects_path; если их нет, отчет удаляется.
+    Если создать отчет там нельзя (например, папка исходного файла только для чтения),
+    он пишется в fallback_dir, и rejects_path указывает на фактический файл.
+    """
+    progress = Signal(int)          # обработано строк
+    succeeded = Signal(int, int)    # импортировано, отклонено
+    failed = Signal(str)
+
+    def __init__(self, storage, file_path, top_folder, sub_folder, rejects_path, fallback_dir, parent=None):
+        super().__init__(parent)
+        self.storage = storage
+        self.file_path = file_path
+        self.top_folder = top_folder
+        self.sub_folder = sub_folder
+        self.rejects_path = rejects_path
+        self.fallback_dir = fallback_dir
+
+    def open_rejects(self):
+        try:
+            return open(self.rejects_path, "w", newline="", encoding="utf-8-sig")
+        except OSError:
+            self.rejects_path = os.path.join(self.fallback_dir, os.path.basename(self.rejects_path))
+            os.makedirs(self.fallback_dir, exist_ok=True)
+            return open(self.rejects_path, "w", newline="", encoding="utf-8-sig")
+
+    def run(self):
+        try:
+            rejects = self.open_rejects()
+        except OSError as e:
+            self.failed.emit(f"Не удалось создать отчет об отклоненных строках: {e}")
+            return
+        try:
+            with rejects:
+                result = import_documents(self.storage, self.file_path, top_folder=self.top_folder,
+                                          sub_folder=self.sub_folder, rejects=rejects, progress=self.progress.emit)
+        except Exception as e:
+            if os.path.exists(self.rejects_path):
+                os.remove(self.rejects_path)
+            self.failed.emit(str(e))
+            return
+        if not result.rejected:
+            os.remove(self.rejects_path)
+        self.succeeded.emit(result.imported, result.rejected)
+
+
+class StartupTimer:
+    """
+    Замеры этапов запуска до появления окна. Включается ключом --startup-timing
+    или переменной окружения REGISTRAR_STARTUP_TIMING=1; отчет печатается в stderr.
+    Время импортов по модулям дает стандартный python -X importtime main.py.
+    """
+    def __init__(self, started, enabled):
+        self.started = started
+        self.enabled = enabled
+        self.marks = []
+
+    def mark(self, stage):
+        if self.enabled:
+            self.marks.append((stage, time.perf_counter()))
+
+    def report(self):
+        if not self.enabled:
+            return
+        budget_ms = int(os.environ.get("REGISTRAR_STARTUP_BUDGET_MS", STARTUP_BUDGET_MS))
+        lines = ["Время запуска, мс (от старта / этап):"]
+        previous = self.started
+        for stage, moment in self.marks:
+            lines.append(f"{(moment - self.started) * 1000:9.1f} {(moment - previous) * 1000:9.1f}  {stage}")
+            previous = moment
+        total_ms = (previous - self.started) * 1000
+        verdict = "в пределах бюджета" if total_ms <= budget_ms else "БЮДЖЕТ ПРЕВЫШЕН"
+        lines.append(f"Итого до окна: {total_ms:.0f} мс, бюджет {budget_ms} мс - {verdict}")
+        print("\n".join(lines), file=sys.stderr)
+
 
 class RegistrarApp(QMainWindow):
-    def __init__(self):
+    def __init__(self, startup_timer=None):
         super().__init__()
+        startup_timer = startup_timer or StartupTimer(STARTUP_STARTED, enabled=False)
         self.setWindowTitle("Регистратор документов")
         self.resize(1000, 700)
 
@@ -322,179 +1094,227 @@ class RegistrarApp(QMainWindow):
         os.makedirs(self.attachments_dir, exist_ok=True)
 
         # Инициализируем базу данных
-        self.initialize_database()
+        initialize_database(self.db_path)
+        self.storage = DocumentStorage(self.db_path)
+        self.document_cache = SubfolderCache(self.storage)
+        self.attachment_store = AttachmentStore(self.attachments_dir, self.storage)
+        startup_timer.mark("инициализация базы данных")
 
         # Инициализируем структуру папок (двухуровневая структура)
-        # { "Верхняя папка": { "Подпапка": [Document, ...], ... }, ... }
+        # { "Верхняя папка": ["Подпапка", ...], ... }
+        # Документы подпапок загружаются по требованию через self.document_cache
         self.folders = {}
+        # Результат поиска или проверки сроков в таблице: (название, [ID документов]) или None
+        self.result_set = None
+        # Поиск при наборе: номер актуального запроса и еще работающие потоки (в т.ч. прерванные)
+        self.search_generation = 0
+        self.search_workers = set()
 
         # Создаем UI (сначала создаем status_bar)
         self.create_menus()
         self.create_main_widgets()
         self.create_status_bar()
+        startup_timer.mark("создание интерфейса")
+
+        # Текст новых вложений извлекается в фоне для поиска по содержимому;
+        # запускается и из save_data_to_db, поэтому до загрузки данных и образца
+        self.text_index_worker = None
+        self.text_index_requested = False
+        # Повтор сохранения, не прошедшего из-за блокировки базы; предупреждаем один раз подряд
+        self.save_retry_timer = QTimer(self)
+        self.save_retry_timer.setSingleShot(True)
+        self.save_retry_timer.timeout.connect(self.save_data_to_db)
+        self.save_failed = False
 
         # Загружаем данные из базы данных
         self.load_data_from_db()
+        startup_timer.mark("загрузка дерева папок")
 
         # Добавляем образец, если база данных была пуста
         if not self.folders:
             self.add_sample_data()
 
-        # Вызываем очистку после загрузки данных
-        self.cleanup_orphaned_attachments()
+        # Файлы вложений без ссылок удаляются в фоне по очереди pending_deletes
+        self.cleanup_worker = None
+        self.cleanup_requested = False
+        self.scan_worker = None
+        self.shard_migration_worker = None
+        QTimer.singleShot(0, self.start_attachment_cleanup)
+        QTimer.singleShot(0, self.start_attachment_shard_migration)
+        QTimer.singleShot(0, self.start_text_indexing)
+
+        # С базой могут работать несколько экземпляров программы (например, база на общем диске):
+        # их изменения подхватываются по таймеру, перечитываются только затронутые подпапки
+        self.external_changes_timer = QTimer(self)
+        self.external_changes_timer.timeout.connect(self.check_external_changes)
+        self.external_changes_timer.start(EXTERNAL_CHANGES_POLL_MS)
 
         # Подключаем контекстное меню к дереву
         self.folder_tree.setContextMenuPolicy(Qt.ContextMenuPolicy.CustomContextMenu)
         self.folder_tree.customContextMenuRequested.connect(self.open_folder_context_menu)
 
-    def initialize_database(self):
-        """Создает таблицы в базе данных, если они не существуют."""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS documents (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                top_folder TEXT NOT NULL,
-                sub_folder TEXT NOT NULL,
-                number TEXT NOT NULL,
-                name TEXT NOT NULL,
-                counterparty TEXT,
-                start_date TEXT NOT NULL, -- Храним как строку dd.MM.yyyy
-                end_date TEXT,            -- Храним как строку dd.MM.yyyy или NULL
-                description TEXT
-            )
-        ''')
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS attachments (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                document_id INTEGER NOT NULL,
-                file_path TEXT NOT NULL, -- Храним путь относительно папки attachments
-                FOREIGN KEY (document_id) REFERENCES documents (id) ON DELETE CASCADE
-            )
-        ''')
-        conn.commit()
-        conn.close()
-
     def save_data_to_db(self):
-        """Сохраняет данные из памяти в базу данных."""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-
-        # Очистка существующих данных
-        cursor.execute('DELETE FROM attachments')
-        cursor.execute('DELETE FROM documents')
-
-        for top_folder_name, sub_folders in self.folders.items():
-            for sub_folder_name, documents in sub_folders.items():
-                for doc in documents:
-                    # Вставляем документ
-                    cursor.execute('''
-                        INSERT INTO documents (top_folder, sub_folder, number, name, counterparty, start_date, end_date, description)
-                        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-                    ''', (top_folder_name, sub_folder_name, doc.number, doc.name, doc.counterparty,
-                          doc.start_date.toString("dd.MM.yyyy"),
-                          doc.end_date.toString("dd.MM.yyyy") if doc.end_date else None,
-                          doc.description))
-                    doc.id = cursor.lastrowid # Получаем ID вставленного документа
-
-                    # Вставляем вложения
-                    for file_path in doc.attachments:
-                        cursor.execute('''
-                            INSERT INTO attachments (document_id, file_path)
-                            VALUES (?, ?)
-                        ''', (doc.id, file_path)) # file_path уже относительный путь
-
-        conn.commit()
-        conn.close()
-        self.status_bar.showMessage("Данные сохранены в базу данных.")
+        """Записывает в базу данных только новые, измененные и удаленные документы; возвращает успех записи."""
+        try:
+            written = self.storage.flush()
+        except WriteConflict as e:
+            QMessageBox.warning(self, "Конфликт изменений",
+                                f"{e}.\nИзменения этих документов не сохранены, показаны данные из базы.")
+            self.check_external_changes()
+            return False
+        except sqlite3.OperationalError as e:
+            # База занята другим экземпляром (обычно на сетевом диске): изменения остаются накопленными
+            self.status_bar.showMessage(f"База данных занята, изменения не сохранены: {e}")
+            self.save_retry_timer.start(SAVE_RETRY_MS)
+            if not self.save_failed:
+                self.save_failed = True
+                QMessageBox.warning(self, "База данных занята",
+                                    f"Не удалось сохранить изменения: {e}.\n"
+                                    "Изменения не потеряны: сохранение будет повторено автоматически.")
+            return False
+        self.save_failed = False
+        self.save_retry_timer.stop()
+        if written:
+            self.status_bar.showMessage(f"Сохранено изменений в базе данных: {written}")
+            self.start_text_indexing() # Новые вложения попали в очередь извлечения текста
+        return True
 
     def load_data_from_db(self):
-        """Загружает данные из базы данных в память."""
-        self.folders = {} # Очищаем текущие данные
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-
-        # Загружаем документы
-        cursor.execute('SELECT * FROM documents')
-        rows = cursor.fetchall()
-        doc_id_map = {} # Словарь для сопоставления DB ID с объектами Document
-        for row in rows:
-            doc_id, top_folder, sub_folder, number, name, counterparty, start_date_str, end_date_str, description = row
-            
-            # Убедимся, что структура папок существует
-            if top_folder not in self.folders:
-                self.folders[top_folder] = {}
-            if sub_folder not in self.folders[top_folder]:
-                self.folders[top_folder][sub_folder] = []
-
-            doc = Document(
-                number=number,
-                name=name,
-                counterparty=counterparty,
-                start_date=start_date_str, # Конструктор Document обработает строку
-                end_date=end_date_str,     # Конструктор Document обработает строку или None
-                description=description,
-                attachments=[], # Вложения загрузим отдельно
-                db_id=doc_id
-            )
-            
-            self.folders[top_folder][sub_folder].append(doc)
-            doc_id_map[doc_id] = doc # Сохраняем ссылку на объект
-
-        # Загружаем вложения
-        cursor.execute('SELECT document_id, file_path FROM attachments')
-        attachment_rows = cursor.fetchall()
-        for doc_id, file_path in attachment_rows:
-            if doc_id in doc_id_map:
-                doc_id_map[doc_id].attachments.append(file_path) # file_path уже относительный
-
-        conn.close()
+        """Загружает из базы данных иерархию папок; документы читаются лениво."""
+        self.document_cache.clear()
+        self.storage.poll_changes() # Точка отсчета для чужих изменений - до чтения дерева
+        self.folders = self.storage.load_folder_tree()
         self.update_folder_tree_model() # Обновляем модель дерева после загрузки
         # Проверяем, существует ли status_bar, чтобы избежать ошибки при инициализации
         if hasattr(self, 'status_bar') and self.status_bar:
             self.status_bar.showMessage("Данные загружены из базы данных.")
 
-    def cleanup_orphaned_attachments(self):
-        """Удаляет файлы из папки attachments, которые больше не связаны с документами."""
-        # Получаем список всех файлов, связанных с документами
-        connected_files = set()
-        for top_folders in self.folders.values():
-            for docs in top_folders.values():
-                for doc in docs:
-                    connected_files.update(doc.attachments)
-
-        # Получаем список всех файлов в папке attachments
-        if os.path.exists(self.attachments_dir):
-            all_files = set(os.listdir(self.attachments_dir))
-            # Находим файлы, которые не связаны
-            orphaned_files = all_files - connected_files
-
-            # Удаляем осиротевшие файлы
-            for file_name in orphaned_files:
-                file_path = os.path.join(self.attachments_dir, file_name)
-                try:
-                    os.remove(file_path)
-                    print(f"Удален осиротевший файл: {file_path}") # Можно заменить на логирование
-                except Exception as e:
-                    print(f"Ошибка при удалении файла {file_path}: {e}") # Можно заменить на логирование
-
-            if orphaned_files:
-                self.status_bar.showMessage(f"Удалено {len(orphaned_files)} осиротевших файлов.")
-
+    def start_attachment_cleanup(self):
+        """Запускает фоновое удаление файлов из очереди; если оно уже идет, повторяет его по завершении."""
+        if self.cleanup_worker is not None:
+            self.cleanup_requested = True
+            return
+        self.cleanup_requested = False
+        self.cleanup_worker = AttachmentCleanupWorker(self.storage, self.attachments_dir, self)
+        self.cleanup_worker.removed.connect(self.on_attachment_cleanup_done)
+        self.cleanup_worker.start()
+
+    def on_attachment_cleanup_done(self, removed):
+        self.cleanup_worker.wait()
+        self.cleanup_worker.deleteLater()
+        self.cleanup_worker = None
+        if removed:
+            self.status_bar.showMessage(f"Удалено файлов вложений без ссылок: {removed}")
+        if self.cleanup_requested:
+            self.start_attachment_cleanup()
+
+    def start_text_indexing(self):
+        """Запускает извлечение текста вложений из очереди; если оно уже идет, повторяет его по завершении."""
+        if not self.storage.text_index_enabled:
+            return
+        if self.text_index_worker is not None:
+            self.text_index_requested = True
+            return
+        self.text_index_requested = False
+        self.text_index_worker = TextIndexWorker(self.storage, self.attachments_dir, self)
+        self.text_index_worker.progress.connect(
+            lambda indexed: self.status_bar.showMessage(f"Индексация содержимого вложений: {indexed}"))
+        self.text_index_worker.indexed.connect(self.on_text_indexing_done)
+        self.text_index_worker.start()
+
+    def on_text_indexing_done(self, indexed):
+        self.text_index_worker.wait()
+        self.text_index_worker.deleteLater()
+        self.text_index_worker = None
+        if indexed:
+            self.status_bar.showMessage(f"Проиндексировано вложений: {indexed}")
+        if self.text_index_requested:
+            self.start_text_indexing()
+
+    def queue_discarded_attachments(self, dialog):
+        """Ставит в очередь на удаление файлы, скопированные диалогом, но не попавшие в документ."""
+        discarded = dialog.discarded_attachments()
+        if discarded:
+            try:
+                self.storage.queue_file_deletes(attachment.file_path for attachment in discarded)
+            except sqlite3.OperationalError:
+                return # База занята; файлы без ссылок найдет проверка хранилища вложений
+            self.start_attachment_cleanup()
+
+    def scan_attachments(self):
+        """Полная проверка папки вложений в фоне; прерванная проверка продолжается с места остановки."""
+        if self.scan_worker is not None:
+            self.status_bar.showMessage("Проверка хранилища вложений уже выполняется")
+            return
+        if not self.save_data_to_db(): # Ссылки проверяются по базе - несохраненных изменений быть не должно
+            return
+        self.scan_worker = AttachmentScanWorker(self.storage, self.attachments_dir, self)
+        self.scan_worker.progress.connect(
+            lambda checked, removed: self.status_bar.showMessage(
+                f"Проверка вложений: проверено {checked}, удалено {removed}"))
+        self.scan_worker.finished_scan.connect(self.on_attachment_scan_done)
+        self.scan_worker.start()
+
+    def on_attachment_scan_done(self, checked, removed, completed):
+        self.scan_worker.wait()
+        self.scan_worker.deleteLater()
+        self.scan_worker = None
+        state = "завершена" if completed else "прервана"
+        self.status_bar.showMessage(f"Проверка вложений {state}: проверено {checked}, удалено {removed}")
+
+    def start_attachment_shard_migration(self):
+        """Переносит файлы вложений из плоской папки в подкаталоги, если это еще не сделано."""
+        if self.storage.get_setting(ATTACHMENT_LAYOUT_KEY) == ATTACHMENT_LAYOUT_SHARDED:
+            return
+        self.shard_migration_worker = AttachmentShardMigrationWorker(self.storage, self.attachments_dir, self)
+        self.shard_migration_worker.finished_migration.connect(self.on_attachment_shard_migration_done)
+        self.shard_migration_worker.start()
+
+    def on_attachment_shard_migration_done(self, moved, completed):
+        self.shard_migration_worker.wait()
+        self.shard_migration_worker.deleteLater()
+        self.shard_migration_worker = None
+        if moved:
+            self.status_bar.showMessage(f"Файлы вложений перенесены в подкаталоги: {moved}")
+
+    def stop_attachment_workers(self):
+        """Останавливает фоновые работы с хранилищем; недоделанное продолжится при следующем запуске."""
+        for worker in (self.cleanup_worker, self.scan_worker, self.shard_migration_worker, self.text_index_worker):
+            if worker is not None:
+                worker.stop()
+                worker.wait()
 
     def closeEvent(self, event):
         """Переопределяем событие закрытия окна для сохранения данных."""
-        self.save_data_to_db()
-        self.cleanup_orphaned_attachments() # Очищаем при выходе
+        self.save_data_to_db() # Сбрасываем изменения, если они еще не записаны
+        if self.storage.has_changes():
+            answer = QMessageBox.question(self, "Изменения не сохранены",
+                                          "База данных занята, изменения не удалось сохранить. Закрыть без сохранения?")
+            if answer != QMessageBox.StandardButton.Yes:
+                event.ignore()
+                return
+        self.save_retry_timer.stop()
+        self.stop_search_workers()
+        self.stop_attachment_workers()
+        self.storage.close()
         event.accept()
 
     def create_menus(self):
         menubar = self.menuBar()
         # Меню Файл
         file_menu = menubar.addMenu("Файл")
+        import_action = QAction("Импорт из CSV/Excel", self)
+        import_action.triggered.connect(self.import_from_file)
+        file_menu.addAction(import_action)
         export_action = QAction("Экспорт в Excel", self)
         export_action.triggered.connect(self.export_to_excel)
         file_menu.addAction(export_action)
+        export_all_action = QAction("Экспорт всей базы в Excel", self)
+        export_all_action.triggered.connect(self.export_all_to_excel)
+        file_menu.addAction(export_all_action)
+        scan_attachments_action = QAction("Проверить хранилище вложений", self)
+        scan_attachments_action.triggered.connect(self.scan_attachments)
+        file_menu.addAction(scan_attachments_action)
         exit_action = QAction("Выход", self)
         exit_action.triggered.connect(self.close)
         file_menu.addAction(exit_action)
@@ -527,26 +1347,57 @@ class RegistrarApp(QMainWindow):
         # Левая панель - дерево папок
         self.folder_tree = QTreeView()
         self.folder_tree.setHeaderHidden(True)
-        self.folder_model = QStandardItemModel()
+        self.folder_model = FolderTreeModel()
         self.folder_tree.setModel(self.folder_model)
         self.folder_tree.expandAll()
         self.folder_tree.selectionModel().selectionChanged.connect(self.folder_selection_changed)
 
-        # Правая панель - таблица документов и кнопки
+        # Правая панель - строка поиска, таблица документов и кнопки
         right_widget = QWidget()
         right_layout = QVBoxLayout()
 
+        # Строка поиска: запрос уходит в фоновый поток после паузы в наборе
+        search_layout = QHBoxLayout()
+        self.search_field_combo = QComboBox()
+        self.search_field_combo.addItem("Все поля", "all")
+        self.search_field_combo.addItem("Номер документа", "number")
+        self.search_field_combo.addItem("Наименование", "name")
+        self.search_field_combo.addItem("Контрагент", "counterparty")
+        self.search_field_combo.addItem("Описание", "description")
+        self.search_field_combo.addItem("Содержимое вложений", ATTACHMENT_TEXT_FIELD)
+        self.search_field_combo.currentIndexChanged.connect(self.start_live_search)
+        self.search_edit = QLineEdit()
+        self.search_edit.setPlaceholderText("Поиск по номеру, наименованию, контрагенту, описанию и содержимому вложений")
+        self.search_edit.setClearButtonEnabled(True)
+        self.search_timer = QTimer(self)
+        self.search_timer.setSingleShot(True)
+        self.search_timer.setInterval(SEARCH_DEBOUNCE_MS)
+        self.search_timer.timeout.connect(self.start_live_search)
+        self.search_edit.textChanged.connect(self.search_timer.start)
+        self.search_edit.returnPressed.connect(self.start_live_search)
+        search_layout.addWidget(self.search_edit)
+        search_layout.addWidget(self.search_field_combo)
+        right_layout.addLayout(search_layout)
+
         # Таблица документов
         self.document_table = QTableView()
         self.document_table.setSelectionBehavior(QAbstractItemView.SelectionBehavior.SelectRows)
         self.document_table.setSelectionMode(QAbstractItemView.SelectionMode.SingleSelection)
         self.document_table.doubleClicked.connect(self.view_document)
-        self.document_model = QStandardItemModel()
-        self.document_model.setHorizontalHeaderLabels([
-            "Номер", "Наименование", "Контрагент", "Дата начала", "Дата окончания"
-        ])
+        self.document_model = DocumentTableModel(self)
+        self.document_model.set_rows(FOLDER_COLUMNS, [])
         self.document_table.setModel(self.document_model)
-        self.document_table.horizontalHeader().setStretchLastSection(True)
+        # Сортировку выполняет сама модель (по значениям, с сохранением при смене папки),
+        # поэтому щелчки по заголовку обрабатываются здесь, а не через setSortingEnabled
+        header = self.document_table.horizontalHeader()
+        header.setStretchLastSection(True)
+        header.setSectionsClickable(True)
+        header.setSortIndicatorShown(True)
+        header.sectionClicked.connect(self.sort_document_table)
+        header.setContextMenuPolicy(Qt.ContextMenuPolicy.CustomContextMenu)
+        header.customContextMenuRequested.connect(self.show_table_header_menu)
+        self.document_model.modelReset.connect(self.update_sort_indicator)
+        self.update_sort_indicator()
         right_layout.addWidget(self.document_table)
 
         # Кнопки
@@ -571,20 +1422,63 @@ class RegistrarApp(QMainWindow):
         self.setCentralWidget(main_splitter)
 
     def update_folder_tree_model(self):
-        """Обновляет модель дерева папок на основе self.folders"""
-        self.folder_model.clear()
-        for top_folder_name, sub_folders in self.folders.items():
-            top_item = QStandardItem(top_folder_name)
-            # top_item.setData("top", Qt.UserRole) # Можно использовать для идентификации типа
-            self.folder_model.appendRow(top_item)
-            
-            for sub_folder_name in sub_folders.keys():
-                sub_item = QStandardItem(sub_folder_name)
-                # sub_item.setData("sub", Qt.UserRole)
-                top_item.appendRow(sub_item)
-                
+        """Полностью перестраивает модель дерева папок по self.folders (при загрузке)"""
+        self.folder_model.reset(self.folders)
         self.folder_tree.expandAll()
 
+    def merge_folder_tree(self, folders):
+        """Добавляет в self.folders и в дерево папки из folders, которых еще нет; остальное дерево не трогается"""
+        for top_folder_name, sub_folders in folders.items():
+            if top_folder_name not in self.folders:
+                self.folders[top_folder_name] = []
+                self.folder_tree.expand(self.folder_model.add_top_folder(top_folder_name).index())
+            known = set(self.folders[top_folder_name])
+            for sub_folder_name in sub_folders:
+                if sub_folder_name not in known:
+                    self.folders[top_folder_name].append(sub_folder_name)
+                    self.folder_model.add_sub_folder(top_folder_name, sub_folder_name)
+
+    def sync_folder_tree(self, folders):
+        """Приводит self.folders и дерево к folders: убирает исчезнувшие папки и добавляет новые, остальное не трогается"""
+        for top_folder_name in list(self.folders):
+            if top_folder_name not in folders:
+                del self.folders[top_folder_name]
+                self.document_cache.discard(top_folder_name)
+                self.folder_model.remove_top_folder(top_folder_name)
+                continue
+            remaining = set(folders[top_folder_name])
+            for sub_folder_name in [name for name in self.folders[top_folder_name] if name not in remaining]:
+                self.folders[top_folder_name].remove(sub_folder_name)
+                self.document_cache.discard(top_folder_name, sub_folder_name)
+                self.folder_model.remove_sub_folder(top_folder_name, sub_folder_name)
+        self.merge_folder_tree(folders)
+
+    def check_external_changes(self):
+        """Подхватывает изменения других экземпляров программы: дерево папок и затронутые подпапки."""
+        if QApplication.activeModalWidget() is not None:
+            return # Открыт диалог, который может держать документ текущей папки - проверим после него
+        try:
+            changes = self.storage.poll_changes(SQLITE_POLL_BUSY_TIMEOUT)
+        except sqlite3.OperationalError:
+            return # Другой экземпляр записывает изменения - заберем их при следующей проверке
+        if changes is None:
+            return
+        if changes.tree:
+            self.sync_folder_tree(self.storage.load_folder_tree())
+        shown = self.document_model.folder
+        if changes.folders is None:
+            # Журнал изменений успел обрезаться - неизвестно, что менялось, перечитываем все
+            self.document_cache.clear()
+            if shown is not None:
+                self.update_document_table(self.folder_tree.currentIndex())
+            self.status_bar.showMessage("Загружены изменения других пользователей")
+            return
+        for top_folder_name, sub_folder_name in changes.folders:
+            self.document_cache.discard(top_folder_name, sub_folder_name)
+        if shown is not None and (shown in changes.folders or self.folder_model.sub_item(*shown) is None):
+            self.update_document_table(self.folder_tree.currentIndex())
+        self.status_bar.showMessage(f"Загружены изменения других пользователей: папок {len(changes.folders)}")
+
     def create_status_bar(self):
         self.status_bar = QStatusBar()
         self.setStatusBar(self.status_bar)
@@ -599,8 +1493,10 @@ class RegistrarApp(QMainWindow):
         """Обновляет таблицу документов для выбранной подпапки"""
         if mode == "expiring":
             return  # В этом случае используем show_expiring_contracts
+        self.cancel_live_search(clear_text=True)
 
         documents = []
+        folder = None
         status_msg = "Выберите вложенную папку для просмотра документов."
 
         parent = index.parent()
@@ -608,26 +1504,88 @@ class RegistrarApp(QMainWindow):
             # Выбрана вложенная папка
             top_folder_name = parent.data()
             sub_folder_name = index.data()
-            documents = self.folders.get(top_folder_name, {}).get(sub_folder_name, [])
-            status_msg = f"Папка: {top_folder_name} -> {sub_folder_name}. Документов: {len(documents)}"
+            documents = self.cached_documents(top_folder_name, sub_folder_name)
+            if documents is None:
+                documents = []
+                status_msg = "База данных занята другим пользователем, папка не загружена. Выберите ее снова позже."
+            else:
+                folder = (top_folder_name, sub_folder_name)
+                status_msg = f"Папка: {top_folder_name} -> {sub_folder_name}. Документов: {len(documents)}"
         # else:
             # Выбрана верхняя папка - таблица остается пустой
 
-        self.document_model.clear()
-        headers = ["Номер", "Наименование", "Контрагент", "Дата начала", "Дата окончания"]
-        self.document_model.setHorizontalHeaderLabels(headers)
-        for doc in documents:
-            end_date_str = doc.end_date.toString("dd.MM.yyyy") if doc.end_date else "Бессрочный"
-            row = [
-                QStandardItem(doc.number),
-                QStandardItem(doc.name),
-                QStandardItem(doc.counterparty),
-                QStandardItem(doc.start_date.toString("dd.MM.yyyy")),
-                QStandardItem(end_date_str)
-            ]
-            self.document_model.appendRow(row)
+        # Модель не копирует документы: строки берутся прямо из списка подпапки
+        self.document_model.set_rows(FOLDER_COLUMNS, documents, folder=folder)
+        self.result_set = None
+        if folder is not None:
+            status_msg += self.filter_note()
         self.status_bar.showMessage(status_msg)
 
+    def sort_document_table(self, section):
+        """Щелчок по заголовку таблицы: по возрастанию -> по убыванию -> исходный порядок."""
+        title = self.document_model.column_title(section)
+        if title is None:
+            return
+        current = self.document_model.sort_order
+        if current is None or current[0] != title:
+            self.document_model.sort(section, Qt.SortOrder.AscendingOrder)
+        elif current[1] == Qt.SortOrder.AscendingOrder:
+            self.document_model.sort(section, Qt.SortOrder.DescendingOrder)
+        else:
+            self.document_model.sort(-1)
+
+    def update_sort_indicator(self):
+        """Индикатор сортировки в заголовке: тот же столбец может стоять в другом наборе на другом месте."""
+        self.document_table.horizontalHeader().setSortIndicator(*self.document_model.sort_section())
+
+    def show_table_header_menu(self, position):
+        """Контекстное меню заголовка таблицы: фильтр столбца и сброс фильтров и сортировки."""
+        header = self.document_table.horizontalHeader()
+        section = header.logicalIndexAt(position)
+        title = self.document_model.column_title(section)
+        model = self.document_model
+        menu = QMenu(self)
+        if title is not None:
+            menu.addAction(f"Фильтр «{title}»...", lambda: self.edit_column_filter(section))
+            clear_action = menu.addAction(f"Снять фильтр «{title}»", lambda: self.set_column_filter(section, ""))
+            clear_action.setEnabled(title in model.filters)
+        clear_all_action = menu.addAction("Снять все фильтры", self.clear_column_filters)
+        clear_all_action.setEnabled(bool(model.filters))
+        menu.addSeparator()
+        unsort_action = menu.addAction("Исходный порядок строк", lambda: model.sort(-1))
+        unsort_action.setEnabled(model.sort_order is not None)
+        menu.exec(header.mapToGlobal(position))
+
+    def edit_column_filter(self, section):
+        title = self.document_model.column_title(section)
+        prompt = "Показывать строки, содержащие текст:"
+        if self.document_model.is_date_column(section):
+            prompt = "Текст или диапазон дат (дд.мм.гггг-дд.мм.гггг, границу можно не указывать):"
+        text, ok = QInputDialog.getText(self, f"Фильтр «{title}»", prompt,
+                                        text=self.document_model.filters.get(title, ""))
+        if ok:
+            self.set_column_filter(section, text)
+
+    def set_column_filter(self, section, text):
+        self.document_model.set_filter(section, text)
+        self.show_filter_status()
+
+    def clear_column_filters(self):
+        self.document_model.clear_filters()
+        self.show_filter_status()
+
+    def show_filter_status(self):
+        if self.document_model.is_filtered():
+            self.status_bar.showMessage(f"Показано по фильтру: {self.document_model.visible_count()}")
+        else:
+            self.status_bar.showMessage("Фильтры сняты")
+
+    def filter_note(self):
+        """Добавка к сообщению строки состояния, если часть строк скрыта фильтрами столбцов."""
+        if not self.document_model.is_filtered():
+            return ""
+        return f". Показано по фильтру: {self.document_model.visible_count()}"
+
     def get_current_subfolder_path(self):
         """Возвращает кортеж (top_folder_name, sub_folder_name) или (None, None)"""
         current_index = self.folder_tree.currentIndex()
@@ -639,17 +1597,43 @@ class RegistrarApp(QMainWindow):
                 return top_folder_name, sub_folder_name
         return None, None
 
-    def get_selected_document(self):
+    def get_selected_location(self):
+        """Возвращает (top_folder_name, sub_folder_name, Document) для выделенной строки или (None, None, None)"""
         selected = self.document_table.selectionModel().selectedRows()
         if not selected:
+            return None, None, None
+        top_folder_name, sub_folder_name, document = self.document_model.location_at(selected[0].row())
+        if document is None or self.document_model.folder is not None:
+            return top_folder_name, sub_folder_name, document
+        # Результаты поиска читаются из базы отдельно: берем экземпляр из кэша подпапки
+        for doc in self.cached_documents(top_folder_name, sub_folder_name, warn=True) or ():
+            if doc.id == document.id:
+                return top_folder_name, sub_folder_name, doc
+        return None, None, None
+
+    def cached_documents(self, top_folder_name, sub_folder_name, warn=False):
+        """
+        Документы подпапки из кэша (при промахе - из базы) или None, если база занята другим
+        экземпляром дольше SQLITE_BUSY_TIMEOUT; warn - сообщить об этом окном, а не только в строке состояния.
+        """
+        try:
+            return self.document_cache.get(top_folder_name, sub_folder_name)
+        except sqlite3.OperationalError as e:
+            self.status_bar.showMessage(f"База данных занята, папка не загружена: {e}")
+            if warn:
+                QMessageBox.warning(self, "База данных занята",
+                                    f"Не удалось прочитать папку {top_folder_name} -> {sub_folder_name}: {e}.\n"
+                                    "Повторите действие позже.")
             return None
-        row = selected[0].row()
-        top_folder_name, sub_folder_name = self.get_current_subfolder_path()
-        if top_folder_name and sub_folder_name:
-            documents = self.folders.get(top_folder_name, {}).get(sub_folder_name, [])
-            if 0 <= row < len(documents):
-                return documents[row]
-        return None
+
+    def warn_folder_busy(self, e):
+        """Сообщает, что операция с папкой не выполнена из-за занятой базы."""
+        self.status_bar.showMessage(f"База данных занята, папка не изменена: {e}")
+        QMessageBox.warning(self, "База данных занята",
+                            f"Не удалось изменить папку: {e}.\nПовторите действие позже.")
+
+    def get_selected_document(self):
+        return self.get_selected_location()[2]
 
     def view_document(self, index):
         document = self.get_selected_document()
@@ -662,81 +1646,153 @@ class RegistrarApp(QMainWindow):
         if not top_folder_name or not sub_folder_name:
             QMessageBox.warning(self, "Ошибка", "Выберите вложенную папку для добавления документа")
             return
-        dialog = DocumentEditDialog(None, self)
+        dialog = DocumentEditDialog(None, self, self.attachment_store)
         if dialog.exec() == QDialog.DialogCode.Accepted:
             new_doc = dialog.get_document()
-            self.folders[top_folder_name][sub_folder_name].append(new_doc)
+            documents = self.cached_documents(top_folder_name, sub_folder_name, warn=True)
+            if documents is None:
+                dialog.setResult(QDialog.DialogCode.Rejected) # Документ не добавлен - его вложения не нужны
+                self.queue_discarded_attachments(dialog)
+                return
+            documents.append(new_doc)
+            self.storage.add(new_doc, top_folder_name, sub_folder_name)
+            self.save_data_to_db()
             self.update_document_table(self.folder_tree.currentIndex())
             self.status_bar.showMessage(f"Документ добавлен: {new_doc.number}")
+        self.queue_discarded_attachments(dialog)
 
     def edit_document(self):
-        document = self.get_selected_document()
+        top_folder_name, sub_folder_name, document = self.get_selected_location()
         if not document:
             QMessageBox.warning(self, "Ошибка", "Выберите документ для редактирования")
             return
-        top_folder_name, sub_folder_name = self.get_current_subfolder_path()
-        if not top_folder_name or not sub_folder_name:
-            return
-        dialog = DocumentEditDialog(document, self)
+        dialog = DocumentEditDialog(document, self, self.attachment_store)
         if dialog.exec() == QDialog.DialogCode.Accepted:
-            updated_doc = dialog.get_document()
-            # Найдем и заменим документ в папке
-            documents_list = self.folders[top_folder_name][sub_folder_name]
-            for i, doc in enumerate(documents_list):
-                if doc.id == updated_doc.id: # Используем ID из БД
-                    documents_list[i] = updated_doc
-                    break
+            updated_doc = dialog.get_document() # Диалог изменяет тот же объект, что лежит в кэше папки
+            self.storage.update(updated_doc)
+            self.save_data_to_db()
             self.update_document_table(self.folder_tree.currentIndex())
             self.status_bar.showMessage(f"Документ обновлен: {updated_doc.number}")
+            self.start_attachment_cleanup() # Убранные из документа вложения попали в очередь на удаление
+        self.queue_discarded_attachments(dialog)
 
     def delete_document(self):
-        document = self.get_selected_document()
+        top_folder_name, sub_folder_name, document = self.get_selected_location()
         if not document:
             QMessageBox.warning(self, "Ошибка", "Выберите документ для удаления")
             return
-        top_folder_name, sub_folder_name = self.get_current_subfolder_path()
-        if not top_folder_name or not sub_folder_name:
-            return
         reply = QMessageBox.question(
             self, "Подтверждение",
             f"Удалить документ {document.number}?",
             QMessageBox.StandardButton.Yes | QMessageBox.StandardButton.No
         )
         if reply == QMessageBox.StandardButton.Yes:
-            self.folders[top_folder_name][sub_folder_name].remove(document)
-            # Удаляем связанные файлы из папки attachments
-            for file_name in document.attachments:
-                file_path = os.path.join(self.attachments_dir, file_name)
-                if os.path.exists(file_path):
-                    try:
-                        os.remove(file_path)
-                    except Exception as e:
-                        print(f"Ошибка при удалении файла {file_path}: {e}") # Можно заменить на логирование
-
+            documents = self.cached_documents(top_folder_name, sub_folder_name, warn=True)
+            if documents is None:
+                return
+            documents.remove(document)
+            self.storage.remove(document)
+            self.save_data_to_db()
+            # Файлы вложений без ссылок удалятся в фоне
+            self.start_attachment_cleanup()
             self.update_document_table(self.folder_tree.currentIndex())
             self.status_bar.showMessage(f"Документ удален: {document.number}")
 
     def export_to_excel(self):
-        top_folder_name, sub_folder_name = self.get_current_subfolder_path()
-        if not top_folder_name or not sub_folder_name:
-            QMessageBox.warning(self, "Ошибка", "Выберите вложенную папку для экспорта")
-            return
-            
-        documents = self.folders.get(top_folder_name, {}).get(sub_folder_name, [])
-        if not documents:
+        """Экспорт текущей подпапки или текущего результата поиска / проверки сроков"""
+        today = QDate.currentDate().toString('yyyyMMdd')
+        if self.result_set is not None:
+            title, doc_ids = self.result_set
+            if not doc_ids:
+                QMessageBox.warning(self, "Ошибка", "Нет документов для экспорта")
+                return
+            default_name = f"{title}_{today}.xlsx"
+            sheets = [(excel_sheet_title(title, set()), FOLDER_EXPORT_COLUMNS,
+                       self.storage.iter_export_rows_by_ids(doc_ids))]
+            total = len(doc_ids)
+        else:
+            top_folder_name, sub_folder_name = self.get_current_subfolder_path()
+            if not top_folder_name or not sub_folder_name:
+                QMessageBox.warning(self, "Ошибка", "Выберите вложенную папку для экспорта")
+                return
+            self.save_data_to_db()
+            total = self.storage.count_documents(top_folder_name, sub_folder_name)
+            if not total:
+                QMessageBox.warning(self, "Ошибка", "Нет документов для экспорта")
+                return
+            default_name = f"{top_folder_name}_{sub_folder_name}_{today}.xlsx"
+            sheets = subfolder_sheets(self.storage, top_folder_name, sub_folder_name)
+
+        file_path, _ = QFileDialog.getSaveFileName(self, "Экспорт в Excel", default_name, "Excel Files (*.xlsx)")
+        if file_path:
+            self.start_export(file_path, sheets, total)
+
+    def export_all_to_excel(self):
+        """Экспорт всей базы: отдельный лист на каждую подпапку"""
+        self.save_data_to_db()
+        total = self.storage.count_documents()
+        if not total:
             QMessageBox.warning(self, "Ошибка", "Нет документов для экспорта")
             return
-            
         file_path, _ = QFileDialog.getSaveFileName(
-            self, "Экспорт в Excel",
-            f"{top_folder_name}_{sub_folder_name}_{QDate.currentDate().toString('yyyyMMdd')}.xlsx",
+            self, "Экспорт всей базы в Excel",
+            f"Реестр_{QDate.currentDate().toString('yyyyMMdd')}.xlsx",
             "Excel Files (*.xlsx)"
         )
-        if file_path:
-            data = [doc.to_dict() for doc in documents]
-            df = pd.DataFrame(data)
-            df.to_excel(file_path, index=False)
-            self.status_bar.showMessage(f"Документы экспортированы в {file_path}")
+        if not file_path:
+            return
+        self.start_export(file_path, database_sheets(self.storage), total)
+
+    def start_export(self, file_path, sheets, total):
+        """Запускает ExportWorker с окном прогресса и кнопкой отмены"""
+        progress_dialog = QProgressDialog("Экспорт в Excel...", "Отмена", 0, total, self)
+        # Окно модально: пока курсор экспорта открыт, изменения документов ждали бы блокировки БД
+        progress_dialog.setWindowModality(Qt.WindowModality.WindowModal)
+        progress_dialog.setMinimumDuration(500)
+        worker = ExportWorker(file_path, sheets, total, self)
+        progress_dialog.canceled.connect(worker.cancel)
+        worker.progress.connect(lambda written, _total: progress_dialog.setValue(written))
+        worker.succeeded.connect(
+            lambda path, written: self.status_bar.showMessage(f"Экспортировано документов: {written} в {path}"))
+        worker.failed.connect(lambda error: QMessageBox.warning(self, "Ошибка", f"Не удалось выполнить экспорт: {error}"))
+        worker.cancelled.connect(lambda: self.status_bar.showMessage("Экспорт отменен"))
+        worker.finished.connect(progress_dialog.reset)
+        worker.finished.connect(worker.deleteLater)
+        self.export_worker = worker # Держим ссылку, пока поток работает
+        worker.start()
+
+    def import_from_file(self):
+        """Массовый импорт документов из CSV/XLSX; строки без папки попадают в выбранную подпапку"""
+        file_path, _ = QFileDialog.getOpenFileName(self, "Импорт документов", "", "Таблицы (*.csv *.xlsx)")
+        if not file_path:
+            return
+        self.save_data_to_db()
+        top_folder_name, sub_folder_name = self.get_current_subfolder_path()
+        rejects_path = os.path.splitext(file_path)[0] + "_отклонено.csv"
+        # Если рядом с исходным файлом писать нельзя, отчет попадет в папку журнала
+        log_dir = os.environ.get("REGISTRAR_LOG_DIR", os.path.dirname(self.db_path))
+        progress_dialog = QProgressDialog("Импорт документов...", None, 0, 0, self)
+        progress_dialog.setWindowModality(Qt.WindowModality.WindowModal)
+        progress_dialog.setMinimumDuration(500)
+        worker = ImportWorker(self.storage, file_path, top_folder_name, sub_folder_name, rejects_path, log_dir, self)
+        worker.progress.connect(lambda processed: progress_dialog.setLabelText(f"Импорт документов... {processed}"))
+        worker.succeeded.connect(
+            lambda imported, rejected: self.on_import_done(imported, rejected, worker.rejects_path))
+        worker.failed.connect(lambda error: QMessageBox.warning(self, "Ошибка", f"Не удалось выполнить импорт: {error}"))
+        worker.finished.connect(progress_dialog.reset)
+        worker.finished.connect(worker.deleteLater)
+        self.import_worker = worker # Держим ссылку, пока поток работает
+        worker.start()
+
+    def on_import_done(self, imported, rejected, rejects_path):
+        # Документы вставлены в обход кэша подпапок: сбрасываем кэш и добавляем в дерево новые папки
+        self.document_cache.clear()
+        self.merge_folder_tree(self.storage.load_folder_tree())
+        self.update_document_table(self.folder_tree.currentIndex())
+        self.status_bar.showMessage(f"Импортировано документов: {imported}, отклонено строк: {rejected}")
+        if rejected:
+            QMessageBox.information(self, "Импорт",
+                                    f"Отклонено строк: {rejected}. Причины записаны в файл:\n{rejects_path}")
 
     def show_expiring_contracts_dialog(self):
         """Диалог для выбора порогового значения и показ результатов"""
@@ -753,64 +1809,30 @@ class RegistrarApp(QMainWindow):
 
     def show_expiring_contracts(self, days_threshold=30):
         """Показать истекающие договоры в правой панели"""
-        expiring_docs = []
-        # Собираем все истекающие договоры из всех подпапок "Договоры"
-        contract_subfolders = self.folders.get("Договоры", {})
-        for documents in contract_subfolders.values():
-             for doc in documents:
-                 if doc.is_document_expiring(days_threshold):
-                     expiring_docs.append(doc)
-
-        # Очищаем текущую таблицу
-        self.document_model.clear()
-        self.document_model.setHorizontalHeaderLabels([
-            "Номер", "Наименование", "Контрагент", "Дата окончания", "Дней осталось"
-        ])
-
-        # Заполняем таблицу
-        for doc in expiring_docs:
-            days_left = QDate.currentDate().daysTo(doc.end_date)
-            row = [
-                QStandardItem(doc.number),
-                QStandardItem(doc.name),
-                QStandardItem(doc.counterparty),
-                QStandardItem(doc.end_date.toString("dd.MM.yyyy")),
-                QStandardItem(str(days_left))
-            ]
-            self.document_model.appendRow(row)
+        # Собираем истекающие документы из всех папок запросом по индексу end_date
+        expiring_docs = self.storage.find_expiring(days_threshold)
+        self.cancel_live_search(clear_text=True)
+
+        today = date.today()
+        columns = LOCATION_COLUMNS + FOLDER_COLUMNS[:3] + [
+            END_DATE_COLUMN,
+            TableColumn("Дней осталось", lambda top, sub, doc: str(doc.days_left(today)),
+                        key=lambda top, sub, doc: doc.days_left(today)),
+        ]
+        self.result_set = ("Истекающие", [doc.id for _, _, doc in expiring_docs])
+        # Подсветка строк с малым сроком
+        self.document_model.set_rows(
+            columns, expiring_docs,
+            color=lambda top, sub, doc: expiring_color(doc.days_left(today))
+        )
 
         # Обновляем статус бар
         count = len(expiring_docs)
         self.status_bar.showMessage(
-            f"Найдено истекающих договоров: {count}. "
-            f"Порог: {days_threshold} дней"
+            f"Найдено истекающих документов: {count}. "
+            f"Порог: {days_threshold} дней{self.filter_note()}"
         )
 
-        # Подсветка строк с малым сроком
-        self.highlight_expiring_contracts()
-
-    def highlight_expiring_contracts(self):
-        """Подсветка строк в зависимости от оставшегося срока"""
-        for row in range(self.document_model.rowCount()):
-            days_item = self.document_model.item(row, 4)  # Столбец "Дней осталось"
-            if days_item:
-                try:
-                    days_left = int(days_item.text())
-                except ValueError:
-                    continue # Пропускаем, если не число
-
-                color = QColor(0, 0, 0)  # По умолчанию черный
-                if days_left <= 7:
-                    color = QColor(255, 0, 0)  # Красный для срочных (0-7 дней)
-                elif days_left <= 14:
-                    color = QColor(255, 165, 0)  # Оранжевый (8-14 дней)
-
-                # Подсвечиваем всю строку
-                for col in range(self.document_model.columnCount()):
-                    item = self.document_model.item(row, col)
-                    if item:
-                        item.setForeground(color)
-
     def show_search_dialog(self):
         dialog = SearchDialog(self)
         if dialog.exec() == QDialog.DialogCode.Accepted:
@@ -818,55 +1840,69 @@ class RegistrarApp(QMainWindow):
             self.perform_search(search_params)
 
     def perform_search(self, params):
-        results = []
-        for top_folder_name, sub_folders in self.folders.items():
-            for sub_folder_name, documents in sub_folders.items():
-                for doc in documents:
-                    match = False
-                    if params["field"] == "all":
-                        # Search in all text fields
-                        search_text = params["text"].lower()
-                        if (search_text in doc.number.lower() or
-                            search_text in doc.name.lower() or
-                            search_text in doc.counterparty.lower() or
-                            search_text in doc.description.lower()):
-                            match = True
-                    elif params["field"] in ["start_date", "end_date"]:
-                        # Date range search
-                        date = doc.start_date if params["field"] == "start_date" else doc.end_date
-                        if date:
-                            from_date = params["from_date"]
-                            to_date = params["to_date"]
-                            # print(f"Searching date: {date}, From: {from_date}, To: {to_date}") # Debug
-                            if from_date <= date <= to_date:
-                                match = True
-                    else:
-                        # Field-specific text search
-                        field_value = getattr(doc, params["field"], "")
-                        if isinstance(field_value, str) and params["text"].lower() in field_value.lower():
-                             match = True
-
-                    if match:
-                        # Добавляем путь к папке в результаты
-                        results.append((top_folder_name, sub_folder_name, doc))
+        if params["field"] in ["start_date", "end_date"]:
+            # Поиск по диапазону дат - один запрос по индексу
+            results = self.storage.find_by_date_range(params["field"], params["from_date"], params["to_date"])
+        else:
+            # Текстовый поиск по индексу FTS5 (все поля или одно поле)
+            results = self.storage.search_documents(params["text"], params["field"])
 
         # Показываем результаты в правой панели
-        self.document_model.clear()
-        self.document_model.setHorizontalHeaderLabels([
-            "Верхняя папка", "Подпапка", "Номер", "Наименование", "Контрагент", "Дата начала", "Дата окончания"
-        ])
-        for top_folder_name, sub_folder_name, doc in results:
-            row = [
-                QStandardItem(top_folder_name),
-                QStandardItem(sub_folder_name),
-                QStandardItem(doc.number),
-                QStandardItem(doc.name),
-                QStandardItem(doc.counterparty),
-                QStandardItem(doc.start_date.toString("dd.MM.yyyy")),
-                QStandardItem(doc.end_date.toString("dd.MM.yyyy") if doc.end_date else "")
-            ]
-            self.document_model.appendRow(row)
-        self.status_bar.showMessage(f"Найдено документов: {len(results)}")
+        self.cancel_live_search(clear_text=True)
+        self.document_model.set_rows(SEARCH_COLUMNS, results)
+        self.result_set = ("Поиск", [doc.id for _, _, doc in results])
+        self.status_bar.showMessage(f"Найдено документов: {len(results)}{self.filter_note()}")
+
+    def start_live_search(self):
+        """Запускает поиск по тексту строки поиска; предыдущий незаконченный запрос прерывается."""
+        self.search_timer.stop()
+        text = self.search_edit.text().strip()
+        if not text:
+            # Строка очищена - возвращаемся к содержимому выбранной папки
+            self.update_document_table(self.folder_tree.currentIndex())
+            return
+        self.cancel_live_search()
+        if len(text) < SEARCH_MIN_CHARS:
+            self.status_bar.showMessage(f"Введите не меньше {SEARCH_MIN_CHARS} символов для поиска")
+            return
+        worker = SearchWorker(self.storage, self.search_generation, text, self.search_field_combo.currentData(), self)
+        worker.batch.connect(self.on_live_search_batch)
+        worker.finished_search.connect(self.on_live_search_done)
+        worker.finished.connect(lambda: self.search_workers.discard(worker))
+        worker.finished.connect(worker.deleteLater)
+        self.search_workers.add(worker)
+        self.document_model.set_rows(SEARCH_COLUMNS, [])
+        self.result_set = ("Поиск", [])
+        self.status_bar.showMessage("Поиск...")
+        worker.start()
+
+    def cancel_live_search(self, clear_text=False):
+        """Прерывает текущий поиск при наборе: его порции, которые еще в очереди, будут отброшены."""
+        self.search_generation += 1
+        for worker in self.search_workers:
+            worker.cancel()
+        if clear_text and self.search_edit.text():
+            self.search_timer.stop()
+            self.search_edit.blockSignals(True)
+            self.search_edit.clear()
+            self.search_edit.blockSignals(False)
+
+    def on_live_search_batch(self, generation, rows):
+        if generation != self.search_generation:
+            return # Устаревший запрос
+        self.document_model.append_rows(rows)
+        self.result_set[1].extend(doc.id for _, _, doc in rows)
+        self.status_bar.showMessage(f"Поиск... найдено документов: {len(self.result_set[1])}")
+
+    def on_live_search_done(self, generation, found, cancelled):
+        if generation == self.search_generation and not cancelled:
+            self.document_model.finish_rows()
+            self.status_bar.showMessage(f"Найдено документов: {found}{self.filter_note()}")
+
+    def stop_search_workers(self):
+        self.cancel_live_search()
+        for worker in list(self.search_workers):
+            worker.wait()
 
     def show_about(self):
         text = """
@@ -894,9 +1930,14 @@ class RegistrarApp(QMainWindow):
             if name in self.folders:
                 QMessageBox.warning(self, "Ошибка", "Папка с таким именем уже существует.")
                 return
-            self.folders[name] = {} # Создаем пустую верхнюю папку
-            # Обновляем модель дерева
-            self.update_folder_tree_model()
+            try:
+                self.storage.create_folder(name)
+            except sqlite3.OperationalError as e:
+                self.warn_folder_busy(e)
+                return
+            self.folders[name] = [] # Создаем пустую верхнюю папку
+            item = self.folder_model.add_top_folder(name)
+            self.folder_tree.scrollTo(item.index())
             self.status_bar.showMessage(f"Создана верхняя папка: {name}")
 
     def add_sub_folder(self, top_folder_name):
@@ -906,12 +1947,18 @@ class RegistrarApp(QMainWindow):
 
         name, ok = QInputDialog.getText(self, "Новая вложенная папка", "Введите имя папки:")
         if ok and name:
-            if name in self.folders.get(top_folder_name, {}):
+            if name in self.folders.get(top_folder_name, []):
                 QMessageBox.warning(self, "Ошибка", "Подпапка с таким именем уже существует в этой папке.")
                 return
-            self.folders[top_folder_name][name] = [] # Создаем пустую подпапку
-            # Обновляем модель дерева
-            self.update_folder_tree_model()
+            try:
+                self.storage.create_folder(top_folder_name, name)
+            except sqlite3.OperationalError as e:
+                self.warn_folder_busy(e)
+                return
+            self.folders[top_folder_name].append(name) # Создаем пустую подпапку
+            item = self.folder_model.add_sub_folder(top_folder_name, name)
+            self.folder_tree.expand(item.parent().index())
+            self.folder_tree.scrollTo(item.index())
             self.status_bar.showMessage(f"Создана подпапка: {top_folder_name} -> {name}")
 
     def delete_folder(self, index: QModelIndex):
@@ -925,34 +1972,112 @@ class RegistrarApp(QMainWindow):
         if parent_index.isValid():
             # Удаление вложенной папки
             top_folder_name = parent_index.data()
-            sub_folder_docs = self.folders.get(top_folder_name, {}).get(folder_name, [])
-            if sub_folder_docs:
-                QMessageBox.warning(self, "Ошибка", "Нельзя удалить непустую подпапку.")
+            if not self.save_data_to_db(): # Несохраненные документы подпапки не видны в базе
                 return
-            # Удаление из данных
-            del self.folders[top_folder_name][folder_name]
-            # Обновляем модель дерева
-            self.update_folder_tree_model()
+            try:
+                if self.storage.count_documents(top_folder_name, folder_name):
+                    QMessageBox.warning(self, "Ошибка", "Нельзя удалить непустую подпапку.")
+                    return
+                # Удаление из данных
+                self.storage.delete_folder(top_folder_name, folder_name)
+            except sqlite3.OperationalError as e:
+                self.warn_folder_busy(e)
+                return
+            self.folders[top_folder_name].remove(folder_name)
+            self.document_cache.discard(top_folder_name, folder_name)
+            self.folder_model.remove_sub_folder(top_folder_name, folder_name)
             self.status_bar.showMessage(f"Удалена подпапка: {top_folder_name} -> {folder_name}")
 
         else:
             # Удаление верхней папки
-            top_folder_subs = self.folders.get(folder_name, {})
             # Проверяем, есть ли непустые подпапки
-            is_empty = True
-            for docs in top_folder_subs.values():
-                if docs:
-                    is_empty = False
-                    break
-            if not is_empty:
-                QMessageBox.warning(self, "Ошибка", "Нельзя удалить непустую верхнюю папку.")
+            if not self.save_data_to_db():
+                return
+            try:
+                if self.storage.count_documents(folder_name):
+                    QMessageBox.warning(self, "Ошибка", "Нельзя удалить непустую верхнюю папку.")
+                    return
+                # Удаление из данных (даже если папка не пуста, но подпапки пусты)
+                self.storage.delete_folder(folder_name)
+            except sqlite3.OperationalError as e:
+                self.warn_folder_busy(e)
                 return
-            # Удаление из данных (даже если папка не пуста, но подпапки пусты)
             del self.folders[folder_name]
-            # Обновляем модель дерева
-            self.update_folder_tree_model()
+            self.document_cache.discard(folder_name)
+            self.folder_model.remove_top_folder(folder_name)
             self.status_bar.showMessage(f"Удалена верхняя папка: {folder_name}")
             
+    def rename_folder(self, index):
+        """Переименовывает папку: в базе меняется одна строка, документы не переписываются."""
+        parent_index = index.parent()
+        folder_name = index.data()
+        top_folder_name = parent_index.data() if parent_index.isValid() else None
+        new_name, ok = QInputDialog.getText(self, "Переименование папки", "Новое имя папки:", text=folder_name)
+        if not ok or not new_name or new_name == folder_name:
+            return
+        siblings = self.folders[top_folder_name] if top_folder_name is not None else self.folders
+        if new_name in siblings:
+            QMessageBox.warning(self, "Ошибка", "Папка с таким именем уже существует.")
+            return
+        if not self.save_data_to_db(): # Новые документы еще ссылаются на папку по старому имени
+            return
+        try:
+            if top_folder_name is None:
+                self.storage.rename_folder(folder_name, None, new_name)
+            else:
+                self.storage.rename_folder(top_folder_name, folder_name, new_name)
+        except ValueError as e: # Папку с этим именем успел создать другой пользователь
+            QMessageBox.warning(self, "Ошибка", str(e))
+            return
+        except sqlite3.OperationalError as e:
+            self.warn_folder_busy(e)
+            return
+        if top_folder_name is None:
+            # Переименовываем ключ, сохраняя порядок папок
+            self.folders = {new_name if name == folder_name else name: subs for name, subs in self.folders.items()}
+            self.document_cache.discard(folder_name)
+            self.folder_model.rename_top_folder(folder_name, new_name)
+            self.status_bar.showMessage(f"Папка {folder_name} переименована в {new_name}")
+        else:
+            subs = self.folders[top_folder_name]
+            subs[subs.index(folder_name)] = new_name
+            self.document_cache.discard(top_folder_name, folder_name)
+            self.folder_model.rename_sub_folder(top_folder_name, folder_name, new_name)
+            self.status_bar.showMessage(f"Подпапка {top_folder_name} -> {folder_name} переименована в {new_name}")
+        self.update_document_table(self.folder_tree.currentIndex())
+
+    def move_folder(self, index):
+        """Переносит подпапку вместе с документами в другую верхнюю папку."""
+        top_folder_name = index.parent().data()
+        sub_folder_name = index.data()
+        targets = [name for name in self.folders if name != top_folder_name]
+        new_top_folder_name, ok = QInputDialog.getItem(
+            self, "Перенос подпапки", f"Перенести {sub_folder_name} в папку:", targets, 0, True)
+        if not ok or not new_top_folder_name or new_top_folder_name == top_folder_name:
+            return
+        if sub_folder_name in self.folders.get(new_top_folder_name, []):
+            QMessageBox.warning(self, "Ошибка", "В этой папке уже есть подпапка с таким именем.")
+            return
+        was_current = self.folder_tree.currentIndex() == index
+        if not self.save_data_to_db(): # Новые документы еще ссылаются на подпапку в старой папке
+            return
+        try:
+            self.storage.move_folder(top_folder_name, sub_folder_name, new_top_folder_name)
+        except ValueError as e:
+            QMessageBox.warning(self, "Ошибка", str(e))
+            return
+        except sqlite3.OperationalError as e:
+            self.warn_folder_busy(e)
+            return
+        self.folders[top_folder_name].remove(sub_folder_name)
+        self.folders.setdefault(new_top_folder_name, []).append(sub_folder_name)
+        self.document_cache.discard(top_folder_name, sub_folder_name)
+        item = self.folder_model.move_sub_folder(top_folder_name, sub_folder_name, new_top_folder_name)
+        self.folder_tree.expand(item.parent().index())
+        if was_current:
+            self.folder_tree.setCurrentIndex(item.index())
+        self.status_bar.showMessage(f"Подпапка {sub_folder_name} перенесена в {new_top_folder_name}")
+
     def open_folder_context_menu(self, position):
         """Открывает контекстное меню для папок"""
         index = self.folder_tree.indexAt(position)
@@ -964,6 +2089,12 @@ class RegistrarApp(QMainWindow):
         
         if parent_index.isValid():
             # Контекстное меню для подпапки
+            rename_action = QAction("Переименовать подпапку", self)
+            rename_action.triggered.connect(lambda: self.rename_folder(index))
+            menu.addAction(rename_action)
+            move_action = QAction("Перенести в другую папку", self)
+            move_action.triggered.connect(lambda: self.move_folder(index))
+            menu.addAction(move_action)
             delete_action = QAction("Удалить подпапку", self)
             delete_action.triggered.connect(lambda: self.delete_folder(index))
             menu.addAction(delete_action)
@@ -972,6 +2103,9 @@ class RegistrarApp(QMainWindow):
             add_sub_action = QAction("Добавить подпапку", self)
             add_sub_action.triggered.connect(lambda: self.add_sub_folder(index.data()))
             menu.addAction(add_sub_action)
+            rename_action = QAction("Переименовать папку", self)
+            rename_action.triggered.connect(lambda: self.rename_folder(index))
+            menu.addAction(rename_action)
             
             delete_action = QAction("Удалить верхнюю папку", self)
             delete_action.triggered.connect(lambda: self.delete_folder(index))
@@ -981,28 +2115,42 @@ class RegistrarApp(QMainWindow):
 
     def add_sample_data(self):
         """Добавляет начальный образец данных"""
-        self.folders = {
-            "Договоры": { # Верхняя папка-образец
-                "2025": [ # Вложенная папка-образец
-                    Document(
-                        number="SAMPLE-001",
-                        name="Образец документа",
-                        counterparty="ООО Образец",
-                        start_date=QDate.currentDate(),
-                        description="Это пример документа.",
-                        attachments=[]
-                    )
-                ]
-            }
-        }
+        sample = Document(
+            number="SAMPLE-001",
+            name="Образец документа",
+            counterparty="ООО Образец",
+            description="Это пример документа.",
+        )
+        # Верхняя папка-образец "Договоры" с вложенной папкой-образцом "2025"
+        self.folders = {"Договоры": ["2025"]}
+        self.storage.add(sample, "Договоры", "2025")
+        self.save_data_to_db()
         self.update_folder_tree_model()
         self.status_bar.showMessage("Добавлен образец данных.")
 
 
 if __name__ == "__main__":
+    # Текст вложений извлекается в дочерних процессах; в собранной программе (PyInstaller и т.п.)
+    # дочерний процесс запускает тот же исполняемый файл, и freeze_support передает ему управление
+    import multiprocessing
+    multiprocessing.freeze_support()
+    # Журнал registrar.log и профиль сеанса - рядом с main.py, как и база
+    app_dir = os.path.dirname(os.path.abspath(sys.argv[0]))
+    configure_logging(os.environ.get("REGISTRAR_LOG_DIR", app_dir))
+    profiler = profiler_from_args(sys.argv[1:], app_dir)
+    if profiler:
+        profiler.start() # Статистика сохраняется при выходе
+    startup_timer = StartupTimer(
+        STARTUP_STARTED,
+        enabled="--startup-timing" in sys.argv or os.environ.get("REGISTRAR_STARTUP_TIMING") == "1"
+    )
+    startup_timer.mark("импорт модулей")
     app = QApplication(sys.argv)
     # Set style
     app.setStyle("Fusion")
-    window = RegistrarApp()
+    startup_timer.mark("создание QApplication")
+    window = RegistrarApp(startup_timer)
     window.show()
+    # Первая итерация цикла событий после show() - окно отрисовано
+    QTimer.singleShot(0, lambda: (startup_timer.mark("окно показано"), startup_timer.report()))
     sys.exit(app.exec())
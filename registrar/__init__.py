@@ -0,0 +1,2 @@
+"""Ядро реестра документов: модель данных и работа с базой без зависимостей от Qt."""
+from registrar.models import Attachment, Document, format_date, parse_date
@@ -0,0 +1,8 @@
+"""Запуск командной строки: python -m registrar <команда>."""
+import sys
+
+from registrar.cli import main
+
+# Проверка нужна: процессы извлечения текста вложений (spawn) заново импортируют этот модуль
+if __name__ == "__main__":
+    sys.exit(main())
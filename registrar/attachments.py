@@ -0,0 +1,358 @@
+"""
+Хранилище файлов вложений: адресация по содержимому, раскладка по подкаталогам,
+удаление файлов без ссылок. Не зависит от Qt - фоновые потоки окна вызывают эти функции.
+"""
+import hashlib
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from registrar.instrumentation import span
+from registrar.models import Attachment
+
+logger = logging.getLogger(__name__)
+
+# Блок чтения и копирования файлов вложений
+COPY_CHUNK_SIZE = 1024 * 1024
+
+# Очистка вложений: размер порции очереди/просмотра папки, возраст брошенного *.part (сек).
+# Столько же живут без ссылок только что помещенные в хранилище файлы: документ с ними еще может сохраняться
+ATTACHMENT_CLEANUP_BATCH = 1000
+PART_FILE_MAX_AGE = 3600
+# Подкаталог хранилища для недописанных копий (*.part): брошенные копии находятся без обхода всего хранилища
+INCOMING_DIR = ".incoming"
+ATTACHMENT_SCAN_CURSOR_KEY = "attachment_scan_cursor"
+# Отметка в settings о том, что файлы вложений перенесены в подкаталоги
+ATTACHMENT_LAYOUT_KEY = "attachment_layout"
+ATTACHMENT_LAYOUT_SHARDED = "sharded"
+
+
+def attachment_shard(file_path):
+    """Подкаталог хранилища для файла: два уровня по префиксу SHA-1 имени, например ab/cd."""
+    digest = hashlib.sha1(file_path.encode("utf-8")).hexdigest()
+    return os.path.join(digest[:2], digest[2:4])
+
+
+def attachment_path(attachments_dir, file_path):
+    """
+    Полный путь к файлу вложения в хранилище. Файлы разложены по подкаталогам
+    attachment_shard, чтобы в одном каталоге не скапливались сотни тысяч файлов.
+    Файл, который фоновая миграция еще не перенесла из плоской папки, находится по старому пути.
+    """
+    sharded_path = os.path.join(attachments_dir, attachment_shard(file_path), file_path)
+    if not os.path.exists(sharded_path):
+        flat_path = os.path.join(attachments_dir, file_path)
+        if os.path.exists(flat_path):
+            return flat_path
+    return sharded_path
+
+
+class IngestCancelled(Exception):
+    """Помещение вложения в хранилище отменено пользователем."""
+
+
+def _check_cancelled(cancel_event):
+    if cancel_event is not None and cancel_event.is_set():
+        raise IngestCancelled()
+
+
+def file_digest(path, progress=None, cancel_event=None, chunk_size=COPY_CHUNK_SIZE):
+    """SHA-256 и размер файла, читая его блоками. progress(прочитано байт) вызывается после каждого блока."""
+    digest = hashlib.sha256()
+    size = 0
+    with open(path, "rb") as f:
+        while chunk := f.read(chunk_size):
+            _check_cancelled(cancel_event)
+            digest.update(chunk)
+            size += len(chunk)
+            if progress:
+                progress(size)
+    return digest.hexdigest(), size
+
+
+def copy_file(source_path, destination_path, progress=None, cancel_event=None, chunk_size=COPY_CHUNK_SIZE):
+    """
+    Копирует файл, по возможности через reflink (копирование при записи, Btrfs/XFS):
+    данные не дублируются на диске, а изменение исходника не затрагивает копию.
+    Жесткая ссылка на исходный файл не подходит - правка оригинала испортила бы вложение.
+    Обычное копирование идет блоками, чтобы сообщать о прогрессе и проверять отмену.
+    """
+    if sys.platform.startswith("linux"):
+        import fcntl
+        FICLONE = 0x40049409
+        try:
+            with open(source_path, "rb") as src, open(destination_path, "wb") as dst:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            shutil.copystat(source_path, destination_path)
+            return
+        except OSError:
+            pass # Файловая система не поддерживает reflink - копируем обычным образом
+    copied = 0
+    with open(source_path, "rb") as src, open(destination_path, "wb") as dst:
+        while chunk := src.read(chunk_size):
+            _check_cancelled(cancel_event)
+            dst.write(chunk)
+            copied += len(chunk)
+            if progress:
+                progress(copied)
+    shutil.copystat(source_path, destination_path)
+
+
+class AttachmentStore:
+    """
+    Хранилище вложений, адресуемое по содержимому: файл хранится под именем
+    <sha256><расширение> один раз, сколько бы документов на него ни ссылалось.
+    Повторное прикрепление того же содержимого не копирует данные.
+    Методы можно вызывать из рабочих потоков: DocumentStorage держит отдельное соединение для каждого потока.
+    """
+    def __init__(self, attachments_dir, storage):
+        self.attachments_dir = attachments_dir
+        self.storage = storage
+
+    def path(self, file_path):
+        return attachment_path(self.attachments_dir, file_path)
+
+    def ingest(self, source_path, progress=None, cancel_event=None):
+        """
+        Помещает файл в хранилище и возвращает Attachment для документа.
+        progress(процент) сообщает о ходе работы: первая половина - хеширование, вторая - копирование.
+        При установленном cancel_event бросает IngestCancelled, не оставляя файлов в хранилище.
+        """
+        _check_cancelled(cancel_event)
+        size = os.path.getsize(source_path)
+        with span("attachment_copy", bytes=size) as timing:
+            return self._ingest(source_path, size, progress, cancel_event, timing)
+
+    def _ingest(self, source_path, size, progress, cancel_event, timing):
+        name = os.path.basename(source_path)
+        total = max(size, 1)
+        reported = [-1]
+
+        def report(percent):
+            if progress and percent != reported[0]:
+                reported[0] = percent
+                progress(percent)
+
+        content_hash, size = file_digest(source_path, lambda done: report(done * 50 // total), cancel_event)
+        existing = self.storage.find_blob(content_hash)
+        # touch_blob продлевает жизнь записи без ссылок, чтобы очистка не забрала файл до сохранения документа
+        if existing and self.storage.touch_blob(content_hash) and os.path.exists(self.path(existing)):
+            timing.set(copied=False)
+            report(100)
+            return Attachment(name, existing, content_hash) # Только метаданные, без копирования
+
+        file_path = content_hash + os.path.splitext(name)[1].lower()
+        destination_path = self.path(file_path)
+        os.makedirs(os.path.dirname(destination_path), exist_ok=True)
+        incoming_dir = os.path.join(self.attachments_dir, INCOMING_DIR)
+        os.makedirs(incoming_dir, exist_ok=True)
+        # Копируем во временный файл с уникальным именем: в хранилище не окажется недописанного
+        # файла под именем хеша, а одновременное копирование одинаковых файлов не конфликтует.
+        # Оставшиеся после аварийного завершения *.part в INCOMING_DIR удаляет фоновая очистка
+        # (remove_stale_part_files в process_pending_deletes).
+        fd, temp_path = tempfile.mkstemp(prefix=file_path + ".", suffix=".part", dir=incoming_dir)
+        os.close(fd)
+        try:
+            copy_file(source_path, temp_path, lambda done: report(50 + done * 50 // total), cancel_event)
+            _check_cancelled(cancel_event)
+            os.replace(temp_path, destination_path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        self.storage.register_blob(content_hash, file_path, size)
+        report(100)
+        return Attachment(name, file_path, content_hash)
+
+
+def remove_attachment_file(attachments_dir, file_path):
+    """
+    Удаляет файл вложения с диска. Возвращает True, если файл был удален.
+    Пока идет миграция хранилища, файл может лежать и в плоской папке - удаляем оба пути,
+    иначе миграция вернула бы удаленный файл в подкаталог.
+    """
+    removed = False
+    while True:
+        full_path = attachment_path(attachments_dir, file_path)
+        try:
+            os.remove(full_path)
+        except FileNotFoundError:
+            return removed
+        except OSError as e:
+            logger.error("Ошибка при удалении файла %s: %s", full_path, e)
+            return removed
+        removed = True
+
+
+def remove_stale_part_files(attachments_dir):
+    """Удаляет из INCOMING_DIR копии, брошенные больше PART_FILE_MAX_AGE назад (сбой во время копирования)."""
+    removed = 0
+    now = time.time()
+    try:
+        with os.scandir(os.path.join(attachments_dir, INCOMING_DIR)) as entries:
+            stale = [entry.path for entry in entries
+                     if entry.name.endswith(".part") and now - entry.stat().st_mtime > PART_FILE_MAX_AGE]
+    except OSError:
+        return 0 # Каталога еще нет - ничего не копировали
+    for full_path in stale:
+        try:
+            os.remove(full_path)
+            removed += 1
+        except OSError as e:
+            logger.error("Ошибка при удалении файла %s: %s", full_path, e)
+    return removed
+
+
+def process_pending_deletes(storage, attachments_dir, is_stopped=None):
+    """
+    Обрабатывает очередь pending_deletes: удаляет файлы, на которые не осталось
+    ссылок. Ссылки перепроверяются перед удалением, поэтому файл, снова
+    прикрепленный к документу, останется на месте. Файлы, помещенные в хранилище
+    меньше PART_FILE_MAX_AGE назад, остаются в очереди до следующего запуска.
+    Заодно удаляет брошенные недописанные копии (remove_stale_part_files).
+    Возвращает число удаленных файлов.
+    """
+    with span("attachment_cleanup") as timing:
+        removed = remove_stale_part_files(attachments_dir)
+        after = 0
+        while not (is_stopped and is_stopped()):
+            batch = storage.pending_deletes(after, ATTACHMENT_CLEANUP_BATCH)
+            if not batch:
+                break
+            after = batch[-1][0]
+            file_paths = [file_path for _, file_path in batch]
+            claimed, deferred = storage.claim_orphans(file_paths, time.time() - PART_FILE_MAX_AGE)
+            for file_path in claimed:
+                removed += remove_attachment_file(attachments_dir, file_path)
+            deferred = set(deferred)
+            storage.drop_pending_deletes([file_path for file_path in file_paths if file_path not in deferred])
+        timing.set(removed=removed)
+    return removed
+
+
+class AttachmentScan:
+    """
+    Полная проверка хранилища вложений на файлы без ссылок (например, оставшиеся
+    после сбоя). Подкаталоги обходятся по порядку, ссылки проверяются одним
+    запросом на порцию файлов. Последний проверенный подкаталог сохраняется
+    в settings, так что прерванная проверка продолжается с того же места.
+    """
+    def __init__(self, storage, attachments_dir, progress=None):
+        self.storage = storage
+        self.attachments_dir = attachments_dir
+        self.progress = progress # progress(проверено файлов, удалено файлов)
+        self.checked = 0
+        self.removed = 0
+
+    def run(self, is_stopped=None):
+        """Возвращает True, если проверка дошла до конца хранилища."""
+        completed = True
+        if os.path.isdir(self.attachments_dir):
+            with span("attachment_scan") as timing:
+                self.removed += remove_stale_part_files(self.attachments_dir)
+                completed = self._scan(is_stopped)
+                timing.set(rows=self.checked, removed=self.removed, completed=completed)
+        if completed:
+            self.storage.set_setting(ATTACHMENT_SCAN_CURSOR_KEY, None)
+        return completed
+
+    def _directories(self):
+        """Каталоги хранилища по порядку: сама папка (файлы до миграции), затем подкаталоги ab/cd."""
+        yield ""
+        for first in self._subdirectories(""):
+            for second in self._subdirectories(first):
+                yield os.path.join(first, second)
+
+    def _subdirectories(self, directory):
+        try:
+            with os.scandir(os.path.join(self.attachments_dir, directory)) as entries:
+                names = [entry.name for entry in entries if entry.is_dir() and entry.name != INCOMING_DIR]
+        except OSError:
+            return []
+        return sorted(names)
+
+    def _scan(self, is_stopped):
+        cursor = self.storage.get_setting(ATTACHMENT_SCAN_CURSOR_KEY)
+        batch = []
+        for directory in self._directories():
+            if cursor is not None and directory <= cursor:
+                continue # Проверено при прошлом запуске
+            try:
+                with os.scandir(os.path.join(self.attachments_dir, directory)) as entries:
+                    batch.extend((entry.name, entry.path) for entry in entries if entry.is_file())
+            except OSError:
+                continue
+            if len(batch) >= ATTACHMENT_CLEANUP_BATCH:
+                self._process(batch)
+                batch = []
+                self.storage.set_setting(ATTACHMENT_SCAN_CURSOR_KEY, directory)
+                if is_stopped and is_stopped():
+                    return False
+        self._process(batch)
+        return True
+
+    def _process(self, files):
+        """files - список (имя файла, полный путь)."""
+        now = time.time()
+        orphans = []
+        names = []
+        for name, full_path in files:
+            try:
+                age = now - os.path.getmtime(full_path)
+            except OSError:
+                continue
+            if name.endswith(".part"):
+                # Недописанная копия: удаляем, только если копирование явно брошено
+                if age > PART_FILE_MAX_AGE:
+                    orphans.append(full_path)
+            elif age > PART_FILE_MAX_AGE:
+                # Свежий файл мог быть только что скопирован и еще не зарегистрирован в blobs
+                names.append(name)
+        orphaned_names = set(self.storage.claim_orphans(names, now - PART_FILE_MAX_AGE)[0])
+        orphans.extend(full_path for name, full_path in files if name in orphaned_names)
+        for full_path in orphans:
+            try:
+                os.remove(full_path)
+                self.removed += 1
+            except OSError as e:
+                logger.error("Ошибка при удалении файла %s: %s", full_path, e)
+        self.checked += len(files)
+        if self.progress:
+            self.progress(self.checked, self.removed)
+
+
+def shard_attachments(storage, attachments_dir, is_stopped=None):
+    """
+    Однократная миграция хранилища: переносит файлы из плоской папки attachments
+    в подкаталоги attachment_shard. Пока она идет, attachment_path находит еще
+    не перенесенные файлы по старому пути. Возвращает (перенесено файлов, завершена ли миграция);
+    незавершенную миграцию можно просто запустить снова.
+    """
+    moved = 0
+    errors = 0
+    with os.scandir(attachments_dir) as entries:
+        for entry in entries:
+            if is_stopped and is_stopped():
+                return moved, False
+            # Недописанные *.part остаются на месте: их удалит проверка хранилища
+            if not entry.is_file() or entry.name.endswith(".part"):
+                continue
+            destination_dir = os.path.join(attachments_dir, attachment_shard(entry.name))
+            destination_path = os.path.join(destination_dir, entry.name)
+            try:
+                os.makedirs(destination_dir, exist_ok=True)
+                if os.path.exists(destination_path):
+                    os.remove(entry.path) # Содержимое с тем же именем уже в подкаталоге
+                else:
+                    os.replace(entry.path, destination_path)
+                moved += 1
+            except OSError as e:
+                logger.error("Ошибка при переносе файла %s: %s", entry.path, e)
+                errors += 1
+    if errors:
+        return moved, False # Повторим при следующем запуске
+    storage.set_setting(ATTACHMENT_LAYOUT_KEY, ATTACHMENT_LAYOUT_SHARDED)
+    return moved, True
@@ -0,0 +1,219 @@
+"""
+Командная строка реестра: python -m registrar <команда>.
+Работает без графического интерфейса (для ночных заданий); результаты выводятся
+в CSV построчно, по мере чтения из базы.
+"""
+import argparse
+import csv
+import json
+import os
+import sys
+from datetime import date
+
+from registrar.attachments import AttachmentScan, process_pending_deletes
+from registrar.export import FOLDER_EXPORT_COLUMNS, database_sheets, subfolder_sheets, write_csv, write_workbook
+from registrar.importer import import_documents
+from registrar.instrumentation import PROFILE_MODES, configure_logging, session_profiler
+from registrar.models import format_date, parse_date
+from registrar.storage import ATTACHMENT_TEXT_FIELD, DocumentStorage, SEARCH_TEXT_FIELDS, initialize_database
+
+# По умолчанию - та же база, что у приложения: documents.db рядом с main.py
+DEFAULT_DATA_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+RESULT_COLUMNS = ["top_folder", "sub_folder", "number", "name", "counterparty", "start_date", "end_date"]
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="registrar", description="Реестр документов без графического интерфейса")
+    parser.add_argument("--db", default=os.environ.get("REGISTRAR_DB", os.path.join(DEFAULT_DATA_DIR, "documents.db")),
+                        help="файл базы данных (по умолчанию documents.db рядом с main.py или $REGISTRAR_DB)")
+    parser.add_argument("--attachments", help="папка вложений (по умолчанию attachments рядом с базой)")
+    parser.add_argument("--profile", choices=PROFILE_MODES,
+                        help="профилировать команду (cProfile или выборочно); результат - рядом с базой")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    command = commands.add_parser("import", help="массовый импорт документов из CSV или XLSX")
+    command.add_argument("file", help="CSV или XLSX с заголовком; даты dd.MM.yyyy, yyyy-MM-dd или ячейки-даты")
+    command.add_argument("--map", action="append", default=[], metavar="ПОЛЕ=СТОЛБЕЦ",
+                         help="сопоставление поля документа столбцу файла, например number=\"№ договора\"")
+    command.add_argument("--top", help="верхняя папка для строк без столбца top_folder")
+    command.add_argument("--sub", help="подпапка для строк без столбца sub_folder")
+    command.add_argument("--sheet", help="лист XLSX (по умолчанию первый)")
+    command.add_argument("--rejects", help="CSV-отчет об отклоненных строках")
+    command.set_defaults(handler=command_import)
+
+    command = commands.add_parser("export", help="экспорт в CSV (по умолчанию в stdout) или .xlsx")
+    command.add_argument("-o", "--output", default="-", help="файл .csv или .xlsx; '-' - stdout")
+    command.add_argument("--top", help="только верхняя папка")
+    command.add_argument("--sub", help="только подпапка (вместе с --top)")
+    command.set_defaults(handler=command_export)
+
+    command = commands.add_parser("search", help="поиск документов")
+    command.add_argument("text", nargs="?", default="", help="искомый текст (каждое слово - префикс)")
+    command.add_argument("--field", default="all",
+                         choices=("all",) + SEARCH_TEXT_FIELDS + (ATTACHMENT_TEXT_FIELD, "start_date", "end_date"))
+    command.add_argument("--from", dest="from_date", help="начало диапазона дат (для --field start_date/end_date)")
+    command.add_argument("--to", dest="to_date", help="конец диапазона дат")
+    command.set_defaults(handler=command_search)
+
+    command = commands.add_parser("expiring", help="документы, срок которых скоро истекает")
+    command.add_argument("--days", type=int, default=30, help="порог в днях (по умолчанию 30)")
+    command.add_argument("--top", help="только верхняя папка")
+    command.set_defaults(handler=command_expiring)
+
+    command = commands.add_parser("vacuum", help="удалить файлы без ссылок и сжать базу")
+    command.add_argument("--scan", action="store_true", help="полностью проверить папку вложений")
+    command.set_defaults(handler=command_vacuum)
+
+    command = commands.add_parser("index-text", help="извлечь текст вложений для поиска по содержимому")
+    command.add_argument("--rebuild", action="store_true", help="переиндексировать все файлы (например, после установки pypdf)")
+    command.set_defaults(handler=command_index_text)
+
+    command = commands.add_parser("stats", help="сводка по базе")
+    command.add_argument("--json", action="store_true", help="вывести в JSON")
+    command.set_defaults(handler=command_stats)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if not os.path.exists(args.db) and args.command != "import":
+        print(f"База данных не найдена: {args.db}", file=sys.stderr)
+        return 1
+    data_dir = os.path.dirname(os.path.abspath(args.db))
+    if args.attachments is None:
+        args.attachments = os.path.join(data_dir, "attachments")
+    # Замеры команд пишутся в тот же registrar.log, что и у приложения
+    configure_logging(os.environ.get("REGISTRAR_LOG_DIR", data_dir))
+    profiler = session_profiler(args.profile, data_dir)
+    if profiler:
+        profiler.start()
+    initialize_database(args.db) # Применяет миграции, если база создана старой версией
+    storage = DocumentStorage(args.db)
+    try:
+        return args.handler(storage, args) or 0
+    except ValueError as e:
+        print(f"Ошибка: {e}", file=sys.stderr)
+        return 1
+    except BrokenPipeError:
+        # Вывод обрезан (например, | head) - это не ошибка
+        sys.stderr.close()
+        return 0
+    finally:
+        storage.close()
+
+
+def read_date(text):
+    """Дата из dd.MM.yyyy или yyyy-MM-dd."""
+    text = text.strip()
+    if not text:
+        return None
+    return date.fromisoformat(text) if "-" in text else parse_date(text)
+
+
+def parse_mapping(items):
+    mapping = {}
+    for item in items:
+        field, separator, column = item.partition("=")
+        if not separator:
+            raise ValueError(f"сопоставление задается как ПОЛЕ=СТОЛБЕЦ: {item}")
+        mapping[field.strip()] = column.strip()
+    return mapping
+
+
+def command_import(storage, args):
+    progress = lambda processed: print(f"\rОбработано строк: {processed}", end="", file=sys.stderr)
+    if args.rejects:
+        with open(args.rejects, "w", newline="", encoding="utf-8-sig") as rejects:
+            result = import_documents(storage, args.file, parse_mapping(args.map), args.top, args.sub,
+                                      rejects, progress, args.sheet)
+    else:
+        result = import_documents(storage, args.file, parse_mapping(args.map), args.top, args.sub,
+                                  progress=progress, sheet_name=args.sheet)
+    print(file=sys.stderr)
+    print(f"Импортировано документов: {result.imported}, отклонено строк: {result.rejected}", file=sys.stderr)
+    return 2 if result.rejected else 0
+
+
+def command_export(storage, args):
+    if args.sub and not args.top:
+        raise ValueError("--sub указывается вместе с --top")
+    if args.output.lower().endswith(".xlsx"):
+        if args.sub:
+            sheets = subfolder_sheets(storage, args.top, args.sub)
+        else:
+            sheets = database_sheets(storage, args.top)
+        written = write_workbook(args.output, sheets,
+                                 lambda written: print(f"\rЗаписано строк: {written}", end="", file=sys.stderr))
+        print(file=sys.stderr)
+    else:
+        rows = storage.iter_all_export_rows(args.top, args.sub)
+        if args.output == "-":
+            written = write_csv(sys.stdout, FOLDER_EXPORT_COLUMNS, rows)
+        else:
+            with open(args.output, "w", newline="", encoding="utf-8") as f:
+                written = write_csv(f, FOLDER_EXPORT_COLUMNS, rows)
+    print(f"Экспортировано документов: {written}", file=sys.stderr)
+
+
+def write_results(results, extra_columns=()):
+    """Выводит (top_folder, sub_folder, Document) в CSV; extra_columns - [(заголовок, функция(doc))]."""
+    writer = csv.writer(sys.stdout)
+    writer.writerow(RESULT_COLUMNS + [title for title, _ in extra_columns])
+    count = 0
+    for top_folder_name, sub_folder_name, doc in results:
+        writer.writerow([top_folder_name, sub_folder_name, doc.number, doc.name, doc.counterparty,
+                         format_date(doc.start_date), format_date(doc.end_date)]
+                        + [value(doc) for _, value in extra_columns])
+        count += 1
+    return count
+
+
+def command_search(storage, args):
+    if args.field in ("start_date", "end_date"):
+        if not args.from_date or not args.to_date:
+            raise ValueError("для поиска по дате укажите --from и --to")
+        results = storage.iter_by_date_range(args.field, read_date(args.from_date), read_date(args.to_date))
+    else:
+        results = storage.iter_search_results(args.text, args.field)
+    print(f"Найдено документов: {write_results(results)}", file=sys.stderr)
+
+
+def command_expiring(storage, args):
+    today = date.today()
+    count = write_results(storage.iter_expiring(args.days, args.top),
+                          [("days_left", lambda doc: doc.days_left(today))])
+    print(f"Истекает в ближайшие {args.days} дней: {count}", file=sys.stderr)
+
+
+def command_vacuum(storage, args):
+    removed = process_pending_deletes(storage, args.attachments)
+    print(f"Удалено файлов из очереди: {removed}", file=sys.stderr)
+    if args.scan:
+        scan = AttachmentScan(storage, args.attachments)
+        scan.run()
+        print(f"Проверено файлов: {scan.checked}, удалено: {scan.removed}", file=sys.stderr)
+    before = os.path.getsize(args.db)
+    storage.vacuum()
+    print(f"Размер базы: {before} -> {os.path.getsize(args.db)} байт", file=sys.stderr)
+
+
+def command_index_text(storage, args):
+    from registrar.textindex import index_attachment_texts # Не нужен остальным командам
+    if not storage.text_index_enabled:
+        print("SQLite собран без FTS5: поиск по содержимому вложений недоступен", file=sys.stderr)
+        return 1
+    if args.rebuild:
+        storage.reindex_attachment_texts()
+    indexed = index_attachment_texts(
+        storage, args.attachments, progress=lambda count: print(f"Проиндексировано: {count}", file=sys.stderr))
+    print(f"Проиндексировано файлов: {indexed}, в очереди: {storage.statistics()['text_index_queue']}", file=sys.stderr)
+
+
+def command_stats(storage, args):
+    stats = storage.statistics()
+    if args.json:
+        print(json.dumps(stats, ensure_ascii=False, indent=2))
+        return
+    for key, value in stats.items():
+        print(f"{key}\t{value}")
@@ -0,0 +1,119 @@
+"""Экспорт реестра в Excel и CSV потоком строк прямо из курсора SQLite."""
+import csv
+import os
+import re
+
+from registrar.instrumentation import span
+
+# openpyxl импортируется при первом экспорте, чтобы не замедлять запуск программы
+
+# Столбцы файла экспорта (совпадают с ключами Document.to_dict)
+EXPORT_COLUMNS = ["number", "name", "counterparty", "start_date", "end_date", "description", "attachments"]
+FOLDER_EXPORT_COLUMNS = ["top_folder", "sub_folder"] + EXPORT_COLUMNS
+
+# Как часто (в строках) экспорт сообщает о прогрессе и проверяет отмену
+EXPORT_PROGRESS_STEP = 1000
+EXCEL_SHEET_TITLE_MAX = 31
+
+
+class ExportCancelled(Exception):
+    """Экспорт прерван; недописанный файл удален."""
+
+
+def excel_sheet_title(name, used_titles):
+    """Допустимое и уникальное в книге имя листа Excel (не длиннее 31 символа, без []:*?/\\)."""
+    title = re.sub(r"[\[\]:*?/\\]", "_", name).strip("'") or "Лист"
+    title = title[:EXCEL_SHEET_TITLE_MAX]
+    candidate = title
+    suffix = 1
+    while candidate.lower() in used_titles:
+        suffix += 1
+        tail = f" ({suffix})"
+        candidate = title[:EXCEL_SHEET_TITLE_MAX - len(tail)] + tail
+    used_titles.add(candidate.lower())
+    return candidate
+
+
+def subfolder_sheets(storage, top_folder_name, sub_folder_name):
+    """Один лист с документами подпапки."""
+    return [(excel_sheet_title(sub_folder_name, set()), EXPORT_COLUMNS,
+             storage.iter_export_rows(top_folder_name, sub_folder_name))]
+
+
+def database_sheets(storage, top_folder_name=None):
+    """Отдельный лист на каждую подпапку всей базы или одной верхней папки."""
+    used_titles = set()
+    sheets = []
+    for top_folder, sub_folders in storage.load_folder_tree().items():
+        if top_folder_name is not None and top_folder != top_folder_name:
+            continue
+        for sub_folder in sub_folders:
+            # Генераторы не открывают соединение, пока запись не дойдет до их листа
+            sheets.append((excel_sheet_title(f"{top_folder} - {sub_folder}", used_titles),
+                           EXPORT_COLUMNS, storage.iter_export_rows(top_folder, sub_folder)))
+    return sheets
+
+
+def write_workbook(file_path, sheets, progress=None, is_cancelled=None):
+    """
+    Пишет листы [(имя листа, заголовки, итератор строк), ...] в write-only книгу
+    openpyxl: расход памяти не зависит от числа строк. Файл пишется во временный
+    *.part и переименовывается только после успешного сохранения.
+    progress(записано строк) вызывается каждые EXPORT_PROGRESS_STEP строк;
+    если is_cancelled() вернул True, бросает ExportCancelled. Возвращает число строк.
+    """
+    with span("export_xlsx", file=os.path.basename(file_path)) as timing:
+        written = _write_workbook(file_path, sheets, progress, is_cancelled)
+        timing.set(rows=written)
+    return written
+
+
+def _write_workbook(file_path, sheets, progress, is_cancelled):
+    temp_path = file_path + ".part"
+    from openpyxl import Workbook
+    workbook = Workbook(write_only=True)
+    written = 0
+    try:
+        for title, headers, rows in sheets:
+            if is_cancelled and is_cancelled():
+                raise ExportCancelled()
+            sheet = workbook.create_sheet(title)
+            sheet.append(headers)
+            try:
+                for row in rows:
+                    sheet.append(row)
+                    written += 1
+                    if written % EXPORT_PROGRESS_STEP == 0:
+                        if is_cancelled and is_cancelled():
+                            raise ExportCancelled()
+                        if progress:
+                            progress(written)
+            finally:
+                # Курсор закрываем в том же потоке, где он был открыт
+                if hasattr(rows, "close"):
+                    rows.close()
+        workbook.save(temp_path)
+        os.replace(temp_path, file_path)
+    except BaseException:
+        for title, headers, rows in sheets:
+            if hasattr(rows, "close"):
+                rows.close()
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    if progress:
+        progress(written)
+    return written
+
+
+def write_csv(stream, headers, rows):
+    """Пишет строки в CSV по мере чтения из базы. Возвращает число строк."""
+    writer = csv.writer(stream)
+    writer.writerow(headers)
+    written = 0
+    with span("export_csv") as timing:
+        for row in rows:
+            writer.writerow(row)
+            written += 1
+        timing.set(rows=written)
+    return written
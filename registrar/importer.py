@@ -0,0 +1,228 @@
+"""
+Массовый импорт документов из CSV и XLSX. Файл читается потоково, строки
+проверяются и вставляются порциями (executemany в одной транзакции на порцию),
+поэтому расход памяти не зависит от размера файла. Отклоненные строки
+с причиной пишутся в отчет по мере обнаружения.
+"""
+import csv
+import os
+import re
+from collections import namedtuple
+from datetime import date, datetime
+
+from registrar.instrumentation import span
+from registrar.models import DATE_FORMAT
+
+# Сколько строк вставляется одной транзакцией
+IMPORT_CHUNK_ROWS = 10000
+
+# Поля документа, которые можно загрузить, и заголовки столбцов, узнаваемые без явного сопоставления
+IMPORT_FIELDS = ("top_folder", "sub_folder", "number", "name", "counterparty", "start_date", "end_date", "description")
+IMPORT_HEADER_ALIASES = {
+    "top_folder": ("верхняя папка", "папка"),
+    "sub_folder": ("подпапка", "вложенная папка"),
+    "number": ("номер", "номер документа", "№"),
+    "name": ("наименование", "название"),
+    "counterparty": ("контрагент",),
+    "start_date": ("дата начала", "дата"),
+    "end_date": ("дата окончания", "срок"),
+    "description": ("описание", "примечание"),
+}
+
+# Форматы дат, которые понимает импорт (кроме ячеек-дат Excel)
+IMPORT_DATE_FORMATS = (DATE_FORMAT, "%Y-%m-%d", "%d/%m/%Y", "%d.%m.%y")
+
+REJECT_COLUMNS = ["row", "reason"]
+
+ImportResult = namedtuple("ImportResult", ["imported", "rejected"])
+
+
+class ImportFormatError(ValueError):
+    """Файл нельзя импортировать целиком: нет заголовка, нужных столбцов или формат не поддерживается."""
+
+
+def read_csv_rows(path):
+    """Строки CSV как списки значений; кодировка UTF-8 (с BOM или без), разделитель определяется по началу файла."""
+    with open(path, newline="", encoding="utf-8-sig") as f:
+        sample = f.read(64 * 1024)
+        f.seek(0)
+        try:
+            dialect = csv.Sniffer().sniff(sample, delimiters=",;\t")
+        except csv.Error:
+            dialect = csv.excel
+        yield from csv.reader(f, dialect)
+
+
+def read_xlsx_rows(path, sheet_name=None):
+    """Строки листа XLSX в режиме read-only: openpyxl не загружает книгу в память целиком."""
+    from openpyxl import load_workbook
+    workbook = load_workbook(path, read_only=True, data_only=True)
+    try:
+        sheet = workbook[sheet_name] if sheet_name else workbook.worksheets[0]
+        for row in sheet.iter_rows(values_only=True):
+            yield list(row)
+    finally:
+        workbook.close()
+
+
+def read_rows(path, sheet_name=None):
+    extension = os.path.splitext(path)[1].lower()
+    if extension == ".csv":
+        return read_csv_rows(path)
+    if extension in (".xlsx", ".xlsm"):
+        return read_xlsx_rows(path, sheet_name)
+    raise ImportFormatError(f"Неподдерживаемый формат файла: {extension or path}")
+
+
+def _normalize_header(value):
+    return re.sub(r"\s+", " ", str(value or "")).strip().lower()
+
+
+def map_columns(header, mapping=None):
+    """
+    Индексы столбцов для полей документа. mapping - {поле: заголовок столбца};
+    остальные поля ищутся по собственному имени и по IMPORT_HEADER_ALIASES.
+    """
+    positions = {_normalize_header(title): index for index, title in enumerate(header)}
+    columns = {}
+    for field, title in (mapping or {}).items():
+        if field not in IMPORT_FIELDS:
+            raise ImportFormatError(f"Неизвестное поле документа: {field}")
+        if _normalize_header(title) not in positions:
+            raise ImportFormatError(f"В файле нет столбца «{title}» для поля {field}")
+        columns[field] = positions[_normalize_header(title)]
+    for field in IMPORT_FIELDS:
+        if field in columns:
+            continue
+        for title in (field,) + IMPORT_HEADER_ALIASES[field]:
+            if title in positions:
+                columns[field] = positions[title]
+                break
+    return columns
+
+
+class _DateParser:
+    """Разбор дат с запоминанием: в реестре одни и те же даты повторяются тысячами."""
+    def __init__(self):
+        self._cache = {}
+
+    def __call__(self, value):
+        """ISO-строка даты, None для пустого значения; ValueError для неразборчивого."""
+        if value is None or value == "":
+            return None
+        if isinstance(value, datetime):
+            return value.date().isoformat()
+        if isinstance(value, date):
+            return value.isoformat()
+        text = str(value).strip()
+        if not text:
+            return None
+        result = self._cache.get(text)
+        if result is None:
+            result = self._parse(text)
+            if len(self._cache) < 100000:
+                self._cache[text] = result
+        return result
+
+    @staticmethod
+    def _parse(text):
+        text = text.split(" ")[0] # "01.02.2025 0:00:00" из выгрузок учетных систем
+        for date_format in IMPORT_DATE_FORMATS:
+            try:
+                return datetime.strptime(text, date_format).date().isoformat()
+            except ValueError:
+                pass
+        raise ValueError(f"неверная дата «{text}»")
+
+
+def _text(value):
+    if value is None:
+        return ""
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value)) # Номера из Excel приходят числами
+    return str(value).strip()
+
+
+def import_documents(storage, path, mapping=None, top_folder=None, sub_folder=None,
+                     rejects=None, progress=None, sheet_name=None, chunk_rows=IMPORT_CHUNK_ROWS):
+    """
+    Импортирует документы из CSV/XLSX файла path в базу storage.
+    top_folder/sub_folder - папка для строк, где она не указана в файле.
+    rejects - поток для CSV-отчета об отклоненных строках (номер строки, причина, исходные значения).
+    progress(обработано строк) вызывается после каждой порции. Возвращает ImportResult.
+    """
+    rows = read_rows(path, sheet_name)
+    try:
+        with span("import", file=os.path.basename(path)) as timing:
+            result = _import_rows(storage, rows, mapping, top_folder, sub_folder, rejects, progress, chunk_rows)
+            timing.set(rows=result.imported, rejected=result.rejected)
+        return result
+    finally:
+        if hasattr(rows, "close"):
+            rows.close()
+
+
+def _import_rows(storage, rows, mapping, top_folder, sub_folder, rejects, progress, chunk_rows):
+    header = None
+    row_number = 0
+    for row_number, header in enumerate(rows, start=1):
+        if any(_text(value) for value in header):
+            break
+    else:
+        raise ImportFormatError("Файл пуст")
+    columns = map_columns(header, mapping)
+    for field in ("number", "start_date"):
+        if field not in columns:
+            raise ImportFormatError(f"Не найден столбец для поля {field}")
+    if "top_folder" not in columns and not top_folder or "sub_folder" not in columns and not sub_folder:
+        raise ImportFormatError("Не задана папка: нет столбцов top_folder/sub_folder и папки по умолчанию")
+
+    reject_writer = csv.writer(rejects) if rejects is not None else None
+    if reject_writer:
+        reject_writer.writerow(REJECT_COLUMNS + [_text(title) for title in header])
+    parse_date = _DateParser()
+    get = {field: (lambda row, index=index: row[index] if index < len(row) else None)
+           for field, index in columns.items()}
+    missing = lambda row: None
+
+    imported = rejected = processed = 0
+    chunk = []
+    for row_number, row in enumerate(rows, start=row_number + 1):
+        if not any(_text(value) for value in row):
+            continue # Пустые строки в конце листа
+        processed += 1
+        try:
+            values = (
+                _text(get.get("top_folder", missing)(row)) or top_folder,
+                _text(get.get("sub_folder", missing)(row)) or sub_folder,
+                _text(get["number"](row)),
+                _text(get.get("name", missing)(row)),
+                _text(get.get("counterparty", missing)(row)),
+                parse_date(get["start_date"](row)),
+                parse_date(get.get("end_date", missing)(row)),
+                _text(get.get("description", missing)(row)),
+            )
+            if not values[0] or not values[1]:
+                raise ValueError("не указана папка")
+            if not values[2]:
+                raise ValueError("не указан номер")
+            if values[5] is None:
+                raise ValueError("не указана дата начала")
+            if values[6] is not None and values[6] < values[5]:
+                raise ValueError("дата окончания раньше даты начала")
+        except ValueError as e:
+            rejected += 1
+            if reject_writer:
+                reject_writer.writerow([row_number, str(e)] + [_text(value) for value in row])
+            continue
+        chunk.append(values)
+        if len(chunk) >= chunk_rows:
+            imported += storage.insert_document_rows(chunk)
+            chunk = []
+            if progress:
+                progress(processed)
+    if chunk:
+        imported += storage.insert_document_rows(chunk)
+    if progress:
+        progress(processed)
+    return ImportResult(imported, rejected)
@@ -0,0 +1,192 @@
+"""
+Инструментирование: замеры участков работы (загрузка, сохранение, поиск, экспорт...)
+в журнал с ротацией и профилирование всего сеанса.
+
+Замер:
+    with span("search", field=field) as s:
+        results = ...
+        s.set(rows=len(results))
+пишет в журнал строку "search 12.3 мс rows=111 field=all". Если журнал не настроен,
+замер почти ничего не стоит.
+
+Профилирование включается ключом --profile (cProfile) или --profile=sample
+(выборочный профилировщик по стекам всех потоков) либо переменной окружения
+REGISTRAR_PROFILE=cprofile|sample; статистика сохраняется при выходе.
+"""
+import atexit
+import cProfile
+import io
+import logging
+import logging.handlers
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import Counter
+
+LOG_FILE_NAME = "registrar.log"
+LOG_MAX_BYTES = 1024 * 1024
+LOG_BACKUP_COUNT = 5
+
+PROFILE_MODES = ("cprofile", "sample")
+# Интервал выборочного профилировщика, сек
+SAMPLE_INTERVAL = 0.005
+# Сколько строк сводки профиля записывается в журнал
+PROFILE_REPORT_LINES = 30
+
+logger = logging.getLogger(__name__)
+perf_logger = logging.getLogger("registrar.perf")
+
+
+class Span:
+    """Замер участка работы; дополнительные поля (например, rows) задаются через set()."""
+    __slots__ = ("name", "fields", "started")
+
+    def __init__(self, name, fields):
+        self.name = name
+        self.fields = fields
+        self.started = None
+
+    def set(self, **fields):
+        self.fields.update(fields)
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if perf_logger.isEnabledFor(logging.INFO):
+            duration_ms = (time.perf_counter() - self.started) * 1000
+            if exc_type is not None:
+                self.fields["error"] = exc_type.__name__
+            details = " ".join(f"{key}={value}" for key, value in self.fields.items())
+            perf_logger.info("%s %.1f мс %s", self.name, duration_ms, details)
+        return False
+
+
+def span(name, **fields):
+    return Span(name, fields)
+
+
+def configure_logging(log_dir, level=None):
+    """
+    Журнал registrar.log в log_dir с ротацией (LOG_BACKUP_COUNT файлов по LOG_MAX_BYTES);
+    предупреждения и ошибки дублируются в stderr. Уровень - level или REGISTRAR_LOG_LEVEL (по умолчанию INFO).
+    """
+    root = logging.getLogger("registrar")
+    if root.handlers:
+        return # Уже настроен (повторный вызов main() в том же процессе)
+    root.setLevel(level or os.environ.get("REGISTRAR_LOG_LEVEL", "INFO").upper())
+    root.propagate = False
+    console = logging.StreamHandler(sys.stderr)
+    console.setLevel(logging.WARNING)
+    console.setFormatter(logging.Formatter("%(levelname)s: %(message)s"))
+    root.addHandler(console)
+    try:
+        os.makedirs(log_dir, exist_ok=True)
+        handler = logging.handlers.RotatingFileHandler(
+            os.path.join(log_dir, LOG_FILE_NAME), maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT,
+            encoding="utf-8")
+    except OSError as e:
+        logger.warning("Журнал недоступен (%s): %s", log_dir, e)
+        return
+    handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s [%(threadName)s] %(message)s"))
+    root.addHandler(handler)
+
+
+class SessionProfiler:
+    """
+    Профилирование сеанса целиком. cprofile - детерминированный профиль основного
+    потока (файл .prof для pstats/snakeviz); sample - стеки всех потоков раз в
+    SAMPLE_INTERVAL в формате folded (для flamegraph.pl/speedscope), почти без замедления.
+    Сводка самых затратных функций пишется в журнал.
+    """
+    def __init__(self, mode, output_path):
+        if mode not in PROFILE_MODES:
+            raise ValueError(f"Неизвестный режим профилирования: {mode}")
+        self.mode = mode
+        self.output_path = output_path
+        self._profile = None
+        self._samples = Counter()
+        self._sampler = None
+        self._stopped = threading.Event()
+
+    def start(self):
+        if self.mode == "cprofile":
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+        else:
+            self._sampler = threading.Thread(target=self._sample, name="profiler", daemon=True)
+            self._sampler.start()
+        atexit.register(self.stop)
+        logger.info("Профилирование (%s) включено, результат: %s", self.mode, self.output_path)
+
+    def _sample(self):
+        own_id = threading.get_ident()
+        while not self._stopped.wait(SAMPLE_INTERVAL):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, str(thread_id)))
+                self._samples[";".join(reversed(stack))] += 1
+
+    def stop(self):
+        """Останавливает профилирование и сохраняет результат; повторный вызов ничего не делает."""
+        if self._stopped.is_set():
+            return
+        self._stopped.set()
+        if self._profile is not None:
+            self._profile.disable()
+            self._profile.dump_stats(self.output_path)
+            report = io.StringIO()
+            pstats.Stats(self._profile, stream=report).sort_stats("cumulative").print_stats(PROFILE_REPORT_LINES)
+            logger.info("Профиль сеанса (cProfile):\n%s", report.getvalue())
+        else:
+            self._sampler.join()
+            with open(self.output_path, "w", encoding="utf-8") as f:
+                for stack, count in self._samples.most_common():
+                    f.write(f"{stack} {count}\n")
+            leaves = Counter()
+            for stack, count in self._samples.items():
+                leaves[stack.rsplit(";", 1)[-1]] += count
+            total = sum(leaves.values()) or 1
+            lines = [f"{count * 100 / total:5.1f}%  {leaf}" for leaf, count in leaves.most_common(PROFILE_REPORT_LINES)]
+            logger.info("Профиль сеанса (выборки: %d):\n%s", total, "\n".join(lines))
+
+
+def profiler_from_args(argv, output_dir):
+    """SessionProfiler по ключу --profile[=cprofile|sample] в argv; см. session_profiler."""
+    mode = None
+    for arg in argv:
+        if arg == "--profile":
+            mode = "cprofile"
+        elif arg.startswith("--profile="):
+            mode = arg.partition("=")[2]
+    return session_profiler(mode, output_dir)
+
+
+def session_profiler(mode, output_dir):
+    """
+    SessionProfiler для режима mode, а без него - по переменной REGISTRAR_PROFILE;
+    None, если профилирование не запрошено или режим неизвестен (с предупреждением в журнале). Файл результата - REGISTRAR_PROFILE_OUTPUT
+    или registrar.prof / registrar-profile.folded в output_dir.
+    """
+    mode = mode or os.environ.get("REGISTRAR_PROFILE")
+    if not mode or mode == "0":
+        return None
+    if mode == "1":
+        mode = "cprofile"
+    if mode not in PROFILE_MODES:
+        # Опечатка в ключе или переменной окружения не должна мешать запуску программы
+        logger.warning("Неизвестный режим профилирования %r (допустимы: %s), профилирование выключено",
+                       mode, ", ".join(PROFILE_MODES))
+        return None
+    default_name = "registrar.prof" if mode == "cprofile" else "registrar-profile.folded"
+    return SessionProfiler(mode, os.environ.get("REGISTRAR_PROFILE_OUTPUT", os.path.join(output_dir, default_name)))
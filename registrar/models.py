@@ -0,0 +1,96 @@
+"""Модель данных реестра. Не зависит от Qt: QDate появляется только в окнах приложения."""
+import re
+from collections import namedtuple
+from datetime import date, datetime
+
+# Формат дат для отображения и экспорта (dd.MM.yyyy)
+DATE_FORMAT = "%d.%m.%Y"
+
+# Диапазон дат в фильтре таблицы: "дд.мм.гггг-дд.мм.гггг", любая граница может отсутствовать
+DATE_RANGE_RE = re.compile(r"^\s*(\d{1,2}\.\d{1,2}\.\d{4})?\s*(?:-|–|\.\.)\s*(\d{1,2}\.\d{1,2}\.\d{4})?\s*$")
+NUMBER_PART_RE = re.compile(r"(\d+)")
+
+# Вложение документа: имя для отображения, путь в хранилище (относительно attachments) и хеш содержимого
+# (None у вложений, добавленных до перехода на хранение по хешу)
+Attachment = namedtuple("Attachment", ["name", "file_path", "content_hash"])
+
+
+def parse_date(text):
+    """Дата из строки dd.MM.yyyy; пустая строка - None."""
+    return datetime.strptime(text, DATE_FORMAT).date() if text else None
+
+
+def format_date(value, empty=""):
+    """Дата в формате отображения или заглушка, если даты нет."""
+    return value.strftime(DATE_FORMAT) if value else empty
+
+
+def parse_date_range(text):
+    """(с, по) из строки "дд.мм.гггг-дд.мм.гггг" (отсутствующая граница - None); None, если это не диапазон."""
+    match = DATE_RANGE_RE.match(text)
+    if match is None or not any(match.groups()):
+        return None
+    try:
+        return parse_date(match.group(1)), parse_date(match.group(2))
+    except ValueError:
+        return None
+
+
+def natural_sort_key(text):
+    """Ключ сортировки текста без учета регистра; числа внутри строки сравниваются как числа (№ 9 < № 10)."""
+    parts = NUMBER_PART_RE.split((text or "").casefold())
+    parts[1::2] = map(int, parts[1::2])
+    return parts
+
+
+def date_sort_key(value):
+    """Ключ сортировки даты: отсутствующая дата (бессрочный документ) считается самой поздней."""
+    return (value is None, value or date.min)
+
+
+class Document:
+    """
+    Документ реестра. Атрибуты хранятся в слотах, даты - datetime.date,
+    вложения - кортеж Attachment: запись занимает в несколько раз меньше
+    памяти, чем экземпляр с __dict__ и объектами QDate.
+    """
+    __slots__ = ("id", "number", "name", "counterparty", "start_date", "end_date",
+                 "description", "attachments", "version")
+
+    def __init__(self, number="", name="", counterparty="",
+                 start_date=None, end_date=None,
+                 description="", attachments=(), db_id=None, version=None):
+        self.id = db_id # Идентификатор в БД
+        self.version = version # Номер версии записи в БД (растет при каждом сохранении)
+        self.number = number
+        self.name = name
+        self.counterparty = counterparty
+        if isinstance(start_date, str):
+            start_date = parse_date(start_date)
+        self.start_date = start_date or date.today()
+        if isinstance(end_date, str):
+            end_date = parse_date(end_date)
+        self.end_date = end_date
+        self.description = description
+        self.attachments = tuple(attachments)
+
+    def days_left(self, today=None):
+        """Сколько дней осталось до даты окончания (None для бессрочного документа)."""
+        if not self.end_date:
+            return None
+        return (self.end_date - (today or date.today())).days
+
+    def is_document_expiring(self, days_threshold=30, today=None):
+        days_left = self.days_left(today)
+        return days_left is not None and 0 <= days_left <= days_threshold # Истекающий = осталось от 0 до threshold дней
+
+    def to_dict(self):
+        return {
+            "number": self.number,
+            "name": self.name,
+            "counterparty": self.counterparty,
+            "start_date": format_date(self.start_date),
+            "end_date": format_date(self.end_date),
+            "description": self.description,
+            "attachments": ", ".join(attachment.name for attachment in self.attachments) # Имена файлов одной строкой
+        }
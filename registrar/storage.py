@@ -0,0 +1,1373 @@
+"""Хранение документов в SQLite: схема и миграции, сохранение, поиск, сроки, выборки для экспорта."""
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from contextlib import contextmanager
+from datetime import date, timedelta
+
+from registrar.instrumentation import span
+from registrar.models import Attachment, Document
+
+logger = logging.getLogger(__name__)
+
+# Сколько подпапок с документами одновременно держим в памяти
+SUBFOLDER_CACHE_SIZE = 16
+
+# Кэш результатов поиска и проверки сроков: сколько запросов и сколько строк всего
+QUERY_CACHE_SIZE = 32
+QUERY_CACHE_MAX_ROWS = 200000
+
+# Текстовые поля документа, по которым идет поиск "Все поля"
+SEARCH_TEXT_FIELDS = ("number", "name", "counterparty", "description")
+# Поле поиска по тексту, извлеченному из файлов вложений (см. registrar.textindex);
+# поиск "Все поля" после совпадений в полях документа отдает и совпадения во вложениях
+ATTACHMENT_TEXT_FIELD = "attachments"
+
+# Через сколько шагов виртуальной машины SQLite проверяется отмена запроса
+QUERY_CANCEL_CHECK_STEPS = 10000
+
+# Настройки соединений SQLite (см. connect_database)
+SQLITE_CACHE_SIZE_KB = 64 * 1024           # Кэш страниц каждого соединения
+SQLITE_MMAP_SIZE = 256 * 1024 * 1024       # Сколько байт файла БД читается через отображение в память
+SQLITE_CACHED_STATEMENTS = 256             # Подготовленные запросы, которые соединение держит готовыми
+# Сколько секунд ждать, пока другой экземпляр программы закончит запись
+SQLITE_BUSY_TIMEOUT = 15.0
+# То же для периодической проверки чужих изменений: она идет в потоке окна и не должна его подвешивать
+SQLITE_POLL_BUSY_TIMEOUT = 0.25
+
+# Файловые системы сетевых дисков (по /proc/mounts): WAL и mmap на них ненадежны
+NETWORK_FILESYSTEMS = {"nfs", "nfs4", "cifs", "smb3", "smbfs", "9p", "afpfs", "fuse.sshfs", "davfs"}
+
+# folder_id записи журнала change_log, отмечающей изменение самого дерева папок
+FOLDER_TREE_CHANGE = 0
+# Сколько последних записей хранит журнал изменений; экземпляр, пропустивший больше, перечитывает все
+CHANGE_LOG_KEEP = 200000
+
+# Изменения, записанные в базу другими соединениями (см. DocumentStorage.poll_changes):
+# tree - изменилось дерево папок, folders - подпапки (top_folder, sub_folder) с измененными документами
+# или None, если журнал изменений уже очищен и перечитать нужно все подпапки
+ExternalChanges = namedtuple("ExternalChanges", ["tree", "folders"])
+
+
+class QueryCancelled(Exception):
+    """Запрос прерван вызывающей стороной (см. DocumentStorage.iter_search_results)."""
+
+
+class WriteConflict(Exception):
+    """
+    Документы изменены или удалены в базе другим экземпляром программы после того,
+    как были прочитаны; их изменения не записаны (см. DocumentStorage.flush).
+    """
+    def __init__(self, documents):
+        super().__init__("Документы изменены или удалены другим пользователем: "
+                         + ", ".join(doc.number for doc in documents))
+        self.documents = documents
+
+
+def migrate_iso_dates(cursor):
+    """Миграция 1: даты dd.MM.yyyy -> yyyy-MM-dd, чтобы их можно было сравнивать и индексировать."""
+    for column in ("start_date", "end_date"):
+        cursor.execute(f'''
+            UPDATE documents
+            SET {column} = substr({column}, 7, 4) || '-' || substr({column}, 4, 2) || '-' || substr({column}, 1, 2)
+            WHERE {column} GLOB '[0-9][0-9].[0-9][0-9].[0-9][0-9][0-9][0-9]'
+        ''')
+    cursor.execute("UPDATE documents SET end_date = NULL WHERE end_date = ''")
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_documents_start_date ON documents (start_date)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_documents_end_date ON documents (end_date)')
+
+
+def migrate_content_addressed_attachments(cursor):
+    """
+    Миграция 2: хранилище вложений по хешу содержимого.
+    blobs - по одной записи на уникальное содержимое со счетчиком ссылок,
+    attachments - ссылки документов на файлы с исходным именем файла.
+    Старые вложения (content_hash IS NULL) остаются отдельными файлами.
+    """
+    cursor.execute('ALTER TABLE attachments ADD COLUMN name TEXT') # Имя файла для отображения
+    cursor.execute('ALTER TABLE attachments ADD COLUMN content_hash TEXT')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS blobs (
+            content_hash TEXT PRIMARY KEY, -- SHA-256 содержимого
+            file_path TEXT NOT NULL,       -- Путь относительно папки attachments
+            size INTEGER NOT NULL,
+            ref_count INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_attachments_content_hash ON attachments (content_hash)')
+    # Счетчик ссылок поддерживается триггерами, поэтому он верен при любой записи в attachments
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS attachments_blob_ref_ai AFTER INSERT ON attachments
+        WHEN new.content_hash IS NOT NULL BEGIN
+            UPDATE blobs SET ref_count = ref_count + 1 WHERE content_hash = new.content_hash;
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS attachments_blob_ref_ad AFTER DELETE ON attachments
+        WHEN old.content_hash IS NOT NULL BEGIN
+            UPDATE blobs SET ref_count = ref_count - 1 WHERE content_hash = old.content_hash;
+        END
+    ''')
+
+
+def migrate_pending_deletes(cursor):
+    """
+    Миграция 3: очередь файлов вложений на удаление. Ее пополняют триггеры, когда
+    на содержимое не остается ссылок или удаляется старое вложение; обрабатывает
+    ее фоновая очистка, так что полный просмотр папки attachments не нужен.
+    """
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS pending_deletes (
+            file_path TEXT PRIMARY KEY -- Путь относительно папки attachments
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS settings (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_attachments_file_path ON attachments (file_path)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_blobs_file_path ON blobs (file_path)')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS blobs_unreferenced_au AFTER UPDATE OF ref_count ON blobs
+        WHEN new.ref_count <= 0 BEGIN
+            INSERT OR IGNORE INTO pending_deletes (file_path) VALUES (new.file_path);
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS attachments_legacy_ad AFTER DELETE ON attachments
+        WHEN old.content_hash IS NULL BEGIN
+            INSERT OR IGNORE INTO pending_deletes (file_path) VALUES (old.file_path);
+        END
+    ''')
+    cursor.execute('INSERT OR IGNORE INTO pending_deletes (file_path) SELECT file_path FROM blobs WHERE ref_count <= 0')
+
+
+def migrate_folder_tables(cursor):
+    """
+    Миграция 4: папки - отдельные таблицы top_folders и sub_folders, документ ссылается
+    на подпапку по folder_id. Пустые папки сохраняются в базе, а переименование и перенос
+    папки меняют одну строку вместо всех ее документов. Таблица documents пересоздается
+    с прежними ID, поэтому вложения и полнотекстовый индекс остаются верными.
+    """
+    cursor.execute('''
+        CREATE TABLE top_folders (
+            id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL UNIQUE
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE sub_folders (
+            id INTEGER PRIMARY KEY,
+            top_folder_id INTEGER NOT NULL REFERENCES top_folders (id) ON DELETE CASCADE,
+            name TEXT NOT NULL,
+            UNIQUE (top_folder_id, name)
+        )
+    ''')
+    cursor.execute('INSERT INTO top_folders (name) SELECT DISTINCT top_folder FROM documents ORDER BY top_folder')
+    cursor.execute('''
+        INSERT INTO sub_folders (top_folder_id, name)
+        SELECT DISTINCT t.id, d.sub_folder FROM documents d JOIN top_folders t ON t.name = d.top_folder
+        ORDER BY t.id, d.sub_folder
+    ''')
+    sequence = cursor.execute("SELECT seq FROM sqlite_sequence WHERE name = 'documents'").fetchone()
+    cursor.execute('''
+        CREATE TABLE documents_new (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            folder_id INTEGER NOT NULL REFERENCES sub_folders (id),
+            number TEXT NOT NULL,
+            name TEXT NOT NULL,
+            counterparty TEXT,
+            start_date TEXT NOT NULL, -- Храним как строку yyyy-MM-dd (ISO 8601)
+            end_date TEXT,            -- Храним как строку yyyy-MM-dd или NULL
+            description TEXT
+        )
+    ''')
+    cursor.execute('''
+        INSERT INTO documents_new (id, folder_id, number, name, counterparty, start_date, end_date, description)
+        SELECT d.id, s.id, d.number, d.name, d.counterparty, d.start_date, d.end_date, d.description
+        FROM documents d
+        JOIN top_folders t ON t.name = d.top_folder
+        JOIN sub_folders s ON s.top_folder_id = t.id AND s.name = d.sub_folder
+        ORDER BY d.id
+    ''')
+    cursor.execute('DROP TABLE documents') # Вместе с индексами и триггерами полнотекстового индекса
+    cursor.execute('ALTER TABLE documents_new RENAME TO documents')
+    if sequence:
+        # ID удаленных документов не выдаются повторно, как и до миграции
+        cursor.execute("DELETE FROM sqlite_sequence WHERE name = 'documents'")
+        cursor.execute("INSERT INTO sqlite_sequence (name, seq) VALUES ('documents', ?)", sequence)
+    cursor.execute('CREATE INDEX idx_documents_folder ON documents (folder_id)')
+    cursor.execute('CREATE INDEX idx_documents_start_date ON documents (start_date)')
+    cursor.execute('CREATE INDEX idx_documents_end_date ON documents (end_date)')
+    if cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'documents_fts'").fetchone():
+        create_search_triggers(cursor)
+
+
+def migrate_change_tracking(cursor):
+    """
+    Миграция 5: совместная работа нескольких экземпляров программы с одной базой.
+    documents.version растет при каждом сохранении документа, и запись проходит, только
+    если версия не изменилась с момента чтения (оптимистическая блокировка).
+    change_log - журнал изменений: подпапка, в которой изменился документ, или
+    FOLDER_TREE_CHANGE при изменении самих папок. Его ведут триггеры, поэтому другие
+    экземпляры узнают, какие подпапки перечитать, не сравнивая документы.
+    """
+    cursor.execute('ALTER TABLE documents ADD COLUMN version INTEGER NOT NULL DEFAULT 1')
+    cursor.execute('''
+        CREATE TABLE change_log (
+            change_id INTEGER PRIMARY KEY,
+            folder_id INTEGER NOT NULL -- ID подпапки или FOLDER_TREE_CHANGE
+        )
+    ''')
+    for name, event, folder in (("documents_changes_ai", "INSERT", "new.folder_id"),
+                                ("documents_changes_au", "UPDATE", "new.folder_id"),
+                                ("documents_changes_ad", "DELETE", "old.folder_id"),
+                                ("documents_changes_move", "UPDATE OF folder_id", "old.folder_id")):
+        cursor.execute(f'CREATE TRIGGER {name} AFTER {event} ON documents '
+                       f'BEGIN INSERT INTO change_log (folder_id) VALUES ({folder}); END')
+    for table in ("top_folders", "sub_folders"):
+        for event in ("INSERT", "UPDATE", "DELETE"):
+            cursor.execute(f'CREATE TRIGGER {table}_changes_{event[0].lower()} AFTER {event} ON {table} '
+                           f'BEGIN INSERT INTO change_log (folder_id) VALUES ({FOLDER_TREE_CHANGE}); END')
+
+
+def migrate_blob_registration(cursor):
+    """
+    Миграция 6: blobs.registered_at - когда содержимое последний раз помещали в хранилище
+    (unix-время). Документ с только что добавленным вложением еще может быть не сохранен,
+    поэтому такие записи claim_orphans не удаляет до истечения срока. У старых записей NULL.
+    """
+    cursor.execute('ALTER TABLE blobs ADD COLUMN registered_at REAL')
+
+
+# Миграции схемы БД по порядку; индекс в списке + 1 = номер версии после миграции
+DB_MIGRATIONS = [
+    migrate_iso_dates,
+    migrate_content_addressed_attachments,
+    migrate_pending_deletes,
+    migrate_folder_tables,
+    migrate_change_tracking,
+    migrate_blob_registration,
+]
+
+
+def is_network_path(path):
+    """Лежит ли файл на сетевом диске: UNC-путь или сетевой диск Windows, NFS/SMB и т.п. в Linux."""
+    path = os.path.abspath(path)
+    if os.name == "nt":
+        if path.startswith("\\\\"):
+            return True
+        import ctypes
+        drive = os.path.splitdrive(path)[0] + "\\"
+        return ctypes.windll.kernel32.GetDriveTypeW(drive) == 4 # DRIVE_REMOTE
+    try:
+        with open("/proc/mounts", encoding="utf-8") as f:
+            mounts = [line.split()[1:3] for line in f]
+    except OSError:
+        return False # Нет /proc (macOS и т.п.) - считаем диск локальным
+    filesystem, longest = None, -1
+    for mount_point, fs_type in mounts:
+        mount_point = mount_point.replace("\\040", " ")
+        if (path == mount_point or path.startswith(mount_point.rstrip("/") + "/")) and len(mount_point) > longest:
+            filesystem, longest = fs_type, len(mount_point)
+    return filesystem in NETWORK_FILESYSTEMS
+
+
+def journal_mode(db_path):
+    """
+    Режим журнала для базы: WAL на локальном диске; DELETE на сетевом, где WAL не работает
+    (разделяемая память журнала видна только на одном компьютере). Переопределяется REGISTRAR_JOURNAL_MODE.
+    """
+    return os.environ.get("REGISTRAR_JOURNAL_MODE", "DELETE" if is_network_path(db_path) else "WAL").upper()
+
+
+def connect_database(db_path, network=False):
+    """
+    Соединение с настройками для работы с реестром: внешние ключи (каскадное удаление
+    вложений), ожидание чужой записи до SQLITE_BUSY_TIMEOUT, кэш страниц и подготовленных запросов.
+    На локальном диске (журнал WAL) - synchronous=NORMAL (база остается целостной при сбое,
+    теряется лишь последняя транзакция) и чтение через mmap; на сетевом - synchronous=FULL без mmap.
+    """
+    conn = sqlite3.connect(db_path, timeout=SQLITE_BUSY_TIMEOUT, cached_statements=SQLITE_CACHED_STATEMENTS)
+    conn.execute('PRAGMA foreign_keys = ON')
+    conn.execute(f'PRAGMA synchronous = {"FULL" if network else "NORMAL"}')
+    conn.execute(f'PRAGMA cache_size = -{SQLITE_CACHE_SIZE_KB}')
+    conn.execute(f'PRAGMA mmap_size = {0 if network else SQLITE_MMAP_SIZE}')
+    return conn
+
+
+def initialize_database(db_path):
+    """Создает таблицы в базе данных, если они не существуют, применяет миграции и выбирает режим журнала."""
+    conn = connect_database(db_path, is_network_path(db_path))
+    # WAL: чтение не блокируется записью (поиск и экспорт в фоне идут во время сохранения),
+    # а фиксация транзакции - дописывание в журнал. Режим хранится в самой базе.
+    mode = journal_mode(db_path)
+    if conn.execute('PRAGMA journal_mode').fetchone()[0].upper() != mode:
+        try:
+            conn.execute(f'PRAGMA journal_mode = {mode}')
+        except sqlite3.OperationalError as e:
+            # Смена режима требует, чтобы базу не открывал никто другой; сменится при следующем запуске
+            logger.warning("Не удалось перевести базу в режим журнала %s: %s", mode, e)
+    # Миграции пересоздают таблицы; с внешними ключами DROP TABLE documents удалил бы вложения каскадно
+    conn.execute('PRAGMA foreign_keys = OFF')
+    cursor = conn.cursor()
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS documents (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            top_folder TEXT NOT NULL,
+            sub_folder TEXT NOT NULL,
+            number TEXT NOT NULL,
+            name TEXT NOT NULL,
+            counterparty TEXT,
+            start_date TEXT NOT NULL, -- Храним как строку yyyy-MM-dd (ISO 8601)
+            end_date TEXT,            -- Храним как строку yyyy-MM-dd или NULL
+            description TEXT
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS attachments (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            document_id INTEGER NOT NULL,
+            file_path TEXT NOT NULL, -- Храним путь относительно папки attachments
+            FOREIGN KEY (document_id) REFERENCES documents (id) ON DELETE CASCADE
+        )
+    ''')
+    # Индексы для ленивой загрузки подпапок и их вложений (в базе после миграции 4 индекс
+    # idx_documents_folder уже построен по folder_id, и эта команда ничего не делает)
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_documents_folder ON documents (top_folder, sub_folder)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_attachments_document ON attachments (document_id)')
+    initialize_search_index(cursor)
+    conn.commit()
+    migrate_database(conn)
+    with conn:
+        initialize_attachment_text_index(conn.cursor())
+    conn.close()
+
+
+def migrate_database(conn):
+    """Применяет версионные миграции схемы; номер версии хранится в PRAGMA user_version."""
+    version = conn.execute('PRAGMA user_version').fetchone()[0]
+    for number, migration in enumerate(DB_MIGRATIONS[version:], start=version + 1):
+        with conn: # Каждая миграция - отдельная транзакция вместе с новым номером версии
+            conn.execute('BEGIN') # Явно, чтобы DDL тоже откатывался при ошибке
+            migration(conn.cursor())
+            conn.execute(f'PRAGMA user_version = {number}')
+
+
+def initialize_search_index(cursor):
+    """Создает полнотекстовый индекс FTS5 по документам и триггеры его синхронизации."""
+    exists = cursor.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'documents_fts'").fetchone()
+    if exists:
+        return
+    try:
+        # unicode61 приводит к нижнему регистру и кириллицу, поиск без учета регистра работает "из коробки"
+        cursor.execute('''
+            CREATE VIRTUAL TABLE documents_fts USING fts5(
+                number, name, counterparty, description,
+                content='documents', content_rowid='id',
+                tokenize='unicode61 remove_diacritics 2'
+            )
+        ''')
+    except sqlite3.OperationalError as e:
+        # SQLite собран без FTS5 - поиск будет работать перебором
+        logger.warning("Полнотекстовый индекс недоступен: %s", e)
+        return
+    create_search_triggers(cursor)
+    # Индексируем документы, которые уже были в базе
+    cursor.execute("INSERT INTO documents_fts (documents_fts) VALUES ('rebuild')")
+
+
+def create_search_triggers(cursor):
+    """
+    Триггеры, поддерживающие documents_fts в соответствии с таблицей documents.
+    Каждый - отдельным execute: executescript зафиксировал бы транзакцию миграции.
+    """
+    cursor.execute('''
+        CREATE TRIGGER documents_fts_ai AFTER INSERT ON documents BEGIN
+            INSERT INTO documents_fts (rowid, number, name, counterparty, description)
+            VALUES (new.id, new.number, new.name, new.counterparty, new.description);
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER documents_fts_ad AFTER DELETE ON documents BEGIN
+            INSERT INTO documents_fts (documents_fts, rowid, number, name, counterparty, description)
+            VALUES ('delete', old.id, old.number, old.name, old.counterparty, old.description);
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER documents_fts_au AFTER UPDATE OF number, name, counterparty, description ON documents BEGIN
+            INSERT INTO documents_fts (documents_fts, rowid, number, name, counterparty, description)
+            VALUES ('delete', old.id, old.number, old.name, old.counterparty, old.description);
+            INSERT INTO documents_fts (rowid, number, name, counterparty, description)
+            VALUES (new.id, new.number, new.name, new.counterparty, new.description);
+        END
+    ''')
+
+
+def initialize_attachment_text_index(cursor):
+    """
+    Полнотекстовый индекс содержимого файлов вложений. Текст извлекается один раз на файл
+    хранилища (одно содержимое, прикрепленное к нескольким документам, - одна запись
+    attachment_texts) и связывается с документами через attachments.file_path.
+    Новые файлы ставит в очередь attachment_text_queue триггер, разбирает ее
+    registrar.textindex в фоне, а записи удаленных файлов убирает claim_orphans.
+    """
+    exists = cursor.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'attachment_text_fts'").fetchone()
+    if exists:
+        return
+    try:
+        cursor.execute('''
+            CREATE VIRTUAL TABLE attachment_text_fts USING fts5(
+                text, tokenize='unicode61 remove_diacritics 2'
+            )
+        ''')
+    except sqlite3.OperationalError as e:
+        logger.warning("Индекс содержимого вложений недоступен: %s", e)
+        return
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS attachment_texts (
+            id INTEGER PRIMARY KEY, -- rowid текста в attachment_text_fts
+            file_path TEXT NOT NULL UNIQUE,
+            extractor TEXT          -- Чем извлечен текст; NULL - формат не поддерживается или файл не прочитан
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS attachment_text_queue (
+            file_path TEXT PRIMARY KEY -- Путь относительно папки attachments
+        )
+    ''')
+    # Документ при сохранении перезаписывает свои вложения, поэтому в очередь попадают
+    # только файлы, которые еще не индексировались
+    cursor.execute('''
+        CREATE TRIGGER attachments_text_queue_ai AFTER INSERT ON attachments
+        WHEN NOT EXISTS (SELECT 1 FROM attachment_texts WHERE file_path = new.file_path) BEGIN
+            INSERT OR IGNORE INTO attachment_text_queue (file_path) VALUES (new.file_path);
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER attachment_texts_ad AFTER DELETE ON attachment_texts BEGIN
+            DELETE FROM attachment_text_fts WHERE rowid = old.id;
+        END
+    ''')
+    # Вложения, которые уже были в базе
+    cursor.execute('INSERT OR IGNORE INTO attachment_text_queue (file_path) SELECT file_path FROM attachments')
+
+
+class DatabaseEngine:
+    """
+    Долгоживущие соединения с базой, настроенные connect_database: по одному на поток
+    (соединение SQLite нельзя использовать из другого потока). Соединение открывается
+    при первом обращении потока и дальше переиспользуется вместе с кэшем страниц и
+    подготовленных запросов; соединение завершившегося потока закрывается вместе с ним.
+    """
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.network = is_network_path(db_path)
+        self._local = threading.local()
+
+    def connect(self):
+        """Новое отдельное соединение; закрывает вызывающий."""
+        return connect_database(self.db_path, self.network)
+
+    def connection(self):
+        """Соединение текущего потока."""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = self.connect()
+        return conn
+
+    def close(self):
+        """Закрывает соединение текущего потока (при следующем обращении откроется новое)."""
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            self._local.conn = None
+            conn.close()
+
+
+class DocumentStorage:
+    """
+    Слой сохранения документов в SQLite.
+    Отслеживает новые, измененные и удаленные документы и при flush()
+    записывает в базу только их, а не всю структуру папок.
+    """
+    def __init__(self, db_path, query_cache_size=QUERY_CACHE_SIZE, query_cache_rows=QUERY_CACHE_MAX_ROWS):
+        self.db_path = db_path
+        self.engine = DatabaseEngine(db_path) # Все чтение и запись идут через соединения движка
+        self._new = {}      # Document -> (top_folder, sub_folder), порядок добавления сохраняется
+        self._dirty = {}    # Document -> None (упорядоченное множество)
+        self._deleted = []  # Удаленные документы (Document)
+        self.fts_enabled = self._table_exists('documents_fts')
+        self.text_index_enabled = self._table_exists('attachment_text_fts')
+        # Поколение данных: растет при любом изменении документов или папок и делает кэш запросов устаревшим
+        self.generation = 0
+        self._generation_lock = threading.Lock()
+        self.query_cache = QueryCache(query_cache_size, query_cache_rows)
+        # Отслеживание чужих изменений (poll_changes): поток, который их проверяет,
+        # (PRAGMA data_version его соединения, последний учтенный change_log.change_id)
+        # и диапазоны номеров change_log, записанных им самим
+        self._watch_thread = None
+        self._seen = None
+        self._own_changes = []
+
+    def mark_changed(self):
+        """Отмечает изменение данных: результаты запросов, закэшированные раньше, больше не используются."""
+        with self._generation_lock:
+            self.generation += 1
+
+    def close(self):
+        """Закрывает соединение с базой текущего потока."""
+        self.engine.close()
+
+    def add(self, doc, top_folder_name, sub_folder_name):
+        """Помечает документ как новый."""
+        self._new[doc] = (top_folder_name, sub_folder_name)
+
+    def update(self, doc):
+        """Помечает документ как измененный."""
+        if doc in self._new:
+            return # Новый документ будет вставлен в актуальном состоянии
+        self._dirty[doc] = None
+
+    def remove(self, doc):
+        """Помечает документ как удаленный."""
+        if self._new.pop(doc, None) is not None:
+            return # Документ еще не попал в базу
+        self._dirty.pop(doc, None)
+        if doc.id is not None:
+            self._deleted.append(doc)
+
+    def has_changes(self):
+        return bool(self._new or self._dirty or self._deleted)
+
+    def flush(self):
+        """
+        Записывает накопленные изменения одной транзакцией. Возвращает число затронутых документов.
+        Измененный или удаленный документ записывается, только если его версия в базе та же, что
+        при чтении; документы, которые тем временем изменил другой экземпляр программы, пропускаются,
+        а после записи остальных бросается WriteConflict со списком пропущенных.
+        Если транзакция не прошла (например, база дольше SQLITE_BUSY_TIMEOUT занята другим
+        экземпляром), исключение sqlite3 пробрасывается, а изменения остаются накопленными.
+        """
+        if not self.has_changes():
+            return 0
+        with span("db_save", new=len(self._new), updated=len(self._dirty), deleted=len(self._deleted)) as timing:
+            try:
+                conflicts = self._write_changes()
+            except sqlite3.Error:
+                for doc in self._new:
+                    doc.id = None # Транзакция откатилась - документы не вставлены
+                raise
+            timing.set(conflicts=len(conflicts))
+        self.mark_changed()
+
+        written = len(self._new) + len(self._dirty) + len(self._deleted) - len(conflicts)
+        self._new.clear()
+        self._dirty.clear()
+        self._deleted.clear()
+        if conflicts:
+            # Новые вложения несохраненных документов не нужны; файлы, на которые есть ссылки, останутся
+            self.queue_file_deletes([attachment.file_path for doc in conflicts for attachment in doc.attachments])
+            raise WriteConflict(conflicts)
+        return written
+
+    def _write_changes(self):
+        """Запись изменений; возвращает документы, не записанные из-за конфликта версий."""
+        conflicts = []
+        updated = []
+        with self._transaction() as conn:
+            cursor = conn.cursor()
+            for doc in self._deleted:
+                # Вложения удаляются каскадно (ON DELETE CASCADE, внешние ключи включены в соединении)
+                cursor.execute('DELETE FROM documents WHERE id = ? AND version = ?', (doc.id, doc.version))
+                if cursor.rowcount == 0 and cursor.execute(
+                        'SELECT 1 FROM documents WHERE id = ?', (doc.id,)).fetchone() is not None:
+                    conflicts.append(doc) # Документ изменен другим пользователем (уже удаленный - не конфликт)
+
+            for doc in self._dirty:
+                cursor.execute('''
+                    UPDATE documents
+                    SET number = ?, name = ?, counterparty = ?, start_date = ?, end_date = ?, description = ?,
+                        version = version + 1
+                    WHERE id = ? AND version = ?
+                ''', self._document_values(doc) + (doc.id, doc.version))
+                if cursor.rowcount == 0:
+                    conflicts.append(doc) # Изменен или удален другим пользователем
+                    continue
+                updated.append(doc)
+                self._write_attachments(cursor, doc)
+
+            for doc, (top_folder_name, sub_folder_name) in self._new.items():
+                cursor.execute('''
+                    INSERT INTO documents (folder_id, number, name, counterparty, start_date, end_date, description)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                ''', (self._folder_id(cursor, top_folder_name, sub_folder_name, create=True),)
+                    + self._document_values(doc))
+                doc.id = cursor.lastrowid # Получаем ID вставленного документа
+                doc.version = 1
+                self._write_attachments(cursor, doc)
+        for doc in updated: # Только после фиксации транзакции
+            doc.version += 1
+        return conflicts
+
+    def insert_document_rows(self, rows):
+        """
+        Массовая вставка документов одной транзакцией, минуя учет изменений.
+        rows - кортежи (top_folder, sub_folder, number, name, counterparty, start_date, end_date, description)
+        с датами в ISO; недостающие папки создаются. Возвращает число вставленных строк.
+        """
+        with self._transaction() as conn:
+            cursor = conn.cursor()
+            folder_ids = {}
+            for row in rows:
+                folder = row[:2]
+                if folder not in folder_ids:
+                    folder_ids[folder] = self._folder_id(cursor, *folder, create=True)
+            cursor.executemany('''
+                INSERT INTO documents (folder_id, number, name, counterparty, start_date, end_date, description)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', ((folder_ids[row[:2]],) + tuple(row[2:]) for row in rows))
+        self.mark_changed()
+        return len(rows)
+
+    def load_folder_tree(self):
+        """Читает только иерархию папок, включая пустые: { "Верхняя папка": ["Подпапка", ...], ... }"""
+        folders = {}
+        with span("db_load_tree") as timing:
+            conn = self.engine.connection()
+            # Читаются только таблицы папок, документы не затрагиваются
+            for top_folder, sub_folder in conn.execute('''
+                    SELECT t.name, s.name FROM top_folders t LEFT JOIN sub_folders s ON s.top_folder_id = t.id
+                    ORDER BY t.name, s.name
+            '''):
+                sub_folders = folders.setdefault(top_folder, [])
+                if sub_folder is not None:
+                    sub_folders.append(sub_folder)
+            timing.set(rows=sum(len(subs) for subs in folders.values()))
+        return folders
+
+    def load_documents(self, top_folder_name, sub_folder_name):
+        """Загружает документы и вложения одной подпапки."""
+        with span("db_load_folder", folder=f"{top_folder_name}/{sub_folder_name}") as timing:
+            documents = self._load_documents(top_folder_name, sub_folder_name)
+            timing.set(rows=len(documents))
+        return documents
+
+    def _load_documents(self, top_folder_name, sub_folder_name):
+        conn = self.engine.connection()
+        folder_id = self._folder_id(conn.cursor(), top_folder_name, sub_folder_name)
+        if folder_id is None:
+            return []
+        rows = conn.execute('''
+            SELECT id, number, name, counterparty, start_date, end_date, description, version
+            FROM documents WHERE folder_id = ? ORDER BY id
+        ''', (folder_id,)).fetchall()
+        documents = [self._row_to_document(row) for row in rows]
+        attachments = {doc.id: [] for doc in documents}
+        for doc_id, file_path, name, content_hash in conn.execute('''
+            SELECT a.document_id, a.file_path, a.name, a.content_hash
+            FROM attachments a JOIN documents d ON d.id = a.document_id
+            WHERE d.folder_id = ? ORDER BY a.id
+        ''', (folder_id,)):
+            if doc_id in attachments:
+                attachments[doc_id].append(Attachment(name or file_path, file_path, content_hash))
+        for doc in documents:
+            doc.attachments = tuple(attachments[doc.id])
+        return documents
+
+    def iter_documents(self, top_folder_name=None, is_cancelled=None):
+        """Построчно отдает (top_folder, sub_folder, Document) без вложений, не держа всю выборку в памяти."""
+        query = self.DOCUMENT_SELECT
+        params = ()
+        if top_folder_name is not None:
+            query += ' WHERE t.name = ?'
+            params = (top_folder_name,)
+        for row in self._iter_query(query, params, is_cancelled):
+            yield row[0], row[1], self._row_to_document(row[2:])
+
+    def search_documents(self, text, field="all"):
+        """
+        Полнотекстовый поиск по номеру, наименованию, контрагенту и описанию, а также
+        (field "all" или ATTACHMENT_TEXT_FIELD) по тексту файлов вложений.
+        Каждое слово запроса ищется как префикс; результаты упорядочены по релевантности.
+        Возвращает список (top_folder, sub_folder, Document).
+        """
+        with span("search", field=field) as timing:
+            results = list(self.iter_search_results(text, field))
+            timing.set(rows=len(results))
+        return results
+
+    def iter_search_results(self, text, field="all", is_cancelled=None):
+        """
+        То же, что search_documents, но отдает результаты по мере чтения из курсора.
+        Если is_cancelled() вернул True, запрос прерывается (в том числе внутри SQLite)
+        и бросается QueryCancelled - так поиск при наборе текста бросает устаревшие запросы.
+        """
+        # Запрос FTS зависит только от слов, перебор - от всей строки
+        key = ("search", field, " ".join(re.findall(r"\w+", text.lower())) if self.fts_enabled else text.lower())
+        generation = self.generation
+        cached = self.query_cache.get(key, generation)
+        if cached is not None:
+            yield from cached
+            return
+        collected = []
+        for row in self._iter_search_rows(text, field, is_cancelled):
+            if collected is not None:
+                collected.append(row)
+                if len(collected) > self.query_cache.max_rows:
+                    collected = None # Слишком большой результат не кэшируем
+            yield row
+        if collected is not None:
+            self.query_cache.put(key, generation, collected)
+
+    def _iter_search_rows(self, text, field, is_cancelled):
+        words = re.findall(r"\w+", text)
+        if not words:
+            yield from self.iter_documents(is_cancelled=is_cancelled) # Пустой запрос совпадает со всеми документами
+            return
+        if not self.fts_enabled:
+            if field != ATTACHMENT_TEXT_FIELD:
+                yield from self._scan_documents(text, field, is_cancelled)
+            return
+        query = " ".join(f'"{word}"*' for word in words)
+        found = set()
+        if field != ATTACHMENT_TEXT_FIELD:
+            for row in self._iter_query('''
+                    SELECT t.name, s.name, d.id, d.number, d.name, d.counterparty,
+                           d.start_date, d.end_date, d.description, d.version
+                    FROM documents_fts JOIN documents d ON d.id = documents_fts.rowid
+                    JOIN sub_folders s ON s.id = d.folder_id JOIN top_folders t ON t.id = s.top_folder_id
+                    WHERE documents_fts MATCH ?
+                    ORDER BY rank
+                ''', (query if field == "all" else f"{field} : ({query})",), is_cancelled):
+                found.add(row[2])
+                yield row[0], row[1], self._row_to_document(row[2:])
+        if field in ("all", ATTACHMENT_TEXT_FIELD) and self.text_index_enabled:
+            # Документы, у которых слова нашлись только в содержимом вложений, - после совпадений в полях
+            for row in self._iter_query('''
+                    SELECT t.name, s.name, d.id, d.number, d.name, d.counterparty,
+                           d.start_date, d.end_date, d.description, d.version
+                    FROM (
+                        SELECT a.document_id AS id, MIN(f.rank) AS rank
+                        FROM attachment_text_fts f
+                        JOIN attachment_texts x ON x.id = f.rowid
+                        JOIN attachments a ON a.file_path = x.file_path
+                        WHERE attachment_text_fts MATCH ?
+                        GROUP BY a.document_id
+                    ) m
+                    JOIN documents d ON d.id = m.id
+                    JOIN sub_folders s ON s.id = d.folder_id JOIN top_folders t ON t.id = s.top_folder_id
+                    ORDER BY m.rank
+                ''', (query,), is_cancelled):
+                if row[2] not in found:
+                    yield row[0], row[1], self._row_to_document(row[2:])
+
+    def _scan_documents(self, text, field, is_cancelled=None):
+        """Поиск подстроки перебором - для SQLite без FTS5."""
+        search_text = text.lower()
+        fields = SEARCH_TEXT_FIELDS if field == "all" else (field,)
+        for top_folder_name, sub_folder_name, doc in self.iter_documents(is_cancelled=is_cancelled):
+            if any(search_text in (getattr(doc, name) or "").lower() for name in fields):
+                yield top_folder_name, sub_folder_name, doc
+
+    def _iter_query(self, query, params, is_cancelled=None):
+        """Строки запроса по мере чтения; is_cancelled проверяется и между строками, и внутри SQLite."""
+        if is_cancelled is None:
+            yield from self.engine.connection().execute(query, params)
+            return
+        # Обработчик прогресса действует на все соединение, поэтому прерываемый запрос
+        # выполняется в отдельном соединении, а не в общем соединении потока
+        conn = self.engine.connect()
+        try:
+            # Ненулевой ответ обработчика прерывает выполняющийся запрос (сортировку по rank и т.п.)
+            conn.set_progress_handler(is_cancelled, QUERY_CANCEL_CHECK_STEPS)
+            try:
+                for row in conn.execute(query, params):
+                    if is_cancelled():
+                        raise QueryCancelled()
+                    yield row
+            except sqlite3.OperationalError:
+                if is_cancelled():
+                    raise QueryCancelled() from None
+                raise
+        finally:
+            conn.close()
+
+    def find_by_date_range(self, field, from_date, to_date):
+        """Документы, у которых дата field ("start_date" или "end_date") попадает в диапазон, по индексу."""
+        with span("search_dates", field=field) as timing:
+            results = self._cached_select(("dates", field, from_date, to_date),
+                                          *self._date_range_where(field, from_date, to_date))
+            timing.set(rows=len(results))
+        return results
+
+    def iter_by_date_range(self, field, from_date, to_date):
+        """То же, что find_by_date_range, но построчно из курсора и без кэша - для выгрузки большого результата."""
+        where, params = self._date_range_where(field, from_date, to_date)
+        for row in self._iter_query(self.DOCUMENT_SELECT + where, params):
+            yield row[0], row[1], self._row_to_document(row[2:])
+
+    @staticmethod
+    def _date_range_where(field, from_date, to_date):
+        if field not in ("start_date", "end_date"):
+            raise ValueError(f"Неизвестное поле даты: {field}")
+        return (f' WHERE d.{field} BETWEEN ? AND ? ORDER BY d.{field}',
+                (from_date.isoformat(), to_date.isoformat()))
+
+    def find_expiring(self, days_threshold, top_folder_name=None):
+        """
+        Документы, срок которых истекает в ближайшие days_threshold дней (включая сегодня),
+        по всем папкам или только в top_folder_name. Диапазонный просмотр индекса
+        idx_documents_end_date: O(log N + k), результаты уже отсортированы по дате окончания.
+        """
+        today = date.today()
+        with span("expiry_scan", days=days_threshold) as timing:
+            # В ключе - сегодняшняя дата: назавтра тот же порог дает другой диапазон
+            results = self._cached_select(("expiring", days_threshold, top_folder_name, today),
+                                          *self._expiring_where(today, days_threshold, top_folder_name))
+            timing.set(rows=len(results))
+        return results
+
+    def iter_expiring(self, days_threshold, top_folder_name=None):
+        """То же, что find_expiring, но построчно из курсора и без кэша - для выгрузки большого результата."""
+        where, params = self._expiring_where(date.today(), days_threshold, top_folder_name)
+        for row in self._iter_query(self.DOCUMENT_SELECT + where, params):
+            yield row[0], row[1], self._row_to_document(row[2:])
+
+    @staticmethod
+    def _expiring_where(today, days_threshold, top_folder_name):
+        params = (today.isoformat(), (today + timedelta(days=days_threshold)).isoformat())
+        where = ' WHERE d.end_date BETWEEN ? AND ?'
+        if top_folder_name is not None:
+            where += ' AND t.name = ?'
+            params += (top_folder_name,)
+        return where + ' ORDER BY d.end_date', params
+
+    def _cached_select(self, key, where, params):
+        """_select_documents через кэш запросов; возвращает новый список, который можно изменять."""
+        generation = self.generation
+        results = self.query_cache.get(key, generation)
+        if results is None:
+            results = self._select_documents(where, params)
+            self.query_cache.put(key, generation, results)
+        return list(results)
+
+    def _select_documents(self, where, params):
+        conn = self.engine.connection()
+        rows = conn.execute(self.DOCUMENT_SELECT + where, params).fetchall()
+        return [(row[0], row[1], self._row_to_document(row[2:])) for row in rows]
+
+    # Документы с именами папок: d - documents, s - sub_folders, t - top_folders
+    DOCUMENT_FOLDERS = '''
+        documents d JOIN sub_folders s ON s.id = d.folder_id JOIN top_folders t ON t.id = s.top_folder_id
+    '''
+    # То же с обходом по порядку папок: CROSS JOIN фиксирует порядок соединения, и ORDER BY t.name, s.name, d.id
+    # выполняется по индексам имен папок и idx_documents_folder без сортировки всей выборки
+    FOLDER_ORDERED_DOCUMENTS = '''
+        top_folders t CROSS JOIN sub_folders s ON s.top_folder_id = t.id CROSS JOIN documents d ON d.folder_id = s.id
+    '''
+    DOCUMENT_SELECT = '''
+        SELECT t.name, s.name, d.id, d.number, d.name, d.counterparty, d.start_date, d.end_date, d.description,
+               d.version
+        FROM ''' + DOCUMENT_FOLDERS
+
+    # Строка экспорта: ID, затем значения; даты переводятся в dd.MM.yyyy, вложения склеиваются прямо в SQL
+    EXPORT_FIELDS = '''
+        SELECT d.id, t.name, s.name, d.number, d.name, d.counterparty,
+               substr(d.start_date, 9, 2) || '.' || substr(d.start_date, 6, 2) || '.' || substr(d.start_date, 1, 4),
+               CASE WHEN d.end_date IS NULL THEN ''
+                    ELSE substr(d.end_date, 9, 2) || '.' || substr(d.end_date, 6, 2) || '.' || substr(d.end_date, 1, 4) END,
+               d.description,
+               COALESCE((SELECT group_concat(COALESCE(a.name, a.file_path), ', ')
+                         FROM attachments a WHERE a.document_id = d.id), '')
+    '''
+    EXPORT_SELECT = EXPORT_FIELDS + ' FROM ' + DOCUMENT_FOLDERS
+
+    def iter_export_rows(self, top_folder_name, sub_folder_name):
+        """
+        Построчно отдает строки экспорта подпапки прямо из курсора SQLite.
+        Соединение открывается при первой итерации, поэтому генератор можно передать в другой поток.
+        """
+        conn = self.engine.connection()
+        for row in conn.execute(self.EXPORT_SELECT + '''
+            WHERE t.name = ? AND s.name = ? ORDER BY d.id
+        ''', (top_folder_name, sub_folder_name)):
+            yield row[3:] # Папка известна из имени листа
+
+    def iter_export_rows_by_ids(self, doc_ids, chunk_size=500):
+        """Строки экспорта (с папками) для заданных ID документов в исходном порядке."""
+        conn = self.engine.connection()
+        for start in range(0, len(doc_ids), chunk_size):
+            chunk = doc_ids[start:start + chunk_size]
+            placeholders = ", ".join("?" * len(chunk))
+            rows = {row[0]: row[1:] for row in conn.execute(
+                self.EXPORT_SELECT + f' WHERE d.id IN ({placeholders})', chunk)}
+            for doc_id in chunk:
+                if doc_id in rows:
+                    yield rows[doc_id]
+
+    def iter_all_export_rows(self, top_folder_name=None, sub_folder_name=None):
+        """Строки экспорта с папками (вся база, верхняя папка или подпапка) по порядку папок."""
+        where, params = '', ()
+        if top_folder_name is not None:
+            where, params = ' WHERE t.name = ?', (top_folder_name,)
+            if sub_folder_name is not None:
+                where, params = where + ' AND s.name = ?', params + (sub_folder_name,)
+        conn = self.engine.connection()
+        for row in conn.execute(self.EXPORT_FIELDS + ' FROM ' + self.FOLDER_ORDERED_DOCUMENTS + where
+                                + ' ORDER BY t.name, s.name, d.id', params):
+            yield row[1:]
+
+    def count_documents(self, top_folder_name=None, sub_folder_name=None):
+        """Количество документов во всей базе, в верхней папке или в подпапке."""
+        conn = self.engine.connection()
+        if top_folder_name is None:
+            row = conn.execute('SELECT COUNT(*) FROM documents').fetchone()
+        elif sub_folder_name is None:
+            row = conn.execute('SELECT COUNT(*) FROM ' + self.DOCUMENT_FOLDERS + ' WHERE t.name = ?',
+                               (top_folder_name,)).fetchone()
+        else:
+            row = conn.execute('SELECT COUNT(*) FROM documents WHERE folder_id = ?',
+                               (self._folder_id(conn.cursor(), top_folder_name, sub_folder_name),)).fetchone()
+        return row[0]
+
+    def create_folder(self, top_folder_name, sub_folder_name=None):
+        """Создает верхнюю папку или подпапку (и ее верхнюю папку), если их еще нет."""
+        with self._transaction() as conn:
+            cursor = conn.cursor()
+            if sub_folder_name is None:
+                cursor.execute('INSERT OR IGNORE INTO top_folders (name) VALUES (?)', (top_folder_name,))
+            else:
+                self._folder_id(cursor, top_folder_name, sub_folder_name, create=True)
+        self.mark_changed()
+
+    def delete_folder(self, top_folder_name, sub_folder_name=None):
+        """Удаляет пустую подпапку или верхнюю папку со всеми ее (пустыми) подпапками."""
+        if self.count_documents(top_folder_name, sub_folder_name):
+            raise ValueError("Нельзя удалить непустую папку")
+        with self._transaction() as conn:
+            if sub_folder_name is None:
+                # Подпапки удаляются каскадно (ON DELETE CASCADE)
+                conn.execute('DELETE FROM top_folders WHERE name = ?', (top_folder_name,))
+            else:
+                conn.execute('DELETE FROM sub_folders WHERE id = ?',
+                             (self._folder_id(conn.cursor(), top_folder_name, sub_folder_name),))
+        self.mark_changed()
+
+    def rename_folder(self, top_folder_name, sub_folder_name, new_name):
+        """
+        Переименовывает подпапку (или верхнюю папку, если sub_folder_name - None).
+        Меняется одна строка таблицы папок, документы не переписываются.
+        """
+        try:
+            with self._transaction() as conn:
+                if sub_folder_name is None:
+                    conn.execute('UPDATE top_folders SET name = ? WHERE name = ?', (new_name, top_folder_name))
+                else:
+                    conn.execute('UPDATE sub_folders SET name = ? WHERE id = ?',
+                                 (new_name, self._folder_id(conn.cursor(), top_folder_name, sub_folder_name)))
+        except sqlite3.IntegrityError:
+            raise ValueError(f"Папка с именем {new_name} уже существует") from None
+        self.mark_changed()
+
+    def move_folder(self, top_folder_name, sub_folder_name, new_top_folder_name):
+        """Переносит подпапку в другую верхнюю папку (создается при необходимости) вместе с документами."""
+        try:
+            with self._transaction() as conn:
+                cursor = conn.cursor()
+                folder_id = self._folder_id(cursor, top_folder_name, sub_folder_name)
+                cursor.execute('INSERT OR IGNORE INTO top_folders (name) VALUES (?)', (new_top_folder_name,))
+                cursor.execute('''
+                    UPDATE sub_folders SET top_folder_id = (SELECT id FROM top_folders WHERE name = ?) WHERE id = ?
+                ''', (new_top_folder_name, folder_id))
+        except sqlite3.IntegrityError:
+            raise ValueError(f"В папке {new_top_folder_name} уже есть подпапка {sub_folder_name}") from None
+        self.mark_changed()
+
+    @contextmanager
+    def _transaction(self):
+        """
+        Транзакция записи документов или папок в соединении потока. Блокировка записи берется
+        сразу (BEGIN IMMEDIATE), поэтому номера записей change_log, появившихся за транзакцию,
+        принадлежат ей; в потоке, проверяющем изменения, они запоминаются как собственные.
+        """
+        conn = self.engine.connection()
+        with conn: # commit при успехе, rollback при ошибке
+            conn.execute('BEGIN IMMEDIATE')
+            first = self._last_change_id(conn)
+            yield conn
+            last = self._last_change_id(conn)
+            if last // CHANGE_LOG_KEEP != first // CHANGE_LOG_KEEP:
+                conn.execute('DELETE FROM change_log WHERE change_id <= ?', (last - CHANGE_LOG_KEEP,))
+        if last > first and threading.get_ident() == self._watch_thread:
+            self._own_changes.append((first, last))
+
+    def poll_changes(self, busy_timeout=None):
+        """
+        Изменения документов и папок, записанные в базу другими соединениями (другими экземплярами
+        программы, фоновым импортом) с прошлого вызова: ExternalChanges или None, если их не было.
+        Первый вызов запоминает точку отсчета и проверяющий поток; вызывать всегда из него.
+        Пока никто другой не писал, выполняется только PRAGMA data_version.
+        busy_timeout (сек) ограничивает ожидание чужой записи; если его не хватило,
+        бросается sqlite3.OperationalError, а изменения вернет следующий вызов.
+        """
+        conn = self.engine.connection()
+        if busy_timeout is None:
+            return self._poll_changes(conn)
+        conn.execute(f'PRAGMA busy_timeout = {int(busy_timeout * 1000)}')
+        try:
+            return self._poll_changes(conn)
+        finally:
+            conn.execute(f'PRAGMA busy_timeout = {int(SQLITE_BUSY_TIMEOUT * 1000)}')
+
+    def _poll_changes(self, conn):
+        data_version = conn.execute('PRAGMA data_version').fetchone()[0]
+        if self._seen is None:
+            self._watch_thread = threading.get_ident()
+            self._seen = (data_version, self._last_change_id(conn))
+            return None
+        if data_version == self._seen[0]:
+            return None # Собственные записи соединения data_version не меняют
+        last_change = self._seen[1]
+        first_kept = conn.execute('SELECT MIN(change_id) FROM change_log').fetchone()[0]
+        tree = False
+        folders = set()
+        for change_id, folder_id, top_folder_name, sub_folder_name in conn.execute('''
+                SELECT c.change_id, c.folder_id, t.name, s.name FROM change_log c
+                LEFT JOIN sub_folders s ON s.id = c.folder_id LEFT JOIN top_folders t ON t.id = s.top_folder_id
+                WHERE c.change_id > ? ORDER BY c.change_id
+        ''', (last_change,)):
+            last_change = change_id
+            if any(first < change_id <= last for first, last in self._own_changes):
+                continue
+            if folder_id == FOLDER_TREE_CHANGE:
+                tree = True
+            elif sub_folder_name is not None: # Удаленная подпапка видна по изменению дерева
+                folders.add((top_folder_name, sub_folder_name))
+        if first_kept is not None and first_kept > self._seen[1] + 1:
+            tree, folders = True, None # Часть журнала уже удалена
+        self._seen = (data_version, last_change)
+        self._own_changes = [(first, last) for first, last in self._own_changes if last > last_change]
+        if not tree and not folders:
+            return None # Например, изменилась только очередь удаления вложений
+        self.mark_changed()
+        return ExternalChanges(tree, folders)
+
+    @staticmethod
+    def _last_change_id(conn):
+        return conn.execute('SELECT COALESCE(MAX(change_id), 0) FROM change_log').fetchone()[0]
+
+    def find_blob(self, content_hash):
+        """Путь к файлу с таким содержимым, если оно уже есть в хранилище."""
+        conn = self.engine.connection()
+        row = conn.execute('SELECT file_path FROM blobs WHERE content_hash = ?', (content_hash,)).fetchone()
+        return row[0] if row else None
+
+    def register_blob(self, content_hash, file_path, size):
+        """Регистрирует файл хранилища; ссылки на него считают триггеры таблицы attachments."""
+        conn = self.engine.connection()
+        with conn:
+            conn.execute('''
+                INSERT INTO blobs (content_hash, file_path, size, registered_at) VALUES (?, ?, ?, ?)
+                ON CONFLICT (content_hash) DO UPDATE
+                SET file_path = excluded.file_path, size = excluded.size, registered_at = excluded.registered_at
+            ''', (content_hash, file_path, size, time.time()))
+
+    def touch_blob(self, content_hash):
+        """
+        Отмечает повторное помещение содержимого в хранилище (см. migrate_blob_registration).
+        Возвращает False, если записи уже нет - файл забрала очистка, его нужно скопировать заново.
+        """
+        conn = self.engine.connection()
+        with conn:
+            cursor = conn.execute('UPDATE blobs SET registered_at = ? WHERE content_hash = ?',
+                                  (time.time(), content_hash))
+        return cursor.rowcount > 0
+
+    def queue_file_deletes(self, file_paths):
+        """Ставит файлы в очередь на удаление; удалены будут только те, на которые нет ссылок."""
+        conn = self.engine.connection()
+        with conn:
+            conn.executemany('INSERT OR IGNORE INTO pending_deletes (file_path) VALUES (?)',
+                             [(file_path,) for file_path in file_paths])
+
+    def pending_deletes(self, after, limit):
+        """Порция очереди на удаление: [(номер в очереди, file_path)] с номерами больше after."""
+        conn = self.engine.connection()
+        return conn.execute('SELECT rowid, file_path FROM pending_deletes WHERE rowid > ? ORDER BY rowid LIMIT ?',
+                            (after, limit)).fetchall()
+
+    def drop_pending_deletes(self, file_paths):
+        conn = self.engine.connection()
+        with conn:
+            conn.executemany('DELETE FROM pending_deletes WHERE file_path = ?',
+                             [(file_path,) for file_path in file_paths])
+
+    def claim_orphans(self, file_paths, registered_before):
+        """
+        Разбирает пути на (claimed, deferred). claimed - файлы, на которые не ссылается ни одно
+        вложение: записи их содержимого удалены из blobs, файлы можно удалять с диска.
+        deferred - файлы без ссылок, помещенные в хранилище позже registered_before: документ
+        с ними, возможно, еще не сохранен. Проверка ссылок и удаление записей - одна транзакция
+        с блокировкой записи, поэтому ссылка из другого соединения не появится между ними.
+        """
+        file_paths = list(dict.fromkeys(file_paths)) # Во время миграции хранилища имя может встретиться дважды
+        if not file_paths:
+            return [], []
+        placeholders = ", ".join("?" * len(file_paths))
+        claimed = []
+        deferred = []
+        conn = self.engine.connection()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            referenced = {file_path for (file_path,) in conn.execute(
+                f'SELECT DISTINCT file_path FROM attachments WHERE file_path IN ({placeholders})', file_paths)}
+            blobs = {file_path: ref_count for file_path, ref_count in conn.execute(
+                f'SELECT file_path, ref_count FROM blobs WHERE file_path IN ({placeholders})', file_paths)}
+            for file_path in file_paths:
+                if file_path in referenced:
+                    continue
+                if file_path not in blobs:
+                    claimed.append(file_path) # Старое вложение (не по хешу) или файл без записи
+                    continue
+                if blobs[file_path] > 0:
+                    continue
+                cursor = conn.execute('''
+                    DELETE FROM blobs WHERE file_path = ? AND ref_count <= 0
+                    AND (registered_at IS NULL OR registered_at < ?)
+                ''', (file_path, registered_before))
+                (claimed if cursor.rowcount else deferred).append(file_path)
+            if self.text_index_enabled:
+                # Текст удаляемого файла больше не нужен индексу
+                conn.executemany('DELETE FROM attachment_texts WHERE file_path = ?',
+                                 [(file_path,) for file_path in claimed])
+                conn.executemany('DELETE FROM attachment_text_queue WHERE file_path = ?',
+                                 [(file_path,) for file_path in claimed])
+        return claimed, deferred
+
+    def text_index_queue(self, after, limit):
+        """Порция очереди извлечения текста: [(номер в очереди, file_path)] с номерами больше after."""
+        conn = self.engine.connection()
+        return conn.execute('SELECT rowid, file_path FROM attachment_text_queue WHERE rowid > ? ORDER BY rowid LIMIT ?',
+                            (after, limit)).fetchall()
+
+    def store_attachment_texts(self, results):
+        """
+        Записывает извлеченный текст [(file_path, extractor или None, текст)] в индекс и убирает
+        файлы из очереди. Файлы, на которые уже не ссылается ни одно вложение, не индексируются.
+        """
+        conn = self.engine.connection()
+        with conn:
+            for file_path, extractor, text in results:
+                conn.execute('DELETE FROM attachment_text_queue WHERE file_path = ?', (file_path,))
+                conn.execute('DELETE FROM attachment_texts WHERE file_path = ?', (file_path,))
+                referenced = conn.execute('SELECT 1 FROM attachments WHERE file_path = ? LIMIT 1', (file_path,))
+                if referenced.fetchone() is None:
+                    continue
+                text_id = conn.execute('INSERT INTO attachment_texts (file_path, extractor) VALUES (?, ?)',
+                                       (file_path, extractor)).lastrowid
+                if text:
+                    conn.execute('INSERT INTO attachment_text_fts (rowid, text) VALUES (?, ?)', (text_id, text))
+        self.mark_changed() # Поиск по содержимому вложений теперь дает другие результаты
+
+    def reindex_attachment_texts(self):
+        """Ставит все файлы вложений в очередь на повторное извлечение текста; возвращает длину очереди."""
+        conn = self.engine.connection()
+        with conn:
+            conn.execute('INSERT OR IGNORE INTO attachment_text_queue (file_path) SELECT file_path FROM attachments')
+            return conn.execute('SELECT COUNT(*) FROM attachment_text_queue').fetchone()[0]
+
+    def get_setting(self, key, default=None):
+        conn = self.engine.connection()
+        row = conn.execute('SELECT value FROM settings WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else default
+
+    def set_setting(self, key, value):
+        """Сохраняет значение настройки; None удаляет ее."""
+        conn = self.engine.connection()
+        with conn:
+            if value is None:
+                conn.execute('DELETE FROM settings WHERE key = ?', (key,))
+            else:
+                conn.execute('INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)', (key, value))
+
+    def statistics(self):
+        """Сводка по базе: документы, папки, вложения, размер хранилища и файла БД."""
+        conn = self.engine.connection()
+        documents = conn.execute('SELECT COUNT(*) FROM documents').fetchone()[0]
+        top_folders = conn.execute('SELECT COUNT(*) FROM top_folders').fetchone()[0]
+        sub_folders = conn.execute('SELECT COUNT(*) FROM sub_folders').fetchone()[0]
+        attachments = conn.execute('SELECT COUNT(*) FROM attachments').fetchone()[0]
+        blobs, blob_bytes = conn.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM blobs').fetchone()
+        pending_deletes = conn.execute('SELECT COUNT(*) FROM pending_deletes').fetchone()[0]
+        schema_version = conn.execute('PRAGMA user_version').fetchone()[0]
+        stats = {
+            "documents": documents,
+            "top_folders": top_folders,
+            "sub_folders": sub_folders,
+            "attachments": attachments,
+            "unique_files": blobs,
+            "unique_files_bytes": blob_bytes,
+            "pending_deletes": pending_deletes,
+            "schema_version": schema_version,
+            "database_bytes": os.path.getsize(self.db_path),
+        }
+        if self.text_index_enabled:
+            stats["indexed_files"] = conn.execute(
+                'SELECT COUNT(*) FROM attachment_texts WHERE extractor IS NOT NULL').fetchone()[0]
+            stats["text_index_queue"] = conn.execute('SELECT COUNT(*) FROM attachment_text_queue').fetchone()[0]
+        return stats
+
+    def vacuum(self):
+        """Оптимизирует полнотекстовые индексы, обновляет статистику планировщика и сжимает файл БД."""
+        conn = self.engine.connection()
+        with span("db_vacuum"):
+            if self.fts_enabled:
+                with conn:
+                    conn.execute("INSERT INTO documents_fts (documents_fts) VALUES ('optimize')")
+            if self.text_index_enabled:
+                with conn:
+                    conn.execute("INSERT INTO attachment_text_fts (attachment_text_fts) VALUES ('optimize')")
+            conn.execute('ANALYZE')
+            conn.execute('VACUUM')
+
+    @staticmethod
+    def _folder_id(cursor, top_folder_name, sub_folder_name, create=False):
+        """ID подпапки по уникальным индексам имен; с create=True недостающие папки создаются."""
+        row = cursor.execute('''
+            SELECT s.id FROM top_folders t JOIN sub_folders s ON s.top_folder_id = t.id
+            WHERE t.name = ? AND s.name = ?
+        ''', (top_folder_name, sub_folder_name)).fetchone()
+        if row is not None or not create:
+            return row[0] if row else None
+        cursor.execute('INSERT OR IGNORE INTO top_folders (name) VALUES (?)', (top_folder_name,))
+        cursor.execute('INSERT INTO sub_folders (top_folder_id, name) SELECT id, ? FROM top_folders WHERE name = ?',
+                       (sub_folder_name, top_folder_name))
+        return cursor.lastrowid
+
+    def _table_exists(self, name):
+        conn = self.engine.connection()
+        return conn.execute("SELECT 1 FROM sqlite_master WHERE name = ?", (name,)).fetchone() is not None
+
+    @staticmethod
+    def _row_to_document(row):
+        doc_id, number, name, counterparty, start_date_str, end_date_str, description, version = row
+        return Document(
+            number=number,
+            name=name,
+            counterparty=counterparty,
+            start_date=date.fromisoformat(start_date_str),
+            end_date=date.fromisoformat(end_date_str) if end_date_str else None,
+            description=description,
+            db_id=doc_id,
+            version=version
+        )
+
+    @staticmethod
+    def _document_values(doc):
+        return (doc.number, doc.name, doc.counterparty,
+                doc.start_date.isoformat(),
+                doc.end_date.isoformat() if doc.end_date else None,
+                doc.description)
+
+    @staticmethod
+    def _write_attachments(cursor, doc):
+        """Перезаписывает вложения одного документа."""
+        cursor.execute('DELETE FROM attachments WHERE document_id = ?', (doc.id,))
+        cursor.executemany('''
+            INSERT INTO attachments (document_id, file_path, name, content_hash)
+            VALUES (?, ?, ?, ?)
+        ''', [(doc.id, attachment.file_path, attachment.name, attachment.content_hash)
+              for attachment in doc.attachments]) # file_path уже относительный путь
+
+
+class QueryCache:
+    """
+    LRU-кэш результатов запросов (поиск, проверка сроков) по нормализованным параметрам.
+    Запись помнит поколение данных, для которого получена, и после изменения данных
+    (DocumentStorage.mark_changed) считается промахом. Память ограничена числом
+    запросов capacity и суммарным числом строк max_rows; capacity=0 отключает кэш.
+    Может использоваться из нескольких потоков.
+    """
+    def __init__(self, capacity=QUERY_CACHE_SIZE, max_rows=QUERY_CACHE_MAX_ROWS):
+        self.capacity = capacity
+        self.max_rows = max_rows
+        self._entries = OrderedDict() # ключ -> (поколение, [строки])
+        self._rows = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, generation):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != generation:
+                if entry is not None:
+                    self._drop(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, generation, results):
+        if self.capacity <= 0 or len(results) > self.max_rows:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = (generation, results)
+            self._rows += len(results)
+            while len(self._entries) > self.capacity or self._rows > self.max_rows:
+                self._drop(next(iter(self._entries)))
+
+    def _drop(self, key):
+        self._rows -= len(self._entries.pop(key)[1])
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._rows = 0
+
+
+class SubfolderCache:
+    """
+    LRU-кэш документов подпапок. Подпапка загружается из базы при первом
+    обращении; при превышении capacity вытесняется давно не использованная.
+    Пока в хранилище есть несохраненные изменения, подпапки не вытесняются:
+    иначе подпапка с ними перечиталась бы из базы без этих изменений.
+    Сам кэш в базу не пишет - сохранение и его ошибки остаются за вызывающим.
+    """
+    def __init__(self, storage, capacity=SUBFOLDER_CACHE_SIZE):
+        self.storage = storage
+        self.capacity = capacity
+        self._folders = OrderedDict() # (top_folder, sub_folder) -> [Document, ...]
+
+    def get(self, top_folder_name, sub_folder_name):
+        key = (top_folder_name, sub_folder_name)
+        documents = self._folders.get(key)
+        if documents is not None:
+            self._folders.move_to_end(key)
+            return documents
+        documents = self.storage.load_documents(top_folder_name, sub_folder_name)
+        self._folders[key] = documents
+        if not self.storage.has_changes():
+            while len(self._folders) > self.capacity:
+                self._folders.popitem(last=False)
+        return documents
+
+    def discard(self, top_folder_name, sub_folder_name=None):
+        """Убирает из кэша подпапку или все подпапки верхней папки."""
+        for key in list(self._folders):
+            if key[0] == top_folder_name and (sub_folder_name is None or key[1] == sub_folder_name):
+                del self._folders[key]
+
+    def clear(self):
+        self._folders.clear()
@@ -0,0 +1,216 @@
+"""
+Извлечение текста из файлов вложений для поиска по их содержимому.
+
+Формат файла определяет реестр извлекателей по расширению: register_extractor
+связывает функцию(путь) -> текст с расширениями, а модуль, без которого
+извлекатель не работает (например, pypdf для PDF), указывается в requires.
+Разбор PDF и XLSX - работа процессора, поэтому текст извлекается в пуле процессов,
+а в базу его пишет вызывающий поток (см. index_attachment_texts).
+"""
+import importlib.util
+import logging
+import multiprocessing
+import os
+import zipfile
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from xml.etree import ElementTree
+
+from registrar.attachments import attachment_path
+from registrar.instrumentation import span
+
+logger = logging.getLogger(__name__)
+
+# Сколько файлов из очереди разбирается за раз и сколько процессов извлекают текст
+TEXT_INDEX_BATCH = 32
+TEXT_INDEX_WORKERS = max(1, min(4, (os.cpu_count() or 2) - 1))
+# Файлы больше этого не разбираются; текст длиннее обрезается (символов)
+TEXT_INDEX_MAX_FILE_BYTES = 100 * 1024 * 1024
+TEXT_INDEX_MAX_CHARS = 2 * 1024 * 1024
+# Как часто, пока файлы разбираются, проверяется запрос на остановку (сек)
+TEXT_INDEX_STOP_CHECK = 0.2
+
+# Кодировки простого текста по порядку проб; cp1251 - файлы из старых версий Windows
+PLAIN_TEXT_ENCODINGS = ("utf-8-sig", "cp1251")
+
+WORD_NAMESPACE = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+
+# Расширение (в нижнем регистре, с точкой) -> (имя извлекателя, функция(путь) -> текст, нужный модуль или None)
+EXTRACTORS = {}
+
+
+def register_extractor(name, extensions, requires=None):
+    """Декоратор: функция(путь) -> текст извлекает текст из файлов с расширениями extensions."""
+    def decorator(function):
+        for extension in extensions:
+            EXTRACTORS[extension.lower()] = (name, function, requires)
+        return function
+    return decorator
+
+
+def available_extractors():
+    """Расширения, для которых есть извлекатель с установленными зависимостями."""
+    return {extension for extension, (_, _, requires) in EXTRACTORS.items()
+            if requires is None or importlib.util.find_spec(requires) is not None}
+
+
+@register_extractor("text", (".txt", ".csv", ".md", ".xml", ".html", ".htm"))
+def extract_plain_text(path):
+    with open(path, "rb") as f:
+        data = f.read()
+    for encoding in PLAIN_TEXT_ENCODINGS:
+        try:
+            return data.decode(encoding)
+        except UnicodeDecodeError:
+            continue
+    return data.decode(PLAIN_TEXT_ENCODINGS[0], errors="replace")
+
+
+@register_extractor("docx", (".docx", ".docm"))
+def extract_docx(path):
+    """Текст абзацев word/document.xml; библиотека не нужна - DOCX это ZIP с XML."""
+    paragraphs = []
+    with zipfile.ZipFile(path) as archive, archive.open("word/document.xml") as xml:
+        parts = []
+        for _, element in ElementTree.iterparse(xml):
+            if element.tag == WORD_NAMESPACE + "t" and element.text:
+                parts.append(element.text)
+            elif element.tag == WORD_NAMESPACE + "tab":
+                parts.append("\t")
+            elif element.tag == WORD_NAMESPACE + "p":
+                paragraphs.append("".join(parts))
+                parts = []
+                element.clear()
+    return "\n".join(paragraphs)
+
+
+@register_extractor("xlsx", (".xlsx", ".xlsm"))
+def extract_xlsx(path):
+    from openpyxl import load_workbook
+    workbook = load_workbook(path, read_only=True, data_only=True)
+    try:
+        lines = []
+        for sheet in workbook.worksheets:
+            lines.append(sheet.title)
+            for row in sheet.iter_rows(values_only=True):
+                values = [str(value) for value in row if value is not None]
+                if values:
+                    lines.append("\t".join(values))
+        return "\n".join(lines)
+    finally:
+        workbook.close()
+
+
+@register_extractor("pdf", (".pdf",), requires="pypdf")
+def extract_pdf(path):
+    from pypdf import PdfReader
+    reader = PdfReader(path)
+    return "\n".join(page.extract_text() or "" for page in reader.pages)
+
+
+def extract_text(path):
+    """
+    Выполняется в процессе пула: (имя извлекателя, текст) для файла или (None, "")
+    для слишком большого файла. Ошибки разбора передаются вызывающему.
+    """
+    name, function, _ = EXTRACTORS[os.path.splitext(path)[1].lower()]
+    if os.path.getsize(path) > TEXT_INDEX_MAX_FILE_BYTES:
+        return None, ""
+    return name, function(path)[:TEXT_INDEX_MAX_CHARS]
+
+
+def terminate_pool(executor):
+    """Останавливает пул, не дожидаясь разбора текущих файлов: процессы пула завершаются принудительно."""
+    terminate_workers = getattr(executor, "terminate_workers", None) # Python 3.14+
+    if terminate_workers is not None:
+        terminate_workers()
+        return
+    processes = list((executor._processes or {}).values())
+    executor.shutdown(wait=False, cancel_futures=True)
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        process.join()
+
+
+def index_attachment_texts(storage, attachments_dir, is_stopped=None, progress=None, workers=TEXT_INDEX_WORKERS):
+    """
+    Разбирает очередь attachment_text_queue: извлекает текст новых файлов вложений
+    в пуле процессов и записывает его в индекс. Файлы форматов без извлекателя
+    и файлы, извлекателю которых не хватает модуля (PDF без pypdf), отмечаются
+    как проиндексированные без текста: очередь не копится, а после установки модуля
+    их можно переиндексировать (DocumentStorage.reindex_attachment_texts).
+    progress(проиндексировано файлов) вызывается после каждой порции. Возвращает число файлов.
+    is_stopped проверяется и пока файлы разбираются: при остановке уже извлеченный текст
+    записывается, а разбор остальных прерывается (они остаются в очереди).
+    """
+    if not storage.text_index_enabled:
+        return 0
+    extensions = available_extractors()
+    indexed = 0
+    executor = None
+    stopped = bool(is_stopped and is_stopped())
+    with span("text_index") as timing:
+        try:
+            after = 0
+            while not stopped:
+                batch = storage.text_index_queue(after, TEXT_INDEX_BATCH)
+                if not batch:
+                    break
+                after = batch[-1][0]
+                results = []
+                jobs = []
+                for _, file_path in batch:
+                    extension = os.path.splitext(file_path)[1].lower()
+                    if extension in extensions:
+                        jobs.append(file_path)
+                    else:
+                        results.append((file_path, None, ""))
+                if jobs and executor is None:
+                    # spawn, а не fork: процесс приложения многопоточный (Qt, фоновые потоки)
+                    executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+                futures = {executor.submit(extract_text, attachment_path(attachments_dir, file_path)): file_path
+                           for file_path in jobs}
+                broken = False
+                done = []
+                waiting = set(futures)
+                while waiting and not stopped:
+                    finished, waiting = wait(waiting, timeout=TEXT_INDEX_STOP_CHECK, return_when=FIRST_COMPLETED)
+                    done.extend(finished)
+                    stopped = bool(is_stopped and is_stopped())
+                for future in done:
+                    file_path = futures[future]
+                    try:
+                        extractor, text = future.result()
+                    except BrokenProcessPool:
+                        # Процесс пула аварийно завершился на каком-то файле порции: какой именно - неизвестно,
+                        # порция отмечается без текста (ее можно переиндексировать), пул создается заново
+                        if not broken:
+                            logger.error("Процесс извлечения текста завершился аварийно на порции с %s", file_path)
+                        broken = True
+                        extractor, text = None, ""
+                    except FileNotFoundError:
+                        # Потерянные файлы находит проверка хранилища вложений, здесь это не повод для предупреждения
+                        logger.info("Файл вложения не найден, текст не извлечен: %s", file_path)
+                        extractor, text = None, ""
+                    except Exception as e:
+                        logger.warning("Не удалось извлечь текст из вложения %s: %s", file_path, e)
+                        extractor, text = None, ""
+                    results.append((file_path, extractor, text))
+                if broken:
+                    executor.shutdown(wait=False)
+                    executor = None
+                if results:
+                    storage.store_attachment_texts(results)
+                    indexed += len(results)
+                    if progress:
+                        progress(indexed)
+                stopped = stopped or bool(is_stopped and is_stopped())
+        finally:
+            if executor is not None:
+                if stopped:
+                    terminate_pool(executor)
+                else:
+                    executor.shutdown(cancel_futures=True)
+        timing.set(rows=indexed)
+    return indexed